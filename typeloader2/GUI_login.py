@@ -13,17 +13,18 @@ contains classes and functions for login & user handling functionality
 # import modules:
 
 import os, sys, shutil, logging, platform
+from concurrent.futures import ThreadPoolExecutor
 from packaging.version import parse as parsedVersion  # 189
 from configparser import ConfigParser
 from PyQt5.QtWidgets import (QApplication, QDialog, QFormLayout,
                              QMessageBox, QLabel, QPushButton,
                              QLineEdit, QStyleFactory)
-from PyQt5.QtCore import pyqtSlot
+from PyQt5.QtCore import pyqtSlot, pyqtSignal, QObject, QThread, Qt
 from PyQt5.QtGui import QIcon
 
 from typeloader2 import general, db_internal
 from typeloader2.authuser import user
-from typeloader2.typeloader_functions import perform_reference_update, update_curr_versions
+from typeloader2.typeloader_functions import perform_reference_updates, update_curr_versions
 from typeloader2.typeloader_core import update_reference
 from typeloader2.GUI_forms import ProceedButton
 
@@ -384,6 +385,188 @@ class LoginForm(QDialog):
             QMessageBox.warning(self, "Python module out of date!", msg)
 
 
+class ReferenceCheckThread(QThread):
+    """checks in the background whether any of the references need an update
+    """
+    checked = pyqtSignal(list, list)  # references to update, messages
+    failed = pyqtSignal(str)
+
+    def __init__(self, settings, log, parent=None):
+        super().__init__(parent)
+        self.settings = settings
+        self.log = log
+
+    def run(self):
+        try:
+            update_me, messages = check_update_needed(self.settings["reference_local_path"],
+                                                      self.settings["proxy"], self.log)
+        except Exception as E:
+            self.log.exception(E)
+            self.failed.emit(repr(E))
+            return
+        self.checked.emit(update_me, messages)
+
+
+class ReferenceUpdateThread(QThread):
+    """performs reference updates in the background
+    """
+    progress = pyqtSignal(str)
+    updated = pyqtSignal(dict, object)  # results per reference, result of the country list update
+    failed = pyqtSignal(str)
+
+    def __init__(self, update_me, settings, log, parent=None):
+        super().__init__(parent)
+        self.update_me = update_me
+        self.settings = settings
+        self.log = log
+
+    def run(self):
+        try:
+            results, country_result = run_reference_updates(self.update_me, self.settings["reference_local_path"],
+                                                            self.settings["blast_path"], self.settings, self.log,
+                                                            report_func=self.progress.emit)
+        except Exception as E:
+            self.log.exception(E)
+            self.failed.emit(repr(E))
+            return
+        self.updated.emit(results, country_result)
+
+
+class BackgroundReferenceUpdater(QObject):
+    """checks for reference updates after login without blocking the main window;
+    if a new reference version is found, the user is notified by a non-modal message
+    and the update runs in a background thread
+    """
+    def __init__(self, log, settings, parent):
+        super().__init__(parent)
+        self.log = log
+        self.settings = settings
+        self.mainwindow = parent
+        self.threads = []
+        self.notifications = []
+
+    def start(self):
+        """starts the reference check in the background
+        """
+        self.log.info("Checking for reference updates in the background...")
+        self.show_status("Checking for reference updates...")
+        thread = ReferenceCheckThread(self.settings, self.log, self)
+        thread.checked.connect(self.on_checked)
+        thread.failed.connect(self.on_check_failed)
+        self.threads.append(thread)
+        thread.start()
+
+    def show_status(self, msg):
+        """shows msg in the status bar of the main window
+        """
+        try:
+            self.mainwindow.statusBar().showMessage(msg)
+        except AttributeError:
+            pass
+
+    def notify(self, title, msg, icon=QMessageBox.Information, buttons=QMessageBox.Ok):
+        """shows a non-modal message box, returns it
+        """
+        box = QMessageBox(icon, title, msg, buttons, self.mainwindow)
+        box.setWindowModality(Qt.NonModal)
+        box.finished.connect(lambda _: self.notifications.remove(box))
+        self.notifications.append(box)
+        box.show()
+        return box
+
+    @pyqtSlot(list, list)
+    def on_checked(self, update_me, messages):
+        """catches the result of the reference check
+        """
+        if messages:
+            msg = "\n".join(messages)
+            msg += "\n\nKeeping old reference version(s) for now."
+            self.notify("Problem during reference check", msg)
+
+        if not update_me:
+            self.show_status("Reference data is up to date.")
+            return
+
+        targets = " and ".join(update_me)
+        self.show_status(f"Found new reference version for {targets}.")
+        msg = "Found new reference version for {}. Should I update now?\n".format(targets)
+        msg += "(This runs in the background, you can continue working meanwhile.)"
+        box = self.notify("New reference found", msg, QMessageBox.Question, QMessageBox.Yes | QMessageBox.No)
+        box.buttonClicked.connect(lambda button: self.on_reply(box.standardButton(button), update_me))
+
+    @pyqtSlot(str)
+    def on_check_failed(self, error):
+        """catches errors during the reference check
+        """
+        self.show_status("Could not check for reference updates.")
+        self.notify("Reference error", "Could not check for reference updates, probably due to a temporary "
+                                       f"connection hickup. Please restart TypeLoader to try again.\n\n{error}",
+                    QMessageBox.Warning)
+
+    def on_reply(self, reply, update_me):
+        """starts the reference update if the user agreed
+        """
+        if reply != QMessageBox.Yes:
+            self.log.info("User chose not to update the database.")
+            return
+        self.show_status(f"Updating reference data for {' and '.join(update_me)}...")
+        thread = ReferenceUpdateThread(update_me, self.settings, self.log, self)
+        thread.progress.connect(self.show_status)
+        thread.updated.connect(self.on_updated)
+        thread.failed.connect(self.on_update_failed)
+        self.threads.append(thread)
+        thread.start()
+
+    @pyqtSlot(dict, object)
+    def on_updated(self, results, country_result):
+        """catches the results of the reference update, passes them on to the user
+        """
+        msges = []
+        for db_name, (success, err_type, msg) in results.items():
+            if success:
+                msges.append(msg)
+            else:
+                self.notify(err_type, msg, QMessageBox.Warning)
+        if msges:
+            self.notify("Reference data updated", "\n\n".join(msges))
+
+        update_curr_versions(self.settings, self.log)
+        self.show_status("Reference update finished.")
+
+        if country_result:
+            success, msg = country_result
+            if not success:
+                self.notify("Metadata reference update failed", msg, QMessageBox.Warning)
+
+    @pyqtSlot(str)
+    def on_update_failed(self, error):
+        """catches errors during the reference update
+        """
+        self.show_status("Reference update failed.")
+        self.notify("Reference update failed", "Could not update the reference data. "
+                                               f"We'll continue to use the old files for now.\n\n{error}",
+                    QMessageBox.Warning)
+
+    def wait(self):
+        """waits for all running background threads (e.g., before closing TypeLoader),
+        showing a message meanwhile
+        """
+        running = [thread for thread in self.threads if thread.isRunning()]
+        if not running:
+            return
+        self.log.info("Waiting for background reference update to finish...")
+        self.show_status("Waiting for the reference update to finish...")
+        box = QMessageBox(QMessageBox.Information, "Please wait",
+                          "TypeLoader will close as soon as the reference update running in the background "
+                          "has finished.", QMessageBox.NoButton, self.mainwindow)
+        box.setWindowModality(Qt.ApplicationModal)
+        box.show()
+        for thread in running:
+            while not thread.wait(100):  # keep the GUI responsive while waiting
+                QApplication.processEvents()
+        box.close()
+
+
 # ===========================================================
 # functions:
 
@@ -526,6 +709,24 @@ def get_settings(user, log, cf=None):
         with open(user_cf_file, "w") as g:
             cf.write(g)
 
+    if "parse_workers" not in settings_dic:
+        settings_dic["parse_workers"] = "0"
+        cf.set("Pref", "parse_workers", "0")
+        with open(user_cf_file, "w") as g:
+            cf.write(g)
+
+    if "blast_output" not in settings_dic:
+        settings_dic["blast_output"] = "xml"
+        cf.set("Pref", "blast_output", "xml")
+        with open(user_cf_file, "w") as g:
+            cf.write(g)
+
+    if "closest_allele_engine" not in settings_dic:
+        settings_dic["closest_allele_engine"] = "blast"
+        cf.set("Pref", "closest_allele_engine", "blast")
+        with open(user_cf_file, "w") as g:
+            cf.write(g)
+
     settings_dic["reference_local_path"] = os.path.join(settings_dic["root_path"],
                                                         settings_dic["general_dir"],
                                                         settings_dic["reference_dir"])
@@ -596,9 +797,10 @@ def handle_reference_update(update_me, reference_local_path, blast_path, parent,
     """
     msges = []
     updated = []
+    results, country_result = run_reference_updates(update_me, reference_local_path, blast_path, settings, log)
+
     for db_name in update_me:
-        success, err_type, msg = perform_reference_update(db_name, reference_local_path, blast_path,
-                                                          settings["proxy"], log)
+        success, err_type, msg = results[db_name]
         if not success:
             if parent:
                 QMessageBox.warning(parent, err_type, msg)
@@ -612,9 +814,8 @@ def handle_reference_update(update_me, reference_local_path, blast_path, parent,
 
     update_curr_versions(settings, log)
 
-    # also update list of countries:
-    if update_me:
-        success, msg = update_reference.update_country_data(reference_local_path, settings["proxy"], log)
+    if country_result:
+        success, msg = country_result
         if not success:
             if parent:
                 QMessageBox.warning(parent, "Metadata reference update failed", msg)
@@ -622,6 +823,27 @@ def handle_reference_update(update_me, reference_local_path, blast_path, parent,
     return updated
 
 
+def run_reference_updates(update_me, reference_local_path, blast_path, settings, log, report_func=None):
+    """updates all references given in update_me concurrently, plus the list of countries
+
+    :param report_func: called with the combined download progress (as text)
+    :return: dict of format {db_name: (success, error_type, message)},
+             result of the country list update as (success, message) (None if update_me is empty)
+    """
+    country_result = None
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        # also update list of countries (in parallel to the reference updates):
+        country_update = None
+        if update_me:
+            country_update = executor.submit(update_reference.update_country_data, reference_local_path,
+                                             settings["proxy"], log)
+        results = perform_reference_updates(update_me, reference_local_path, blast_path, settings["proxy"], log,
+                                            workers=settings.get("parse_workers", 1), report_func=report_func)
+    if country_update:
+        country_result = country_update.result()
+    return results, country_result
+
+
 def check_update_needed(reference_local_path, proxy, log, skip_if_updated_today=True):
     """check whether any of the references need to be updated (use MD5 check on .dat files)
 
@@ -633,9 +855,12 @@ def check_update_needed(reference_local_path, proxy, log, skip_if_updated_today=
 
     update_me = []
     messages = []
-    for db_name in db_list:
-        new_version_found, msg = update_reference.check_database(db_name, reference_local_path, proxy, log,
-                                                                 skip_if_updated_today=skip_if_updated_today)
+    with ThreadPoolExecutor(max_workers=len(db_list)) as executor:  # check all databases in parallel
+        futures = [executor.submit(update_reference.check_database, db_name, reference_local_path, proxy, log,
+                                   skip_if_updated_today=skip_if_updated_today)
+                   for db_name in db_list]
+    for db_name, future in zip(db_list, futures):
+        new_version_found, msg = future.result()
         if new_version_found:
             update_me.append(db_name.upper())
         else:
@@ -645,41 +870,6 @@ def check_update_needed(reference_local_path, proxy, log, skip_if_updated_today=
     return update_me, messages
 
 
-def check_for_reference_updates(log, settings, parent):
-    """checks whether either of the references need an update
-    (checks MD5 checksum of the .dat files against the reference repo on GitHub),
-    if yes, offers the user to update these references
-
-    :param log: logger instance
-    :param settings: user settings
-    :param parent: parent widget from where this function is called
-    :return: nothing
-    """
-    blast_path = settings["blast_path"]
-    reference_local_path = settings["reference_local_path"]
-    proxy = settings["proxy"]
-
-    update_me, messages = check_update_needed(reference_local_path, proxy, log)
-
-    if update_me:
-        targets = " and ".join(update_me)
-        msg = "Found new reference version for {}. Should I update now?\n".format(targets)
-        msg += "(This should take about a minute or so, please wait after clicking Yes.)"
-        reply = QMessageBox.question(parent, "New reference found", msg,
-                                     QMessageBox.Yes | QMessageBox.No, QMessageBox.Yes)
-
-        if reply == QMessageBox.No:
-            log.info("User chose not to update the database.")
-            return
-
-    if messages:
-        msg = "\n".join(messages)
-        msg += "\n\nKeeping old reference version(s) for now."
-        QMessageBox.information(parent, "Problem during reference check", msg)
-
-    handle_reference_update(update_me, reference_local_path, blast_path, parent, settings, log)
-
-
 def startup(user, curr_time, log):
     """performs startup actions 
     (between 'login accepted' and 'main window start')
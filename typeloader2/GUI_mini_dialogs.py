@@ -209,7 +209,8 @@ class ResetReferenceDialog(QDialog):
 
         success, err_type, msg = perform_reference_update(db_name, reference_local_path, blast_path,
                                                           self.settings["proxy"], self.log,
-                                                          version=version)
+                                                          version=version,
+                                                          workers=self.settings.get("parse_workers", 1))
         self.log.info(msg.replace("\n", " "))
         if success:
             self.updated = version
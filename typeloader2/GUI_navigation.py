@@ -19,6 +19,7 @@ from PyQt5.Qt import QModelIndex, QTreeView, pyqtSlot, pyqtSignal, \
 from PyQt5.QtGui import QIcon
 
 from typeloader2 import general, db_internal, typeloader_functions
+from typeloader2.typeloader_core import result_cache
 from typeloader2.GUI_forms_new_allele import NewAlleleForm
 from typeloader2.GUI_mini_dialogs import ResetReferenceDialog
 
@@ -574,7 +575,10 @@ class Navigation(QWidget):
                                                                                                    project))
         sample_dir = os.path.join(self.settings["projects_dir"], project, sample)
         if files:
-            for myfile in files[0]:
+            sample_files = list(files[0])
+            if sample_files[2]:  # stored annotation of the blast_xml file
+                sample_files.append(os.path.basename(result_cache.get_sample_annotation_file(sample_files[2])))
+            for myfile in sample_files:
                 if myfile:
                     self.log.debug("\tDeleting {}...".format(myfile))
                     try:
@@ -230,6 +230,15 @@ class SettingTab(QTabWidget):
                       "keep_recovery": {"section": "Pref",
                                         "lbl_text": "Days to store recovery data",
                                         "hint": "This user account's logfiles and internal database copies older than this many days will be deleted during any session start."},
+                      "parse_workers": {"section": "Pref",
+                                        "lbl_text": "Processes for reference updates & IPD files",
+                                        "hint": "Number of processes used to parse new reference files and to create IPD files (0 = use all available cores)."},
+                      "blast_output": {"section": "Pref",
+                                       "lbl_text": "BLAST output format",
+                                       "hint": "Format of the BLAST results stored for new alleles: 'xml' (complete BLAST XML) or 'compact' (much smaller table of the alignments)."},
+                      "closest_allele_engine": {"section": "Pref",
+                                                "lbl_text": "Closest allele search",
+                                                "hint": "How the closest known allele of new sequences is found: 'blast' (BLAST) or 'kmer' (faster built-in k-mer search; BLAST is used if it finds nothing)."},
 
                       "root_path": {"section": "Paths",
                                     "lbl_text": "TypeLoader Data Location",
@@ -441,6 +450,28 @@ class UserSettingsDialog(QDialog):
                                     "The ENA timeout threshold must be a number of seconds!")
                 return False
 
+        if field == "parse_workers":
+            pattern = "[^0-9]+"
+            if re.search(pattern, value) or not value:
+                QMessageBox.warning(self,
+                                    "Number of processes rejected",
+                                    "The number of processes for reference updates & IPD files must be a number (0 = all cores)!")
+                return False
+
+        if field == "blast_output":
+            if value not in ["xml", "compact"]:
+                QMessageBox.warning(self,
+                                    "BLAST output format rejected",
+                                    "The BLAST output format must be either 'xml' or 'compact'!")
+                return False
+
+        if field == "closest_allele_engine":
+            if value not in ["blast", "kmer"]:
+                QMessageBox.warning(self,
+                                    "Closest allele search rejected",
+                                    "The closest allele search must be either 'blast' or 'kmer'!")
+                return False
+
         if field == "fav_provenances":
             values = value.split("|")
             ok, msg, _ = typeloader_functions.check_countries_ok(values, self.settings, self.log)
@@ -270,6 +270,8 @@ def move_rename_file(old_path, new_dir, new_name):
     """
     if old_path.endswith(".blast.xml"):
         ext = ".blast.xml"
+    elif old_path.endswith(".blast.tsv"):
+        ext = ".blast.tsv"
     else:
         ext = os.path.splitext(old_path)[-1]
     new_path = os.path.join(new_dir, new_name + ext)
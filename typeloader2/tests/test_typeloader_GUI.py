@@ -8,22 +8,28 @@ unit tests for typeloader_GUI
 @author: Bianca Schoene
 '''
 import gzip
+import hashlib
+import threading
 import unittest
 from unittest.mock import patch
 import os, sys, re, time, platform, datetime, csv
 import difflib  # compare strings
 import shutil
+import pickle
+import subprocess
 import copy
 from pathlib import Path
+from types import SimpleNamespace
 from random import randint
 from configparser import ConfigParser
+from http.server import HTTPServer, BaseHTTPRequestHandler
 
 mypath_inner = Path(__file__).parent.parent
 mypath = mypath_inner.parent
 
 from typeloader2 import general, db_internal, GUI_login
 from xml.etree import ElementTree
-from collections import namedtuple
+from collections import namedtuple, defaultdict
 
 # no .pyw import possible in linux
 # deletion in Test_Clean_Stuff
@@ -31,7 +37,9 @@ shutil.copyfile(mypath_inner / "typeloader_GUI.pyw", mypath_inner / "typeloader_
 
 from typeloader2 import typeloader_GUI
 from typeloader2.typeloader_core import errors, EMBLfunctions as EF, make_imgt_files as MIF, backend_make_ena as BME, \
-    imgt_text_generator as ITG, closestallele as CA, getAlleleSeqsAndBlast as GASB
+    imgt_text_generator as ITG, closestallele as CA, getAlleleSeqsAndBlast as GASB, hla_embl_parser as HEP, \
+    reference_index as RI, update_reference as UR, kmer_search as KS, result_cache as RC, coordinates as COO, \
+    reference_shards as RS, imgtTransform as IT, reference_cache as REFC
 from typeloader2 import GUI_forms_new_project as PROJECT
 from typeloader2 import GUI_forms_new_allele as ALLELE
 from typeloader2 import GUI_forms_new_allele_bulk as BULK
@@ -1952,6 +1960,21 @@ class TestMakeIMGTFilesWith5PrimeOverhang(unittest.TestCase):
         diff_string = imgt_data[cell_line].split("CC")[1].split("XX")[0].strip()
         self.assertEqual(diff_string, self.diff_string)
 
+    def test_parallel_same_as_serial(self):
+        """test that creating the IPD texts with several processes gives the same texts as creating them serially
+        """
+        samples = [(self.sample_id_int, self.local_name, f"DKMS90000{i}") for i in range(1, 4)]
+        results = []
+        for workers in ["1", "3"]:
+            settings = dict(curr_settings)
+            settings["parse_workers"] = workers
+            imgt_data, _, _ = MIF.make_imgt_data(self.project_dir, samples, self.file_dic, self.allele_dic,
+                                                 self.ENA_id_map, self.ENA_gene_map, self.pretypings,
+                                                 settings, log)
+            results.append(imgt_data)
+        self.assertEqual(sorted(results[0].keys()), ["DKMS900001", "DKMS900002", "DKMS900003"])
+        self.assertEqual(results[0], results[1])
+
 
 class Test_EMBL_functions(unittest.TestCase):
     """
@@ -3348,6 +3371,1514 @@ class TestHomozygousXML(unittest.TestCase):
         self.assertEqual(len(diff_ena_files["deleted_sings"]), 0)
 
 
+class TestReferenceIndex(unittest.TestCase):
+    """test whether reading single alleles via the reference index gives the same results as parsing the whole
+    .dat file
+    """
+
+    @classmethod
+    def setUpClass(self):
+        if skip_other_tests:
+            self.skipTest(self, "Skipping TestReferenceIndex because skip_other_tests is set to True")
+        else:
+            self.reference_local_path = os.path.join(curr_settings["root_path"],
+                                                     curr_settings["general_dir"],
+                                                     curr_settings["reference_dir"])
+            self.dat_file = os.path.join(self.reference_local_path, curr_settings["kir_dat"])
+            self.target = "KIR"
+
+    @classmethod
+    def tearDownClass(self):
+        pass
+
+    def test_index_matches_full_parse(self):
+        """test that indexed alleles are identical to fully parsed alleles
+        """
+        all_alleles, _ = HEP.read_dat_file(self.dat_file, self.target, log)
+        names = list(all_alleles.keys())[::50]
+        indexed_alleles = RI.read_alleles(self.dat_file, self.target, names, log)
+        self.assertTrue(os.path.isfile(RI.get_index_file(self.dat_file)))
+        self.assertEqual(sorted(indexed_alleles.keys()), sorted(names))
+        for name in names:
+            for attribute in ["ID", "locus", "seq", "exonpos_dic", "intronpos_dic", "utrpos_dic",
+                              "pseudo_exon_dic", "exon_num_dic", "intron_num_dic"]:
+                self.assertEqual(getattr(indexed_alleles[name], attribute), getattr(all_alleles[name], attribute))
+
+    def test_fasta_index(self):
+        """test that sequences read via the fasta index are identical to those of the parsed fasta file
+        """
+        from Bio import SeqIO
+        fasta_file = os.path.join(self.reference_local_path, curr_settings["parsed_kir"])
+        records = list(SeqIO.parse(fasta_file, "fasta"))
+        for record in records[::20]:
+            self.assertEqual(RI.read_reference_sequence(fasta_file, record.id, log), record.seq)
+        self.assertTrue(os.path.isfile(RI.get_fasta_index_file(fasta_file)))
+        self.assertRaises(KeyError, RI.read_reference_sequence, fasta_file, "KIR2DL1*unknown", log)
+
+
+class RangeRequestHandler(BaseHTTPRequestHandler):
+    """minimal stand-in for a download server supporting Range & If-Range requests;
+    serves self.server.data with ETag self.server.etag
+    """
+    def do_GET(self):
+        data = self.server.data
+        start = 0
+        range_header = self.headers.get("Range")
+        self.server.received_ranges.append(range_header)
+        if range_header and self.headers.get("If-Range") == self.server.etag:
+            start = int(range_header.split("=")[1].split("-")[0])
+        if start:
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{len(data) - 1}/{len(data)}")
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(data) - start))
+        self.send_header("ETag", self.server.etag)
+        self.end_headers()
+        self.wfile.write(data[start:])
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestDownloadFile(unittest.TestCase):
+    """
+    test chunked downloading of reference files (with resuming) against a local HTTP server
+    """
+
+    @classmethod
+    def setUpClass(self):
+        if skip_other_tests:
+            self.skipTest(self, "Skipping TestDownloadFile because skip_other_tests is set to True")
+        else:
+            self.server = HTTPServer(("127.0.0.1", 0), RangeRequestHandler)
+            self.server.data = b"".join(f"line {i}\n".encode() for i in range(100000))
+            self.server.etag = '"release1"'
+            self.server.received_ranges = []
+            threading.Thread(target=self.server.serve_forever, daemon=True).start()
+            self.url = f"http://127.0.0.1:{self.server.server_port}/hla.dat"
+            self.local_file = os.path.join(curr_settings["temp_dir"], "download_test.dat")
+            self.md5 = hashlib.md5(self.server.data).hexdigest()
+
+    @classmethod
+    def tearDownClass(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if os.path.exists(self.local_file):
+            os.remove(self.local_file)
+
+    def setUp(self):
+        self.server.received_ranges.clear()
+
+    def test_download(self):
+        """test that the file is downloaded completely in chunks, with correct MD5 checksum and progress reports
+        """
+        progress = []
+        md5 = UR.download_file(self.url, self.local_file, None, 10, log,
+                               progress_callback=lambda done, total, speed: progress.append((done, total)),
+                               chunk_size=64 * 1024)
+        self.assertEqual(md5, self.md5)
+        with open(self.local_file, "rb") as f:
+            self.assertEqual(f.read(), self.server.data)
+        self.assertGreater(len(progress), 1)
+        self.assertEqual(progress[-1], (len(self.server.data), len(self.server.data)))
+        self.assertFalse(os.path.exists(self.local_file + ".part"))
+
+    def test_resume(self):
+        """test that a partial download is resumed via Range request
+        """
+        with open(self.local_file + ".part", "wb") as g:
+            g.write(self.server.data[:12345])
+        with open(self.local_file + ".part.info", "w") as g:
+            g.write(self.server.etag)
+        md5 = UR.download_file(self.url, self.local_file, None, 10, log)
+        self.assertEqual(md5, self.md5)
+        self.assertEqual(self.server.received_ranges, ["bytes=12345-"])
+
+    def test_resume_changed_file(self):
+        """test that a partial download of an outdated remote file is restarted from scratch
+        """
+        with open(self.local_file + ".part", "wb") as g:
+            g.write(b"outdated content")
+        with open(self.local_file + ".part.info", "w") as g:
+            g.write('"release0"')
+        md5 = UR.download_file(self.url, self.local_file, None, 10, log)
+        self.assertEqual(md5, self.md5)
+        with open(self.local_file, "rb") as f:
+            self.assertEqual(f.read(), self.server.data)
+
+
+class TestRestrictedDbCache(unittest.TestCase):
+    """test whether restricted reference databases are created from the reference index and cached
+    """
+
+    @classmethod
+    def setUpClass(self):
+        if skip_other_tests:
+            self.skipTest(self, "Skipping TestRestrictedDbCache because skip_other_tests is set to True")
+        else:
+            self.reference_local_path = os.path.join(curr_settings["root_path"],
+                                                     curr_settings["general_dir"],
+                                                     curr_settings["reference_dir"])
+            self.mydir = os.path.join(curr_settings["temp_dir"], "restricted_db_cache_test")
+            self.target_dir = os.path.join(self.mydir, "restricted_db")
+            self.cache_dir = os.path.join(self.mydir, "cache")
+            self.blast_path = os.path.dirname(curr_settings["blast_path"])
+            self.ref_alleles = ["HLA-B*35:03:01:01", "HLA-B*07:386N"]
+
+    @classmethod
+    def tearDownClass(self):
+        shutil.rmtree(self.mydir, ignore_errors=True)
+
+    def test_restricted_db_cached(self):
+        """test that the restricted files equal those of a full parse and that the second call uses the cache
+        """
+        success, msg = UR.make_restricted_db("hla", self.reference_local_path, self.ref_alleles,
+                                             self.target_dir, self.blast_path, log, cache_dir=self.cache_dir)
+        self.assertTrue(success, msg)
+        [cached_dir] = [os.path.join(self.cache_dir, mydir) for mydir in os.listdir(self.cache_dir)]
+        self.assertTrue(os.path.isfile(os.path.join(self.target_dir, "parsedhla.fa.nsq")))
+
+        full_dir = os.path.join(self.mydir, "full_parse")
+        HEP.make_parsed_files("hla", self.reference_local_path, log, restricted_to=self.ref_alleles,
+                              target_dir=full_dir)
+        for myfile in ["parsedhla.fa", "curr_version_hla.txt"]:
+            with open(os.path.join(full_dir, myfile)) as f1, open(os.path.join(self.target_dir, myfile)) as f2:
+                self.assertEqual(f1.read(), f2.read())
+
+        shutil.rmtree(self.target_dir)
+        built = os.path.getmtime(os.path.join(cached_dir, "parsedhla.fa.nsq"))
+        success, msg = UR.make_restricted_db("hla", self.reference_local_path, list(reversed(self.ref_alleles)),
+                                             self.target_dir, self.blast_path, log, cache_dir=self.cache_dir)
+        self.assertTrue(success, msg)
+        self.assertEqual(os.listdir(self.cache_dir), [os.path.basename(cached_dir)])
+        self.assertEqual(os.path.getmtime(os.path.join(cached_dir, "parsedhla.fa.nsq")), built)
+        self.assertTrue(os.path.isfile(os.path.join(self.target_dir, "parsedhla.dump")))
+
+
+class TestBatchBlast(unittest.TestCase):
+    """test whether BLASTing the files of a bulk upload in one batch gives the same results as BLASTing them
+    one by one
+    """
+
+    @classmethod
+    def setUpClass(self):
+        if skip_other_tests:
+            self.skipTest(self, "Skipping TestBatchBlast because skip_other_tests is set to True")
+        else:
+            self.bulk_file = os.path.join(curr_settings["login_dir"], "data_unittest", "bulk", "bulk_upload.csv")
+            self.mydir = os.path.join(curr_settings["temp_dir"], "batch_blast_test")
+            os.makedirs(self.mydir, exist_ok=True)
+            self.settings = dict(curr_settings)
+            self.settings["temp_dir"] = self.mydir
+
+    @classmethod
+    def tearDownClass(self):
+        shutil.rmtree(self.mydir, ignore_errors=True)
+
+    def test_batch_equals_single(self):
+        """test that each file gets its own BLAST result with the same hits as a single BLAST run
+        """
+        from Bio.Blast import NCBIXML
+        alleles, _, _ = typeloader_functions.parse_bulk_csv(self.bulk_file, self.settings, log)
+        results = typeloader_functions.batch_blast_bulk_alleles(alleles, self.settings, log)
+        self.assertEqual(sorted(results), sorted(allele[0] for allele in alleles))
+
+        for allele in alleles:
+            batch_xml_file = results[allele[0]]
+            with open(batch_xml_file) as f:
+                batch_hits = [[alignment.hit_id for alignment in record.alignments] for record in NCBIXML.parse(f)]
+            single_file = typeloader_functions.get_temp_raw_file(allele[3], "FASTA", self.settings)
+            single_file = single_file.replace(".fa", "_single.fa")
+            shutil.copyfile(allele[3], single_file)
+            (header, _) = next(EF.fasta_generator(single_file))
+            (seq_name, header_data) = GASB.parse_fasta_header(header)
+            target_family = GASB.get_target_family(seq_name, header_data, self.settings)
+            (parsed_fasta, _, _) = GASB.get_reference_files(target_family, self.settings)
+            shard_dbs = RS.get_shard_dbs(parsed_fasta, header_data, log)
+            database = shard_dbs[0] if len(shard_dbs) == 1 else parsed_fasta  # as chosen for the batch
+            single_xml_file = GASB.blastSequences(single_file, database, self.settings, log)
+            with open(single_xml_file) as f:
+                single_hits = [[alignment.hit_id for alignment in record.alignments] for record in NCBIXML.parse(f)]
+            self.assertEqual(batch_hits, single_hits)
+
+
+class TestCompactBlastOutput(unittest.TestCase):
+    """test whether the compact BLAST output gives the same closest allele results as BLAST XML output
+    """
+
+    @classmethod
+    def setUpClass(self):
+        if skip_other_tests:
+            self.skipTest(self, "Skipping TestCompactBlastOutput because skip_other_tests is set to True")
+        else:
+            self.bulk_file = os.path.join(curr_settings["login_dir"], "data_unittest", "bulk", "bulk_upload.csv")
+            self.mydir = os.path.join(curr_settings["temp_dir"], "compact_blast_test")
+            os.makedirs(self.mydir, exist_ok=True)
+            self.settings = dict(curr_settings)
+            self.settings["temp_dir"] = self.mydir
+
+    @classmethod
+    def tearDownClass(self):
+        shutil.rmtree(self.mydir, ignore_errors=True)
+
+    def test_same_closest_alleles(self):
+        """test that both output formats give the same closest allele items, the compact one using less space
+        """
+        alleles, _, _ = typeloader_functions.parse_bulk_csv(self.bulk_file, self.settings, log)
+        for allele in alleles:
+            fasta_file = typeloader_functions.get_temp_raw_file(allele[3], "FASTA", self.settings)
+            shutil.copyfile(allele[3], fasta_file)
+            (header, _) = next(EF.fasta_generator(fasta_file))
+            (seq_name, header_data) = GASB.parse_fasta_header(header)
+            target_family = GASB.get_target_family(seq_name, header_data, self.settings)
+            (parsed_fasta, _, _) = GASB.get_reference_files(target_family, self.settings)
+
+            self.settings["blast_output"] = "xml"
+            xml_file = GASB.blastSequences(fasta_file, parsed_fasta, self.settings, log)
+            self.settings["blast_output"] = "compact"
+            table_file = GASB.blastSequences(fasta_file, parsed_fasta, self.settings, log)
+            self.assertTrue(table_file.endswith(CA.BLAST_TABLE_EXT))
+            self.assertLess(os.path.getsize(table_file), os.path.getsize(xml_file))
+            self.assertEqual(CA.get_closest_known_alleles(table_file, target_family, self.settings, log),
+                             CA.get_closest_known_alleles(xml_file, target_family, self.settings, log))
+
+
+class TestExactMatch(unittest.TestCase):
+    """test whether sequences identical to or contained in a reference allele are recognized without BLAST
+    """
+
+    @classmethod
+    def setUpClass(self):
+        if skip_other_tests:
+            self.skipTest(self, "Skipping TestExactMatch because skip_other_tests is set to True")
+        else:
+            from Bio import SeqIO
+            self.reference_local_path = os.path.join(curr_settings["root_path"],
+                                                     curr_settings["general_dir"],
+                                                     curr_settings["reference_dir"])
+            self.fasta_file = os.path.join(self.reference_local_path, curr_settings["parsed_kir"])
+            self.records = list(SeqIO.parse(self.fasta_file, "fasta"))[::50]
+            self.mydir = os.path.join(curr_settings["temp_dir"], "exact_match_test")
+            os.makedirs(self.mydir, exist_ok=True)
+            self.settings = dict(curr_settings)
+
+    @classmethod
+    def tearDownClass(self):
+        shutil.rmtree(self.mydir, ignore_errors=True)
+
+    def test_find_reference_match(self):
+        """test that identical and contained sequences are found at the right position, others are not
+        """
+        for record in self.records:
+            seq = str(record.seq)
+            (name, start) = RI.find_reference_match(self.fasta_file, seq, log)
+            self.assertEqual(str(RI.read_reference_sequence(self.fasta_file, name, log)), seq)
+            self.assertEqual(start, 1)
+            self.assertTrue(os.path.isfile(RI.get_sequence_index_file(self.fasta_file)))
+
+            (name, start) = RI.find_reference_match(self.fasta_file, seq[100:-100].lower(), log)
+            self.assertIn(seq[100:-100], str(RI.read_reference_sequence(self.fasta_file, name, log)))
+            self.assertEqual(str(RI.read_reference_sequence(self.fasta_file, name, log))[start - 1:start + 99],
+                             seq[100:200])
+
+            mutated = seq[:1000] + ("A" if seq[1000] != "A" else "C") + seq[1001:]
+            match = RI.find_reference_match(self.fasta_file, mutated, log)
+            if match:  # another allele may differ at exactly this position
+                self.assertIn(mutated, str(RI.read_reference_sequence(self.fasta_file, match[0], log)))
+
+    def test_synthesized_blast_output(self):
+        """test that the BLAST output written for exact matches gives exact closest allele matches in both formats
+        """
+        record = self.records[0]
+        fasta_file = os.path.join(self.mydir, "exact_match.fa")
+        with open(fasta_file, "w") as g:
+            g.write(f">exact_match\n{str(record.seq)[100:-100]}\n")
+
+        results = {}
+        for blast_output in ["xml", "compact"]:
+            self.settings["blast_output"] = blast_output
+            output_file = GASB.blast_exact_matches(fasta_file, self.fasta_file, self.settings, log)
+            self.assertTrue(os.path.isfile(output_file))
+            results[blast_output] = CA.get_closest_known_alleles(output_file, "KIR", self.settings, log)
+            closest_allele = results[blast_output]["exact_match"]
+            self.assertTrue(closest_allele["exactMatch"])
+            self.assertEqual(closest_allele["hitStart"], RI.find_reference_match(self.fasta_file,
+                                                                                 str(record.seq)[100:-100], log)[1])
+        self.assertEqual(results["xml"], results["compact"])
+
+
+class TestKmerEngine(unittest.TestCase):
+    """test whether the k-mer engine finds the same closest alleles as BLAST for the bundled sample files
+    (with a novel SNP added, so the alignment is needed), and compare the runtimes
+    """
+
+    @classmethod
+    def setUpClass(self):
+        if skip_other_tests:
+            self.skipTest(self, "Skipping TestKmerEngine because skip_other_tests is set to True")
+        else:
+            self.mydir = os.path.join(curr_settings["temp_dir"], "kmer_engine_test")
+            os.makedirs(self.mydir, exist_ok=True)
+            self.settings = dict(curr_settings)
+            self.sample_files = [os.path.join(mypath_inner, "sample_files", myfile)
+                                 for myfile in sorted(os.listdir(os.path.join(mypath_inner, "sample_files")))
+                                 if myfile.endswith(".fa")]
+
+    @classmethod
+    def tearDownClass(self):
+        shutil.rmtree(self.mydir, ignore_errors=True)
+
+    def test_same_closest_alleles_as_blast(self):
+        """test that both engines find closest alleles with the same differences
+        """
+        times = {"blast": 0, "kmer": 0}
+        for sample_file in self.sample_files:
+            (header, seq) = next(EF.fasta_generator(sample_file))
+            fasta_file = os.path.join(self.mydir, os.path.basename(sample_file))
+            with open(fasta_file, "w") as g:
+                g.write(f">{header}\n{seq[:1000]}{'A' if seq[1000] != 'A' else 'C'}{seq[1001:]}\n")
+            (seq_name, header_data) = GASB.parse_fasta_header(header)
+            target_family = GASB.get_target_family(seq_name, header_data, self.settings)
+            (parsed_fasta, _, _) = GASB.get_reference_files(target_family, self.settings)
+
+            start = time.time()
+            blast_file = GASB.blastSequences(fasta_file, parsed_fasta, self.settings, log)
+            times["blast"] += time.time() - start
+            start = time.time()
+            hits = KS.search_closest_alleles(fasta_file, parsed_fasta, log)
+            kmer_file = GASB.write_blast_output(fasta_file, parsed_fasta, hits, self.settings, log)
+            times["kmer"] += time.time() - start
+
+            blast_result = CA.get_closest_known_alleles(blast_file, target_family, self.settings, log)
+            kmer_result = CA.get_closest_known_alleles(kmer_file, target_family, self.settings, log)
+            for (query_id, closest_allele) in blast_result.items():
+                log.info(f"{query_id}: BLAST => {closest_allele['name']}, k-mers => {kmer_result[query_id]['name']}")
+                for key in ["differences", "exactMatch", "hitStart", "alignLength", "queryLength"]:
+                    self.assertEqual(kmer_result[query_id][key], closest_allele[key])
+        log.info(f"Runtime for {len(self.sample_files)} sample files: BLAST {times['blast']:.2f}s, "
+                 f"k-mer engine {times['kmer']:.2f}s (incl. creating its index)")
+
+
+class TestResultCache(unittest.TestCase):
+    """test the persistent cache of closest allele results & annotations
+    """
+
+    @classmethod
+    def setUpClass(self):
+        if skip_other_tests:
+            self.skipTest(self, "Skipping TestResultCache because skip_other_tests is set to True")
+        else:
+            self.mydir = os.path.join(curr_settings["temp_dir"], "result_cache_test")
+            os.makedirs(self.mydir, exist_ok=True)
+            self.settings = dict(curr_settings)
+            self.settings["login_dir"] = self.mydir
+            self.cache_dir = RC.get_cache_dir(self.settings)
+
+    @classmethod
+    def tearDownClass(self):
+        shutil.rmtree(self.mydir, ignore_errors=True)
+
+    def test_annotation_cached(self):
+        """test that processing the same sequence again uses the cache and gives the same annotation
+        """
+        sample_file = os.path.join(mypath_inner, "sample_files", "KIR2DL1_0020101.fa")
+        (header, seq) = next(EF.fasta_generator(sample_file))
+        fasta_file = os.path.join(self.mydir, "cached.fa")
+        with open(fasta_file, "w") as g:
+            g.write(f">{header}\n{seq[:1000]}{'A' if seq[1000] != 'A' else 'C'}{seq[1001:]}\n")
+        (parsed_fasta, alleles_file, _) = GASB.get_reference_files("KIR", self.settings)
+
+        blast_file = GASB.blastSequences(fasta_file, parsed_fasta, self.settings, log)
+        RC.store_hits(blast_file, fasta_file, parsed_fasta, "KIR", self.settings, log)
+        annotations = COO.getCoordinates(blast_file, alleles_file, "KIR", self.settings, log)
+        self.assertEqual(len([myfile for myfile in os.listdir(self.cache_dir) if myfile.startswith("hit_")]), 1)
+        self.assertEqual(len([myfile for myfile in os.listdir(self.cache_dir)
+                              if myfile.startswith("annotation_")]), 1)
+
+        os.remove(blast_file)
+        with patch.object(GASB, "blastSequences") as mock_blast:  # BLAST must not be used again
+            cached_file = GASB.search_without_blast(fasta_file, parsed_fasta, "KIR", self.settings, log)
+            mock_blast.assert_not_called()
+        with patch.object(COO, "get_closest_known_alleles") as mock_closest_alleles:
+            self.assertEqual(COO.getCoordinates(cached_file, alleles_file, "KIR", self.settings, log), annotations)
+            mock_closest_alleles.assert_not_called()
+
+    def test_sample_annotation_stored(self):
+        """test that the annotation stored next to the BLAST output is reused until its inputs change
+        """
+        settings = dict(self.settings)
+        settings["login_dir"] = None  # without result cache
+        sample_file = os.path.join(mypath_inner, "sample_files", "KIR2DL1_0020101.fa")
+        fasta_file = os.path.join(self.mydir, "stored.fa")
+        shutil.copy(sample_file, fasta_file)
+        (parsed_fasta, alleles_file, _) = GASB.get_reference_files("KIR", settings)
+        blast_file = GASB.blastSequences(fasta_file, parsed_fasta, settings, log)
+        annotations = COO.getCoordinates(blast_file, alleles_file, "KIR", settings, log)
+        self.assertTrue(os.path.isfile(RC.get_sample_annotation_file(blast_file)))
+
+        with patch.object(COO, "get_closest_known_alleles") as mock_closest_alleles:
+            self.assertEqual(COO.getCoordinates(blast_file, alleles_file, "KIR", settings, log), annotations)
+            mock_closest_alleles.assert_not_called()
+
+        with open(fasta_file, "a") as g:  # changed input => annotate again
+            g.write("\n")
+        with patch.object(COO, "get_closest_known_alleles",
+                          wraps=COO.get_closest_known_alleles) as mock_closest_alleles:
+            self.assertEqual(COO.getCoordinates(blast_file, alleles_file, "KIR", settings, log), annotations)
+            mock_closest_alleles.assert_called_once()
+
+    def test_eviction(self):
+        """test that old entries and the least recently used ones are removed
+        """
+        evict_dir = os.path.join(self.mydir, "evict")
+        os.makedirs(evict_dir, exist_ok=True)
+        now = time.time()
+        for (i, age_days) in enumerate([0, 1, 2, 400]):
+            path = os.path.join(evict_dir, f"hit_{i}.pickle")
+            with open(path, "wb") as g:
+                g.write(b"x" * 1000)
+            os.utime(path, (now - age_days * 86400, now - age_days * 86400))
+        RC.evict_results(evict_dir, log, max_age=180, max_bytes=2500)
+        self.assertEqual(sorted(os.listdir(evict_dir)), ["hit_0.pickle", "hit_1.pickle"])
+
+    def test_eviction_throttled(self):
+        """test that storing results only scans the cache once per eviction interval
+        """
+        throttle_dir = os.path.join(self.mydir, "throttle")
+        os.makedirs(throttle_dir, exist_ok=True)
+        with patch.object(RC, "evict_results") as mock_evict:
+            for _ in range(3):
+                RC.evict_results_throttled(throttle_dir, log)
+            mock_evict.assert_called_once()
+            marker = os.path.join(throttle_dir, RC.RESULT_CACHE_EVICT_MARKER)
+            os.utime(marker, (time.time() - RC.RESULT_CACHE_EVICT_INTERVAL - 1,) * 2)
+            RC.evict_results_throttled(throttle_dir, log)
+            self.assertEqual(mock_evict.call_count, 2)
+
+
+class TestStartRegionAlignment(unittest.TestCase):
+    """test whether aligning only the start region gives the same positions as a global alignment
+    of the complete sequences (as used by fix_incomplete_alignment before)
+    """
+
+    @classmethod
+    def setUpClass(self):
+        if skip_other_tests:
+            self.skipTest(self, "Skipping TestStartRegionAlignment because skip_other_tests is set to True")
+        else:
+            from Bio import SeqIO
+            fasta_file = os.path.join(curr_settings["root_path"], curr_settings["general_dir"],
+                                      curr_settings["reference_dir"], curr_settings["parsed_kir"])
+            self.ref_seq = str(next(SeqIO.parse(fasta_file, "fasta")).seq)[:2000]
+
+    @classmethod
+    def tearDownClass(self):
+        pass
+
+    def test_same_as_global_alignment(self):
+        """test missing bases, mismatches and InDels at the sequence start and a longer 5' UTR
+        """
+        ref_seq = self.ref_seq
+        queries = [ref_seq[10:],  # incomplete start
+                   ("A" if ref_seq[1] != "A" else "C") + ref_seq[1:],  # mismatch at the first base
+                   ref_seq[:2] + ref_seq[4:],  # deletion
+                   ref_seq[:3] + "GA" + ref_seq[3:],  # insertion
+                   "ACGTTGCA" + ref_seq]  # longer 5' UTR
+        for query_seq in queries:
+            hsp_query = query_seq[15:]
+            hsp_start = ref_seq.find(hsp_query[:50]) + 1
+            a = CA.make_global_alignment(ref_seq, query_seq, log)[0]
+            self.assertEqual(CA.align_start_region(ref_seq, query_seq, hsp_start, hsp_query, log),
+                             (a.aligned[0][0][0], a.aligned[1][0][0]))
+
+
+class Timer:
+    """sums up the run times of several implementations of the same function, for micro-benchmarks
+    """
+    def __init__(self):
+        self.times = {}
+
+    def run(self, name, func, *args, **kwargs):
+        """calls func, adds its run time to the times of name, returns its result
+        """
+        start = time.time()
+        result = func(*args, **kwargs)
+        self.times[name] = self.times.get(name, 0) + time.time() - start
+        return result
+
+    def log(self, description):
+        """logs the summed up run times of all implementations
+        """
+        log.info(f"{description}: " + ", ".join(f"{name} {secs:.4f}s" for (name, secs) in self.times.items()))
+
+
+def list_based_differences(hsp_query, hsp_subject, hsp_match):
+    """former list-based version of the differences found by closest_allele_items
+    """
+    deletion_positions = [pos + 1 for pos in range(len(hsp_query)) if hsp_query[pos] == "-"]
+    insertion_positions = [pos + 1 for pos in range(len(hsp_subject)) if hsp_subject[pos] == "-"]
+    mismatch_positions = [pos + 1 for pos in range(len(hsp_match)) if hsp_match[pos] == " "
+                          and (pos + 1) not in deletion_positions and (pos + 1) not in insertion_positions]
+    return {'deletionPositions': deletion_positions, 'insertionPositions': insertion_positions,
+            'mismatchPositions': mismatch_positions,
+            'mismatches': [(hsp_query[pos - 1], hsp_subject[pos - 1]) for pos in mismatch_positions],
+            'deletions': [hsp_subject[pos - 1] for pos in deletion_positions],
+            'insertions': [hsp_query[pos - 1] for pos in insertion_positions]}
+
+
+class TestClosestAlleleItems(unittest.TestCase):
+    """test the differences found by closestallele.closest_allele_items (micro-benchmark on divergent 15 kb
+    alignments, as for KIR genes)
+    """
+
+    @classmethod
+    def setUpClass(self):
+        if skip_other_tests:
+            self.skipTest(self, "Skipping TestClosestAlleleItems because skip_other_tests is set to True")
+        else:
+            import random
+            myrandom = random.Random(42)
+            self.alignments = []
+            for divergence in [0, 0.01, 0.05, 0.2]:
+                query, subject = [], []
+                for _ in range(15000):
+                    base = myrandom.choice("ACGT")
+                    other_base = myrandom.choice([other for other in "ACGT" if other != base])
+                    [(query_base, subject_base)] = myrandom.choices([(base, base), ("-", base), (base, "-"),
+                                                                      (base, other_base)],
+                                                                     [1 - divergence] + [divergence / 3] * 3)
+                    query.append(query_base)
+                    subject.append(subject_base)
+                match = ["|" if q == s else " " for (q, s) in zip(query, subject)]
+                self.alignments.append(("".join(query), "".join(subject), "".join(match)))
+
+    @classmethod
+    def tearDownClass(self):
+        pass
+
+    def test_differences(self):
+        """test that the differences are identical to those of the list-based implementation
+        """
+        timer = Timer()
+        for (hsp_query, hsp_subject, hsp_match) in self.alignments:
+            expected = timer.run("list-based", list_based_differences, hsp_query, hsp_subject, hsp_match)
+            result = timer.run("vectorised", CA.closest_allele_items, hsp_query, hsp_subject, hsp_match,
+                               "KIR2DL1*0010101", False, 1, len(hsp_query), len(hsp_query), 0)
+            self.assertEqual(result["differences"], expected)
+            self.assertEqual(result["exactMatch"], not hsp_match.count(" "))
+        timer.log(f"closest_allele_items on {len(self.alignments)} alignments of 15 kb")
+
+    def test_incomplete_alignment(self):
+        """test that a query aligned incompletely gets an unknown mismatch after the alignment
+        """
+        result = CA.closest_allele_items("AC-GTA", "ACTC-A", "||   |", "KIR2DL1*0010101", False, 1, 6, 10, 0)
+        self.assertEqual(result["differences"], {'deletionPositions': [3], 'insertionPositions': [5],
+                                                 'mismatchPositions': [4, 7], 'mismatches': [('G', 'C'), ('?', '?')],
+                                                 'deletions': ['T'], 'insertions': ['T']})
+        self.assertFalse(result["exactMatch"])
+
+
+class TestReferenceShards(unittest.TestCase):
+    """test the per-locus BLAST databases of the references
+    """
+
+    @classmethod
+    def setUpClass(self):
+        if skip_other_tests:
+            self.skipTest(self, "Skipping TestReferenceShards because skip_other_tests is set to True")
+        else:
+            self.mydir = os.path.join(curr_settings["temp_dir"], "reference_shards_test")
+            os.makedirs(self.mydir, exist_ok=True)
+            (parsed_fasta, _, _) = GASB.get_reference_files("KIR", curr_settings)
+            self.parsed_fasta = os.path.join(self.mydir, os.path.basename(parsed_fasta))
+            shutil.copyfile(parsed_fasta, self.parsed_fasta)
+            self.loci = {RS.get_locus(header.split()[0]) for (header, _) in EF.fasta_generator(self.parsed_fasta)}
+            self.shards_ok, _ = RS.make_shard_dbs(self.parsed_fasta, os.path.dirname(curr_settings["blast_path"]),
+                                                  log)
+
+    @classmethod
+    def tearDownClass(self):
+        shutil.rmtree(self.mydir, ignore_errors=True)
+
+    def test_shards_created(self):
+        """test that there is one BLAST database per locus, listed in the shard manifest
+        """
+        self.assertTrue(self.shards_ok)
+        shards = RS.load_shards(self.parsed_fasta, log)
+        self.assertEqual(set(shards), self.loci)
+        for shard_db in shards.values():
+            self.assertFalse(os.path.isfile(shard_db))  # the sequences are only kept in the database
+            self.assertTrue([myfile for myfile in os.listdir(self.mydir)
+                             if myfile.startswith(os.path.basename(shard_db) + ".")])
+
+    def test_find_locus(self):
+        """test that the locus is only taken from the fasta header, not guessed from the sequence name
+        """
+        self.assertEqual(RS.find_locus(defaultdict(str, locus="KIR2DL1"), self.loci), "KIR2DL1")
+        self.assertIsNone(RS.find_locus(defaultdict(str), self.loci))
+        self.assertIsNone(RS.find_locus(defaultdict(str, locus="KIR9DL9"), self.loci))
+        self.assertEqual(len(RS.get_shard_dbs(self.parsed_fasta, defaultdict(str, locus="KIR2DL1"), log)), 1)
+        self.assertEqual(RS.get_shard_dbs(self.parsed_fasta, defaultdict(str, locus="KIR9DL9"), log), [])
+        self.assertEqual(len(RS.get_shard_dbs(self.parsed_fasta, defaultdict(str), log)), len(self.loci))
+
+    def test_same_closest_allele(self):
+        """test that searching the shard of the locus or all shards finds the same closest allele
+        as searching the complete reference
+        """
+        sample_file = os.path.join(mypath_inner, "sample_files", "KIR2DL1_0020101.fa")
+        (header, seq) = next(EF.fasta_generator(sample_file))
+        fasta_file = os.path.join(self.mydir, "shard_query.fa")
+        with open(fasta_file, "w") as g:
+            g.write(f">{header}\n{seq[:1000]}{'A' if seq[1000] != 'A' else 'C'}{seq[1001:]}\n")
+
+        full_hits = CA.read_top_hits(GASB.blastSequences(fasta_file, self.parsed_fasta, curr_settings, log), "KIR",
+                                     curr_settings, log)
+        for shard_dbs in [RS.get_shard_dbs(self.parsed_fasta, defaultdict(str, locus="KIR2DL1"), log),
+                          RS.get_shard_dbs(self.parsed_fasta, defaultdict(str), log)]:
+            blast_file = GASB.blast_shards(fasta_file, self.parsed_fasta, shard_dbs, "KIR", curr_settings, log)
+            shard_hits = CA.read_top_hits(blast_file, "KIR", curr_settings, log)
+            self.assertEqual(shard_hits.keys(), full_hits.keys())
+            for (query_id, hit) in shard_hits.items():
+                self.assertEqual((hit.name, hit.hit_from, hit.qseq, hit.hseq),
+                                 (full_hits[query_id].name, full_hits[query_id].hit_from, full_hits[query_id].qseq,
+                                  full_hits[query_id].hseq))
+        self.assertFalse([myfile for myfile in os.listdir(self.mydir) if "_shard" in myfile])  # temporary files
+
+
+class TestShardUpdate(unittest.TestCase):
+    """test that reference updates never leave per-locus BLAST databases of the previous version in use
+    """
+
+    @classmethod
+    def setUpClass(self):
+        if skip_other_tests:
+            self.skipTest(self, "Skipping TestShardUpdate because skip_other_tests is set to True")
+        else:
+            self.mydir = os.path.join(curr_settings["temp_dir"], "shard_update_test")
+            self.ref_dir = os.path.join(self.mydir, "reference")
+            os.makedirs(self.ref_dir, exist_ok=True)
+            self.fa_file = os.path.join(self.ref_dir, "parsedKIR.fa")
+            reference_local_path = os.path.join(curr_settings["root_path"], curr_settings["general_dir"],
+                                                curr_settings["reference_dir"])
+            dat_file = os.path.join(reference_local_path, curr_settings["kir_dat"])
+
+            # use the first 3 records of each locus, to keep parsing fast:
+            records = defaultdict(list)  # locus => list of (offset, length)
+            for (offset, length, lines) in HEP.iter_raw_records(dat_file):
+                locus = RS.get_locus(HEP.get_record_name(lines, "KIR"))
+                if len(records[locus]) < 3:
+                    records[locus].append((offset, length))
+            self.loci = sorted(records)
+            self.removed_locus = self.loci[-1]
+            self.versions = {}
+            with open(dat_file, "rb") as f:
+                for (version, loci) in [("old", self.loci), ("new", self.loci[:-1])]:
+                    data = b""
+                    for locus in loci:
+                        for (offset, length) in records[locus]:
+                            f.seek(offset)
+                            data += f.read(length)
+                    self.versions[version] = data
+
+    @classmethod
+    def tearDownClass(self):
+        shutil.rmtree(self.mydir, ignore_errors=True)
+
+    def update(self, version):
+        """updates the KIR reference in self.ref_dir to the given version of the .dat file
+        """
+        def download_file(myurl, local_file, proxy, timeout, log, progress_callback=None):
+            with open(local_file, "wb") as g:
+                g.write(self.versions[version])
+            return hashlib.md5(self.versions[version]).hexdigest()
+
+        with patch.object(UR, "download_file", download_file):
+            success, msg = UR.update_database("kir", self.ref_dir, os.path.dirname(curr_settings["blast_path"]),
+                                              None, log)
+        self.assertTrue(success, msg)
+        self.assertEqual(os.listdir(os.path.join(self.ref_dir, "temp")), [])
+
+    def test_shard_update(self):
+        """test that shards of removed loci are deleted,
+        and that a failed shard build removes all shards instead of mixing old and new ones
+        """
+        self.update("old")
+        self.assertEqual(set(RS.load_shards(self.fa_file, log)), set(self.loci))
+
+        self.update("new")
+        shards = RS.load_shards(self.fa_file, log)
+        self.assertEqual(set(shards), set(self.loci[:-1]))
+        self.assertEqual(set(RS.get_shard_files(self.ref_dir, "parsedKIR.fa", self.loci)),
+                         {os.path.basename(shard_db) for shard_db in shards.values()})
+
+        calls = []
+
+        def run(cmd_list, **kwargs):  # the second shard cannot be created
+            calls.append(cmd_list)
+            if len(calls) == 2:
+                raise subprocess.CalledProcessError(1, cmd_list)
+            return subprocess.run(cmd_list, **kwargs)
+
+        volume_file = os.path.join(self.ref_dir, "parsedKIR.fa.00.nhr")  # not a shard, must be kept
+        with open(volume_file, "w") as g:
+            g.write("volume")
+        with patch.object(RS, "subprocess", SimpleNamespace(run=run, DEVNULL=subprocess.DEVNULL)):
+            self.update("old")
+        self.assertEqual(len(calls), 2)
+        self.assertFalse(os.path.isfile(RS.get_manifest_file(self.fa_file)))
+        self.assertEqual(RS.get_shard_files(self.ref_dir, "parsedKIR.fa", self.loci), {})
+        self.assertTrue(os.path.isfile(volume_file))
+        self.assertEqual(RS.get_shard_dbs(self.fa_file, defaultdict(str), log), [])
+
+
+class TestParallelParsing(unittest.TestCase):
+    """test that parsing a reference with several processes creates the same files as a serial run
+    """
+
+    @classmethod
+    def setUpClass(self):
+        if skip_other_tests:
+            self.skipTest(self, "Skipping TestParallelParsing because skip_other_tests is set to True")
+        else:
+            self.mydir = os.path.join(curr_settings["temp_dir"], "parallel_parsing_test")
+            self.target = "KIR"
+            reference_local_path = os.path.join(curr_settings["root_path"], curr_settings["general_dir"],
+                                                curr_settings["reference_dir"])
+            self.ref_dirs = {}
+            for workers in [1, 3]:
+                ref_dir = os.path.join(self.mydir, f"workers{workers}")
+                os.makedirs(ref_dir, exist_ok=True)
+                shutil.copyfile(os.path.join(reference_local_path, curr_settings["kir_dat"]),
+                                os.path.join(ref_dir, f"{self.target}.dat"))
+                self.ref_dirs[workers] = ref_dir
+
+    @classmethod
+    def tearDownClass(self):
+        shutil.rmtree(self.mydir, ignore_errors=True)
+
+    def assert_same_files(self, files1, files2):
+        """asserts that both lists of files exist and have identical content
+        """
+        for (myfile1, myfile2) in zip(files1, files2):
+            with open(myfile1, "rb") as f1, open(myfile2, "rb") as f2:
+                self.assertEqual(f1.read(), f2.read(), os.path.basename(myfile1))
+
+    def get_parsed_files(self, ref_dir, target_dir):
+        return [os.path.join(target_dir, f"parsed{self.target}.fa"),
+                os.path.join(target_dir, f"parsed{self.target}.dump"),
+                os.path.join(ref_dir, f"{self.target}_allelenames.dump")]
+
+    def test01_complete_reference(self):
+        """test that the complete parsed reference does not depend on the number of workers
+        """
+        for (workers, ref_dir) in self.ref_dirs.items():
+            HEP.make_parsed_files(self.target, ref_dir, log, workers=workers)
+        self.assert_same_files(*[self.get_parsed_files(ref_dir, ref_dir) for ref_dir in self.ref_dirs.values()])
+
+    def test02_restricted_reference(self):
+        """test that a restricted database does not depend on the number of workers
+        """
+        headers = [header for (header, _) in EF.fasta_generator(os.path.join(self.ref_dirs[1],
+                                                                              f"parsed{self.target}.fa"))]
+        restricted_to = [header.split()[0] for header in headers[::50]]
+        parsed_files = []
+        for (workers, ref_dir) in self.ref_dirs.items():
+            target_dir = os.path.join(ref_dir, "restricted")
+            HEP.make_parsed_files(self.target, ref_dir, log, restricted_to=restricted_to, target_dir=target_dir,
+                                  workers=workers)
+            parsed_files.append(self.get_parsed_files(ref_dir, target_dir))
+        self.assert_same_files(*parsed_files)
+        with open(parsed_files[0][0]) as f:
+            self.assertEqual(f.read().count(">"), len(restricted_to))
+
+
+class TestGeneModels(unittest.TestCase):
+    """test the gene model table created with the reference
+    """
+
+    @classmethod
+    def setUpClass(self):
+        if skip_other_tests:
+            self.skipTest(self, "Skipping TestGeneModels because skip_other_tests is set to True")
+        else:
+            self.mydir = os.path.join(curr_settings["temp_dir"], "gene_models_test")
+            self.target = "KIR"
+            reference_local_path = os.path.join(curr_settings["root_path"], curr_settings["general_dir"],
+                                                curr_settings["reference_dir"])
+            self.dat_files = []
+            for workers in [1, 2]:
+                ref_dir = os.path.join(self.mydir, f"workers{workers}")
+                os.makedirs(ref_dir, exist_ok=True)
+                dat_file = os.path.join(ref_dir, curr_settings["kir_dat"])
+                shutil.copyfile(os.path.join(reference_local_path, curr_settings["kir_dat"]), dat_file)
+                HEP.make_parsed_files(self.target, ref_dir, log, workers=workers)
+                self.dat_files.append(dat_file)
+
+    @classmethod
+    def tearDownClass(self):
+        shutil.rmtree(self.mydir, ignore_errors=True)
+
+    def test_gene_model_table(self):
+        """test that the gene model table is independent of the number of workers and listed in the index
+        """
+        (model_file1, model_file2) = [RI.get_gene_model_file(dat_file) for dat_file in self.dat_files]
+        with open(model_file1, "rb") as f1, open(model_file2, "rb") as f2:
+            self.assertEqual(f1.read(), f2.read())
+        index = RI.load_reference_index(self.dat_files[0], self.target, log)
+        self.assertEqual(set(index["gene_models"]), set(index["offsets"]))
+
+    def test_gene_models(self):
+        """test that gene models read from the table are identical to those created from the alleles
+        and give the same coordinates
+        """
+        all_alleles, _ = HEP.read_dat_file(self.dat_files[0], self.target, log)
+        for allele in list(all_alleles.values())[::25]:
+            gene_model = RI.read_gene_model(self.dat_files[0], self.target, allele, log)
+            expected = HEP.make_gene_model(allele)
+            self.assertEqual({key: value for (key, value) in gene_model.items() if key != "codons"}, expected)
+            self.assertEqual("".join(gene_model["codons"]), expected["cdsSequence"])
+            self.assertEqual(COO.getClosestAlleleCoordinates(allele, 10000, gene_model),
+                             COO.getClosestAlleleCoordinates(allele, 10000))
+
+
+def loop_based_coordinates(coordinates, differences, missing_bp):
+    """former loop-based version of the coordinate shift in calculateCoordinates
+    """
+    coordinates = list(coordinates)
+    myinsertions = [pos + missing_bp for pos in differences["insertionPositions"]]
+    mydeletions = [pos + missing_bp for pos in differences["deletionPositions"]]
+    mymismatches = [pos + missing_bp for pos in differences["mismatchPositions"]]
+    for coordIndex in range(len(coordinates)):
+        regionBegin, regionEnd = coordinates[coordIndex]
+        regionInsertions = [pos for pos in myinsertions if regionBegin <= pos <= regionEnd]
+        regionDeletions = [pos for pos in mydeletions if regionBegin <= pos <= regionEnd]
+        coordChange = len(regionInsertions) - len(regionDeletions)
+        if not coordChange:
+            continue
+        if coordIndex != len(coordinates) - 1:
+            coordinates[coordIndex] = (regionBegin, regionEnd + coordChange)
+        for mismatchIndex in range(len(mymismatches)):
+            mismatch = mymismatches[mismatchIndex]
+            if regionBegin <= mismatch <= regionEnd:
+                mymismatches[mismatchIndex] += len([pos for pos in regionInsertions if mismatch > pos])
+                mymismatches[mismatchIndex] -= len([pos for pos in regionDeletions if mismatch > pos])
+            if mismatch > regionEnd:
+                mymismatches[mismatchIndex] += coordChange
+        for nextFeatureIndex in range(coordIndex + 1, len(coordinates)):
+            (start, end) = coordinates[nextFeatureIndex]
+            if nextFeatureIndex != len(coordinates) - 1:
+                coordinates[nextFeatureIndex] = (start + coordChange, end + coordChange)
+            else:
+                coordinates[nextFeatureIndex] = (start + coordChange, end)
+    return coordinates
+
+
+class TestCalculateCoordinates(unittest.TestCase):
+    """test the coordinates calculated by coordinates.calculateCoordinates
+    (micro-benchmark on synthetic alleles with hundreds of indels)
+    """
+
+    @classmethod
+    def setUpClass(self):
+        if skip_other_tests:
+            self.skipTest(self, "Skipping TestCalculateCoordinates because skip_other_tests is set to True")
+        else:
+            import random
+            self.myrandom = random.Random(42)
+            exonpos_dic = {}
+            intronpos_dic = {}
+            pos = 300
+            for exon in range(1, 10):
+                exonpos_dic[exon] = (pos, pos + 100)
+                pos += 100
+                if exon < 9:
+                    intronpos_dic[exon] = (pos, pos + 1500)
+                    pos += 1500
+            seq = "".join(self.myrandom.choice("ACGT") for _ in range(pos + 300))
+            self.allele = HEP.Allele("X0000001", "KIR2DL1", "KIR2DL1*synthetic", seq, exonpos_dic, intronpos_dic,
+                                     {"utr5": (0, 300), "utr3": (pos, pos + 300)}, {exon: False for exon in exonpos_dic},
+                                     {exon: str(exon) for exon in exonpos_dic},
+                                     {intron: str(intron) for intron in intronpos_dic}, "KIR")
+
+    @classmethod
+    def tearDownClass(self):
+        pass
+
+    def test_many_indels(self):
+        """test that the coordinates are identical to those of the loop-based implementation
+        """
+        seq_length = len(self.allele.seq)
+        timer = Timer()
+        for (num_indels, missing_bp) in [(0, 0), (1, 0), (10, 5), (100, 0), (300, 20), (1000, 0)]:
+            differences = {key: sorted(self.myrandom.sample(range(1, seq_length), num_indels))
+                           for key in ["insertionPositions", "deletionPositions"]}
+            differences["mismatchPositions"] = sorted(self.myrandom.sample(range(1, seq_length), 300))
+            query_length = seq_length + self.myrandom.randint(-20, 20)
+            (_, coordinates, _, _, _) = COO.getClosestAlleleCoordinates(self.allele, query_length)
+            expected = timer.run("loop-based", loop_based_coordinates, coordinates, differences, missing_bp)
+            (_, result, _, _, _) = timer.run("bisection", COO.calculateCoordinates, self.allele.name,
+                                             {self.allele.name: self.allele}, differences, query_length, missing_bp)
+            self.assertEqual(result, expected)
+        timer.log("calculateCoordinates on synthetic alleles with up to 1000 indels")
+
+
+def list_based_imgt_differences(cdsMap, differences):
+    """former list-based version of the position shift in changeToImgtCoords
+    """
+    def transform(pos_orig, sum_deletes_before, sum_inserts_before, sum_cds_deletes_before, sum_cds_inserts_before):
+        pos = pos_orig - sum_deletes_before
+        for region in sorted(cdsMap.keys()):
+            if region[0] <= pos <= region[1]:
+                newPosition = cdsMap[region][0] + (pos - region[0]) - sum_cds_inserts_before + sum_cds_deletes_before
+                return (newPosition, newPosition / 3)
+        return (pos_orig - sum_inserts_before, None)
+
+    differences = copy.deepcopy(differences)
+    imgtDifferences = {}
+    ins_in_cds = []
+    del_in_cds = []
+    for key in ["deletionPositions", "insertionPositions", "mismatchPositions"]:
+        imgtDifferences[key] = []
+        new_diff = []
+        for pos in differences[key]:
+            newpos = transform(pos,
+                               len([posx for posx in differences["deletionPositions"] if posx < pos]),
+                               len([posx for posx in differences["insertionPositions"] if posx < pos]),
+                               len([posx for posx in differences["deletionPositions"]
+                                    if posx < pos and posx in del_in_cds]),
+                               len([posx for posx in differences["insertionPositions"]
+                                    if posx < pos and posx in ins_in_cds]))
+            imgtDifferences[key].append(newpos)
+            if newpos[1]:
+                new_diff.append(pos)
+                if key == "insertionPositions":
+                    ins_in_cds.append(pos)
+                elif key == "deletionPositions":
+                    del_in_cds.append(pos)
+            else:
+                new_diff.append(newpos[0])
+        differences[key] = new_diff
+    return imgtDifferences
+
+
+class TestImgtTransform(unittest.TestCase):
+    """test the IMGT positions of differences calculated by imgtTransform.changeToImgtCoords
+    (micro-benchmark on synthetic alleles with hundreds of differences)
+    """
+
+    @classmethod
+    def setUpClass(self):
+        if skip_other_tests:
+            self.skipTest(self, "Skipping TestImgtTransform because skip_other_tests is set to True")
+        else:
+            import random
+            self.myrandom = random.Random(42)
+            self.features = ["utr5"]
+            self.coordinates = [(1, 300)]
+            pos = 301
+            for exon in range(1, 10):
+                self.features.append(f"e{exon}")
+                self.coordinates.append((pos, pos + 99))
+                pos += 100
+                if exon < 9:
+                    self.features.append(f"i{exon}")
+                    self.coordinates.append((pos, pos + 1499))
+                    pos += 1500
+            self.features.append("utr3")
+            self.coordinates.append((pos, pos + 299))
+            self.seq_length = pos + 299
+
+    @classmethod
+    def tearDownClass(self):
+        pass
+
+    def test_find_cds_region(self):
+        """test that positions are assigned to the first CDS region containing them, even for overlapping regions
+        """
+        cdsMap = {(10, 20): (1, 11), (15, 40): (12, 37), (18, 19): (38, 39), (50, 60): (40, 50)}
+        table = IT.getCdsTable(cdsMap)
+        for pos in range(70):
+            expected = [region for region in sorted(cdsMap) if region[0] <= pos <= region[1]]
+            self.assertEqual(IT.findCdsRegion(pos, table), expected[0] if expected else None)
+
+    def test_many_differences(self):
+        """test that the IMGT differences found by bisection are identical to those of the list-based
+        implementation, including unsorted and repeated positions
+        """
+        timer = Timer()
+        for (num_indels, num_mismatches) in [(0, 0), (1, 3), (10, 10), (100, 300), (300, 500), (1000, 1000)]:
+            differences = {}
+            for key in ["insertionPositions", "deletionPositions"]:
+                positions = self.myrandom.sample(range(1, self.seq_length), num_indels)
+                positions += self.myrandom.sample(positions, num_indels // 5)  # repeated positions
+                differences[key] = sorted(positions)
+            differences["mismatchPositions"] = [self.myrandom.randint(1, self.seq_length)
+                                                for _ in range(num_mismatches)]
+            for key in ["mismatches", "insertions", "deletions"]:
+                differences[key] = []
+            cdsMap = IT.constructCDS(self.features, self.coordinates)
+            expected = timer.run("list-based", list_based_imgt_differences, cdsMap, differences)
+            (_, result, _) = timer.run("bisection", IT.changeToImgtCoords, self.features, self.coordinates,
+                                       copy.deepcopy(differences))
+            for key in ["deletionPositions", "insertionPositions", "mismatchPositions"]:
+                self.assertEqual(result[key], expected[key])
+        timer.log("changeToImgtCoords on synthetic alleles with up to 3400 differences")
+
+
+class TestAnnotationBatch(unittest.TestCase):
+    """test the batch annotation of many BLAST results by coordinates.getCoordinates_batch
+    """
+
+    @classmethod
+    def setUpClass(self):
+        if skip_other_tests:
+            self.skipTest(self, "Skipping TestAnnotationBatch because skip_other_tests is set to True")
+        else:
+            self.mydir = os.path.join(curr_settings["temp_dir"], "annotation_batch_test")
+            os.makedirs(self.mydir, exist_ok=True)
+            self.settings = dict(curr_settings)
+            self.settings["login_dir"] = None  # without result cache
+            (self.parsed_fasta, self.alleles_file, _) = GASB.get_reference_files("KIR", self.settings)
+            sample_file = os.path.join(mypath_inner, "sample_files", "KIR2DL1_0020101.fa")
+            (header, seq) = next(EF.fasta_generator(sample_file))
+            self.blast_files = []
+            for (i, pos) in enumerate([1000, 2000, 3000]):
+                fasta_file = os.path.join(self.mydir, f"batch{i}.fa")
+                with open(fasta_file, "w") as g:
+                    g.write(f">{header}\n{seq[:pos]}{'A' if seq[pos] != 'A' else 'C'}{seq[pos + 1:]}\n")
+                self.blast_files.append(GASB.blastSequences(fasta_file, self.parsed_fasta, self.settings, log))
+
+    @classmethod
+    def tearDownClass(self):
+        shutil.rmtree(self.mydir, ignore_errors=True)
+
+    def test_batch(self):
+        """test that all alleles are annotated as by getCoordinates, with one reference read,
+        and that errors are returned per item
+        """
+        expected = [COO.getCoordinates(blast_file, self.alleles_file, "KIR", self.settings, log)
+                    for blast_file in self.blast_files]
+        for blast_file in self.blast_files:
+            os.remove(RC.get_sample_annotation_file(blast_file))
+        items = [(blast_file, self.alleles_file, "KIR") for blast_file in self.blast_files]
+        items.insert(1, (os.path.join(self.mydir, "missing.blast.xml"), self.alleles_file, "KIR"))
+        with patch.object(COO, "read_alleles", wraps=COO.read_alleles) as mock_read_alleles:
+            results = COO.getCoordinates_batch(items, self.settings, log)
+            mock_read_alleles.assert_called_once()
+        self.assertIsInstance(results.pop(1), OSError)
+        self.assertEqual(results, expected)
+
+
+class TestIncrementalReferenceUpdate(unittest.TestCase):
+    """test that incremental reference updates create the same files as a full rebuild
+    """
+
+    @classmethod
+    def setUpClass(self):
+        if skip_other_tests:
+            self.skipTest(self, "Skipping TestIncrementalReferenceUpdate because skip_other_tests is set to True")
+        else:
+            self.mydir = os.path.join(curr_settings["temp_dir"], "incremental_update_test")
+            self.target = "KIR"
+            reference_local_path = os.path.join(curr_settings["root_path"], curr_settings["general_dir"],
+                                                curr_settings["reference_dir"])
+            self.old_dir = os.path.join(self.mydir, "old")
+            os.makedirs(self.old_dir, exist_ok=True)
+            old_dat_file = os.path.join(self.old_dir, f"{self.target}.dat")
+            shutil.copyfile(os.path.join(reference_local_path, curr_settings["kir_dat"]), old_dat_file)
+            HEP.make_parsed_files(self.target, self.old_dir, log)
+
+            # new version: 3 changed, 1 added, 1 removed record
+            records = [lines for (_, _, lines) in HEP.iter_raw_records(old_dat_file)]
+            for i in [10, 20, 30]:
+                seq_line = [j for (j, line) in enumerate(records[i]) if line.startswith("SQ")][0] + 1
+                line = records[i][seq_line]
+                pos = len(line) - len(line.lstrip())
+                records[i][seq_line] = line[:pos] + ("c" if line[pos] != "c" else "a") + line[pos + 1:]
+            old_name = HEP.get_record_name(records[50], self.target)
+            records.append([line.replace(old_name, old_name + "99") for line in records[50]])
+            del records[40]
+            self.new_dat_text = "".join("\n".join(lines) + "\n" for lines in records)
+
+    @classmethod
+    def tearDownClass(self):
+        shutil.rmtree(self.mydir, ignore_errors=True)
+
+    def make_new_reference(self, name):
+        """writes the new version of the .dat file into a new directory, returns the directory
+        """
+        ref_dir = os.path.join(self.mydir, name)
+        os.makedirs(ref_dir, exist_ok=True)
+        dat_file = os.path.join(ref_dir, f"{self.target}.dat")
+        with open(dat_file, "w", newline="\n", encoding="latin-1") as g:
+            g.write(self.new_dat_text)
+        os.utime(dat_file, (1700000000, 1700000000))  # same stamp in all directories
+        return ref_dir
+
+    def assert_same_files(self, ref_dir, full_dir):
+        """asserts that all files of the full rebuild in full_dir are identical in ref_dir
+        """
+        files = sorted(os.listdir(full_dir))
+        for suffix in [".fa", ".dump", ".fa.fai", ".fa.seqidx", ".idx", ".models", "_allelenames.dump",
+                       f"curr_version_{self.target}.txt"]:
+            self.assertTrue([myfile for myfile in files if myfile.endswith(suffix)], suffix)
+        for myfile in files:
+            with open(os.path.join(full_dir, myfile), "rb") as f1, open(os.path.join(ref_dir, myfile), "rb") as f2:
+                self.assertEqual(f1.read(), f2.read(), myfile)
+
+    def test_incremental_update(self):
+        """test that an incremental update only reparses changed records and gives the files of a full rebuild
+        """
+        # the file stamps in the index contain modification times, which differ between both builds:
+        with patch.object(RI, "get_file_stamp", lambda myfile: (os.path.getsize(myfile), 0)):
+            ref_dir = self.make_new_reference("incremental")
+            (version, manifest) = HEP.make_parsed_files_incremental(self.target, ref_dir, self.old_dir, log)
+            full_dir = self.make_new_reference("full")
+            self.assertEqual(HEP.make_parsed_files(self.target, full_dir, log), version)
+
+        self.assertEqual(manifest["mode"], "incremental")
+        self.assertEqual((len(manifest["added"]), len(manifest["changed"]), len(manifest["removed"])), (1, 3, 1))
+        self.assertEqual(HEP.read_change_manifest(ref_dir, self.target), manifest)
+        self.assertEqual(sorted(os.listdir(ref_dir)),
+                         sorted(os.listdir(full_dir) + [os.path.basename(HEP.get_manifest_file(ref_dir,
+                                                                                              self.target))]))
+        self.assert_same_files(ref_dir, full_dir)
+
+    def test_fallback(self):
+        """test that too many changes or a missing previous version lead to a full rebuild
+        """
+        with patch.object(RI, "get_file_stamp", lambda myfile: (os.path.getsize(myfile), 0)):
+            full_dir = self.make_new_reference("full_fallback")
+            HEP.make_parsed_files(self.target, full_dir, log)
+            for (name, old_dir, max_changes) in [("too_many_changes", self.old_dir, 0),
+                                                 ("no_previous_version", os.path.join(self.mydir, "missing"), 0.3)]:
+                ref_dir = self.make_new_reference(name)
+                with patch.object(HEP, "patch_parsed_files") as mock_patch:
+                    (_, manifest) = HEP.make_parsed_files_incremental(self.target, ref_dir, old_dir, log,
+                                                                      max_changes=max_changes)
+                    mock_patch.assert_not_called()
+                self.assertEqual(manifest["mode"], "full")
+                os.remove(HEP.get_manifest_file(ref_dir, self.target))
+                self.assert_same_files(ref_dir, full_dir)
+
+
+class TestReferenceCache(unittest.TestCase):
+    """test the process-wide cache for parsed reference data
+    """
+
+    @classmethod
+    def setUpClass(self):
+        if skip_other_tests:
+            self.skipTest(self, "Skipping TestReferenceCache because skip_other_tests is set to True")
+        else:
+            self.mydir = os.path.join(curr_settings["temp_dir"], "reference_cache_test")
+            os.makedirs(self.mydir, exist_ok=True)
+
+    @classmethod
+    def tearDownClass(self):
+        shutil.rmtree(self.mydir, ignore_errors=True)
+
+    def test_hit_and_miss(self):
+        """test that values are only loaded on the first request
+        """
+        cache = REFC.ReferenceCache()
+        loaded = []
+        for _ in range(3):
+            value = cache.get(("allele", "/ref/KIR.dat", ("1",), "KIR2DL1*001"),
+                              lambda: loaded.append(1) or "value")
+            self.assertEqual(value, "value")
+        self.assertEqual(len(loaded), 1)
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+
+    def test_eviction(self):
+        """test that the least recently used entries are removed when the memory cap is exceeded
+        """
+        cache = REFC.ReferenceCache(max_bytes=250)
+        keys = [("allele", "/ref/KIR.dat", ("1",), name) for name in ["a", "b", "c"]]
+        cache.get(keys[0], lambda: "a", lambda value: 100)
+        cache.get(keys[1], lambda: "b", lambda value: 100)
+        cache.get(keys[0], lambda: "a", lambda value: 100)  # a is now used more recently than b
+        cache.get(keys[2], lambda: "c", lambda value: 100)
+        self.assertEqual(list(cache.entries.keys()), [keys[0], keys[2]])
+        self.assertEqual((cache.size, cache.evictions), (200, 1))
+
+    def test_invalidate(self):
+        """test that invalidating a directory only removes the entries of files in this directory
+        """
+        cache = REFC.ReferenceCache()
+        dir1 = os.path.join(self.mydir, "ref1")
+        dir2 = os.path.join(self.mydir, "ref2")
+        key1 = ("allele", os.path.join(dir1, "KIR.dat"), ("1",), "KIR2DL1*001")
+        key2 = ("allele", os.path.join(dir2, "KIR.dat"), ("1",), "KIR2DL1*001")
+        for key in [key1, key2]:
+            cache.get(key, lambda: "value", lambda value: 10)
+        cache.invalidate(dir1)
+        self.assertEqual(list(cache.entries.keys()), [key2])
+        self.assertEqual(cache.size, 10)
+        cache.invalidate()
+        self.assertEqual((len(cache.entries), cache.size), (0, 0))
+
+    def test_version_token(self):
+        """test that the version token is only read once, and that a rewritten reference gets a new token
+        after its directory was invalidated, so its old entries are not used anymore
+        """
+        cache = REFC.ReferenceCache()
+        ref_dir = os.path.join(self.mydir, "token")
+        os.makedirs(ref_dir, exist_ok=True)
+        fasta_file = os.path.join(ref_dir, "parsedKIR.fa")
+        self.assertIsNone(cache.get_token(fasta_file)[1][-1])  # missing files are not remembered
+        with open(fasta_file, "w") as g:
+            g.write(">KIR2DL1*001\nACGT\n")
+        with open(os.path.join(ref_dir, "curr_version_KIR.txt"), "w") as g:
+            g.write("2.10.0")
+        (path, token1) = cache.get_token(fasta_file)
+        self.assertEqual(path, os.path.abspath(fasta_file))
+        self.assertEqual(token1[:3], ("2.10.0", None, 18))
+        cache.get(("sequence", path, token1, "KIR2DL1*001"), lambda: "ACGT")
+
+        with open(os.path.join(ref_dir, "curr_version_KIR.txt"), "w") as g:
+            g.write("2.11.0")
+        with patch.object(REFC, "read_version_token") as mock_read:
+            self.assertEqual(cache.get_token(fasta_file), (path, token1))
+            mock_read.assert_not_called()
+        cache.invalidate(ref_dir)
+        (_, token2) = cache.get_token(fasta_file)
+        self.assertEqual(token2[:3], ("2.11.0", None, 18))
+        self.assertEqual(cache.get(("sequence", path, token2, "KIR2DL1*001"), lambda: "ACGTACGT"), "ACGTACGT")
+        self.assertEqual(cache.misses, 2)
+
+    def test_reference_replaced(self):
+        """test that a reference file replaced without invalidating the cache (e.g., by another TypeLoader session)
+        is read again on the next lookup
+        """
+        ref_dir = os.path.join(self.mydir, "replaced")
+        os.makedirs(ref_dir, exist_ok=True)
+        fasta_file = os.path.join(ref_dir, "parsedKIR.fa")
+        with open(fasta_file, "w") as g:
+            g.write(">KIR2DL1*001\nACGT\n>KIR2DL1*002\nACGA\n")
+        os.utime(fasta_file, (1700000000, 1700000000))
+        self.assertEqual(str(RI.read_reference_sequence(fasta_file, "KIR2DL1*002", log)), "ACGA")
+
+        with open(fasta_file, "w") as g:  # reference update by another session
+            g.write(">KIR2DL1*001\nACGTACGT\n>KIR2DL1*002\nACGAACGA\n")
+        RI.make_fasta_index(fasta_file, log)  # updates replace the fasta index, too
+        self.assertEqual(str(RI.read_reference_sequence(fasta_file, "KIR2DL1*002", log)), "ACGAACGA")
+        self.assertFalse([key for key in REFC.reference_cache.entries
+                          if key[1] == os.path.abspath(fasta_file) and key[2][-1] == 1700000000])
+
+
+class TestDatFileRecords(unittest.TestCase):
+    """test reading .dat files record by record
+    """
+
+    @classmethod
+    def setUpClass(self):
+        if skip_other_tests:
+            self.skipTest(self, "Skipping TestDatFileRecords because skip_other_tests is set to True")
+        else:
+            self.mydir = os.path.join(curr_settings["temp_dir"], "dat_records_test")
+            os.makedirs(self.mydir, exist_ok=True)
+            self.target = "KIR"
+            reference_local_path = os.path.join(curr_settings["root_path"], curr_settings["general_dir"],
+                                                curr_settings["reference_dir"])
+            dat_file = os.path.join(reference_local_path, curr_settings["kir_dat"])
+            self.records = []
+            for (_, _, lines) in HEP.iter_raw_records(dat_file):
+                self.records.append(lines)
+                if len(self.records) == 20:
+                    break
+
+    @classmethod
+    def tearDownClass(self):
+        shutil.rmtree(self.mydir, ignore_errors=True)
+
+    def write_dat_file(self, name, records, newline="\n"):
+        """writes records (lists of lines) into a .dat file, returns its path
+        """
+        dat_file = os.path.join(self.mydir, name)
+        with open(dat_file, "w", encoding="latin-1", newline="") as g:
+            g.write("".join(newline.join(lines) + newline for lines in records))
+        return dat_file
+
+    def test_record_boundaries(self):
+        """test that offset and length of each record point to exactly this record
+        """
+        dat_file = self.write_dat_file("KIR_lf.dat", self.records)
+        raw_records = list(HEP.iter_raw_records(dat_file))
+        self.assertEqual([lines for (_, _, lines) in raw_records], self.records)
+        self.assertEqual(raw_records[0][0], 0)
+        for ((offset, length, lines), next_record) in zip(raw_records, raw_records[1:] + [None]):
+            self.assertEqual(HEP.read_raw_record(dat_file, offset, length), lines)
+            if next_record:
+                self.assertEqual(offset + length, next_record[0])
+            else:
+                self.assertEqual(offset + length, os.path.getsize(dat_file))
+
+    def test_crlf(self):
+        """test that files with Windows line endings yield the same records and alleles
+        """
+        lf_file = self.write_dat_file("KIR_lf.dat", self.records)
+        crlf_file = self.write_dat_file("KIR_crlf.dat", self.records, newline="\r\n")
+        crlf_records = list(HEP.iter_raw_records(crlf_file))
+        self.assertEqual([lines for (_, _, lines) in crlf_records], self.records)
+        for (offset, length, lines) in crlf_records:
+            self.assertEqual(HEP.read_raw_record(crlf_file, offset, length), lines)
+
+        lf_alleles = list(HEP.iter_dat_file(lf_file, self.target, log))
+        crlf_alleles = list(HEP.iter_dat_file(crlf_file, self.target, log))
+        self.assertEqual(len(crlf_alleles), len(self.records))
+        for ((lf_allele, lf_version), (crlf_allele, crlf_version)) in zip(lf_alleles, crlf_alleles):
+            self.assertEqual(crlf_version, lf_version)
+            self.assertEqual((crlf_allele.name, crlf_allele.seq, crlf_allele.exonpos_dic),
+                             (lf_allele.name, lf_allele.seq, lf_allele.exonpos_dic))
+
+        for (start, end) in HEP.get_chunk_ranges(crlf_file, 3):
+            for (offset, length, _) in HEP.iter_raw_records(crlf_file, start, end):
+                self.assertTrue(start <= offset < end)
+
+    def test_missing_final_terminator(self):
+        """test that an unterminated last record is not yielded, and that all complete records are
+        """
+        records = self.records[:-1] + [self.records[-1][:-1]]
+        self.assertTrue(self.records[-1][-1].startswith("//"))
+        dat_file = self.write_dat_file("KIR_unterminated.dat", records)
+        raw_records = list(HEP.iter_raw_records(dat_file))
+        self.assertEqual([lines for (_, _, lines) in raw_records], self.records[:-1])
+        alleles, _ = HEP.read_dat_file(dat_file, self.target, log)
+        self.assertNotIn(HEP.get_record_name(self.records[-1], self.target), alleles)
+        self.assertEqual(len(alleles), len(self.records) - 1)
+
+    def test_duplicate_records(self):
+        """test that an allele occurring in several records is only listed once in the allele names file
+        """
+        allele_names = {}
+        duplicates = self.records + self.records[:5]
+        for (name, records, workers) in [("unique", self.records, 1), ("duplicates1", duplicates, 1),
+                                         ("duplicates2", duplicates, 2)]:
+            ref_dir = os.path.join(self.mydir, name)
+            os.makedirs(ref_dir, exist_ok=True)
+            self.write_dat_file(os.path.join(ref_dir, f"{self.target}.dat"), records)
+            HEP.make_parsed_files(self.target, ref_dir, log, workers=workers)
+            with open(os.path.join(ref_dir, f"{self.target}_allelenames.dump"), "rb") as f:
+                allele_names[name] = pickle.load(f)
+        self.assertTrue(allele_names["unique"])
+        self.assertEqual(allele_names["duplicates1"], allele_names["unique"])
+        self.assertEqual(allele_names["duplicates2"], allele_names["unique"])
+
+
+class TestConcurrentReferenceUpdates(unittest.TestCase):
+    """test that HLA and KIR references can be checked and updated at the same time,
+    sharing one temp dir
+    """
+
+    @classmethod
+    def setUpClass(self):
+        if skip_other_tests:
+            self.skipTest(self, "Skipping TestConcurrentReferenceUpdates because skip_other_tests is set to True")
+        else:
+            self.mydir = os.path.join(curr_settings["temp_dir"], "concurrent_update_test")
+            self.source_dir = os.path.join(self.mydir, "source")
+            os.makedirs(self.source_dir, exist_ok=True)
+            reference_local_path = os.path.join(curr_settings["root_path"], curr_settings["general_dir"],
+                                                curr_settings["reference_dir"])
+            self.source_files = {}
+            self.md5s = {}
+            for (db_name, dat_file) in [("hla", curr_settings["hla_dat"]), ("KIR", curr_settings["kir_dat"])]:
+                # use the first 50 records of each reference, to keep parsing fast:
+                dat_file = os.path.join(reference_local_path, dat_file)
+                end = [offset + length for (offset, length, _) in HEP.iter_raw_records(dat_file)][49]
+                with open(dat_file, "rb") as f:
+                    data = f.read(end)
+                source_file = os.path.join(self.source_dir, f"{db_name}.dat")
+                with open(source_file, "wb") as g:
+                    g.write(data)
+                self.source_files[db_name] = source_file
+                self.md5s[db_name] = hashlib.md5(data).hexdigest()
+
+    @classmethod
+    def tearDownClass(self):
+        shutil.rmtree(self.mydir, ignore_errors=True)
+
+    def test_check_concurrently(self):
+        """test that both databases are checked at the same time and only the changed one is reported
+        """
+        ref_dir = os.path.join(self.mydir, "check")
+        os.makedirs(ref_dir, exist_ok=True)
+        for (db_name, local_md5) in [("hla", self.md5s["hla"]), ("KIR", "outdated")]:
+            shutil.copyfile(self.source_files[db_name], os.path.join(ref_dir, f"{db_name}.dat"))
+            with open(os.path.join(ref_dir, f"curr_md5_{db_name}.txt"), "w") as g:
+                g.write(f"{local_md5} 01.01.20")
+
+        both_running = threading.Barrier(2, timeout=30)  # raises BrokenBarrierError if the checks run serially
+
+        def get_remote_md5checksum(db_name, IPD_db_name, proxy, log):
+            both_running.wait()
+            return self.md5s[IPD_db_name]
+
+        with patch.object(UR, "get_remote_md5checksum", get_remote_md5checksum):
+            update_me, messages = check_update_needed(ref_dir, None, log)
+        self.assertEqual(update_me, ["KIR"])
+        self.assertEqual(messages, [])
+
+    def test_update_concurrently(self):
+        """test that updating both databases at the same time creates the same files as parsing them one by one,
+        and that no files are left in the shared temp dir
+        """
+        ref_dir = os.path.join(self.mydir, "update")
+        os.makedirs(ref_dir, exist_ok=True)
+        both_running = threading.Barrier(2, timeout=30)  # raises BrokenBarrierError if the updates run serially
+
+        def download_file(myurl, local_file, proxy, timeout, log, progress_callback=None):
+            both_running.wait()
+            db_name = os.path.basename(local_file).split(".")[0]
+            shutil.copyfile(self.source_files[db_name], local_file)
+            return self.md5s[db_name]
+
+        with patch.object(UR, "download_file", download_file):
+            results = typeloader_functions.perform_reference_updates(["HLA", "KIR"], ref_dir,
+                                                                     curr_settings["blast_path"], None, log)
+        for (db_name, (success, err, msg)) in results.items():
+            self.assertTrue(success, f"{db_name}: {msg}")
+        self.assertEqual(os.listdir(os.path.join(ref_dir, "temp")), [])
+
+        for db_name in ["hla", "KIR"]:
+            serial_dir = os.path.join(self.mydir, f"serial_{db_name}")
+            os.makedirs(serial_dir, exist_ok=True)
+            shutil.copyfile(self.source_files[db_name], os.path.join(serial_dir, f"{db_name}.dat"))
+            HEP.make_parsed_files(db_name, serial_dir, log)
+            for myfile in [f"parsed{db_name}.fa", f"curr_version_{db_name}.txt"]:
+                with open(os.path.join(serial_dir, myfile)) as f1, open(os.path.join(ref_dir, myfile)) as f2:
+                    self.assertEqual(f1.read(), f2.read(), myfile)
+            with open(os.path.join(ref_dir, f"curr_md5_{db_name}.txt")) as f:
+                self.assertEqual(f.read().split()[0], self.md5s[db_name])
+
+    def test_workers_split(self):
+        """test that concurrent updates share the worker budget instead of each using all cores
+        """
+        with patch.object(typeloader_functions, "perform_reference_update",
+                          return_value=(True, None, "")) as mock_update:
+            typeloader_functions.perform_reference_updates(["HLA", "KIR"], self.mydir, curr_settings["blast_path"],
+                                                           None, log, workers=4)
+            self.assertEqual([call.kwargs["workers"] for call in mock_update.call_args_list], [2, 2])
+            mock_update.reset_mock()
+            typeloader_functions.perform_reference_updates(["HLA", "KIR"], self.mydir, curr_settings["blast_path"],
+                                                           None, log, workers=1)
+            self.assertEqual([call.kwargs["workers"] for call in mock_update.call_args_list], [1, 1])
+
+    def test_no_parallel_update_of_same_reference(self):
+        """test that a reference cannot be updated while another update of it is running (e.g., a manual reset)
+        """
+        with typeloader_functions.REFERENCE_UPDATE_LOCKS["kir"]:
+            with patch.object(UR, "update_database") as mock_update:
+                success, err, msg = typeloader_functions.perform_reference_update("KIR", self.mydir,
+                                                                                  curr_settings["blast_path"],
+                                                                                  None, log)
+                mock_update.assert_not_called()
+        self.assertFalse(success)
+        self.assertEqual(err, "Reference update running")
+
+
 class TestCleanStuff(unittest.TestCase):
     """
     Remove all directories and files written by  all unit tests
@@ -20,6 +20,7 @@ sys.path.append(mypackage)
 
 import os
 import ctypes
+import multiprocessing
 import time
 import platform
 from functools import partial
@@ -65,6 +66,7 @@ class MainGUI(QMainWindow):
         self.current_project = ""
         self.current_sample = ""
         self.uncommitted_changes = False
+        self.reference_updater = None  # set after startup, see GUI_login.BackgroundReferenceUpdater
         self.initUI()
 
     def initUI(self):
@@ -500,6 +502,8 @@ class MainGUI(QMainWindow):
             self.mydb.close()
 
         if self.settings["modus"] == "debugging":
+            if self.reference_updater:
+                self.reference_updater.wait()
             return
 
         self.log.debug("Asking for confirmation before closing...")
@@ -509,6 +513,8 @@ class MainGUI(QMainWindow):
 
         if reply == QMessageBox.Yes:
             self.log.debug("Closing TypeLoader...")
+            if self.reference_updater:
+                self.reference_updater.wait()
             event.accept()
         else:
             self.log.debug("Not closing TypeLoader.")
@@ -618,6 +624,7 @@ def remove_lock(settings_dic, log):
 # main:
 
 if __name__ == '__main__':  # pragma: nocover
+    multiprocessing.freeze_support()  # needed for process pools in the frozen Windows app
     if GUI_login.config_files_missing():
         sys.exit(1)
 
@@ -677,17 +684,8 @@ if __name__ == '__main__':  # pragma: nocover
             ex = MainGUI(mydb, log, settings_dic)
             ex.showMaximized()
             splash.finish(ex)
-            try:
-                GUI_login.check_for_reference_updates(log, settings_dic, ex)
-            except Exception as E:
-                log.error(E)
-                log.exception(E)
-                try:
-                    QMessageBox.warning(ex, "Reference error",
-                                        "Could not update the reference file, probably due to a temporary connection hickup. Please restart TypeLoader to try again.")
-                except Exception as E2:
-                    log.info("Could not open QMessagebox")
-                    log.exception(E2)
+            ex.reference_updater = GUI_login.BackgroundReferenceUpdater(log, settings_dic, ex)
+            ex.reference_updater.start()
             result = app.exec_()
             cleanup_recovery(settings_dic, log)
             ok = True
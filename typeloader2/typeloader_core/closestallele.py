@@ -12,28 +12,257 @@ This routine makes the following assumptions :
 from Bio.Blast import NCBIXML
 from Bio import SeqIO
 from Bio import Align
+import numpy as np
 import os
 import re
 
 try:
     from . import errors
+    from .reference_index import read_reference_sequence
 except ImportError:
     import errors
+    from reference_index import read_reference_sequence
+
+BLAST_XML_EXT = ".blast.xml"
+BLAST_TABLE_EXT = ".blast.tsv"  # compact BLAST output (tabular with comment lines, -outfmt 7)
+BLAST_TABLE_FIELDS = "qseqid sseqid qlen qstart sstart send length btop stitle"  # stitle last: may contain blanks
+END_WINDOW = 50  # number of HSP bases anchoring the alignment of the region before the HSP
+END_BAND = 50  # number of reference bases considered in addition to the unaligned query bases
+
+
+###################################################
+
+class CompactHsp:
+    """first HSP of a hit read from compact BLAST output;
+    the aligned sequences are not stored but rebuilt from the BTOP string by expand()
+    """
+
+    def __init__(self, query_start, sbjct_start, sbjct_end, align_length, btop):
+        self.query_start = query_start
+        self.sbjct_start = sbjct_start
+        self.sbjct_end = sbjct_end
+        self.align_length = align_length
+        self.btop = btop
+        self.query = self.sbjct = self.match = None
+
+    def expand(self, ref_sequence, query_sequence):
+        """rebuilds the aligned query, subject and match strings (as given in BLAST XML output)
+        from the BTOP string and the sequences of query and reference allele
+        """
+        if self.sbjct_start <= self.sbjct_end:
+            sbjct_seq = str(ref_sequence[self.sbjct_start - 1:self.sbjct_end]).upper()
+        else:  # hit on the minus strand
+            sbjct_seq = str(ref_sequence[self.sbjct_end - 1:self.sbjct_start].reverse_complement()).upper()
+        query_seq = str(query_sequence[self.query_start - 1:]).upper()
+
+        query, sbjct, match = [], [], []
+        q = s = 0
+        for (num, query_base, sbjct_base) in re.findall(r"(\d+)|(\D)(\D)", self.btop):
+            if num:  # stretch of identical bases
+                n = int(num)
+                query.append(query_seq[q:q + n])
+                sbjct.append(sbjct_seq[s:s + n])
+                match.append("|" * n)
+                q += n
+                s += n
+            else:  # mismatch or gap
+                query.append(query_base)
+                sbjct.append(sbjct_base)
+                match.append(" ")
+                if query_base != "-":
+                    q += 1
+                if sbjct_base != "-":
+                    s += 1
+        self.query = "".join(query)
+        self.sbjct = "".join(sbjct)
+        self.match = "".join(match)
+
+
+class CompactAlignment:
+    """top hit of a query read from compact BLAST output
+    """
+
+    def __init__(self, hit_id, hit_def, hsps):
+        self.hit_id = hit_id
+        self.hit_def = hit_def
+        self.hsps = hsps
+
+
+class CompactRecord:
+    """BLAST result of one query read from compact BLAST output (contains only the top hit)
+    """
+
+    def __init__(self, query_id, database):
+        self.query_id = query_id
+        self.database = database
+        self.query_length = 0
+        self.alignments = []
+
+
+class AlignedHit:
+    """alignment of a query to a reference allele found without BLAST (exact reference match or k-mer search),
+    holding what is needed to write it as BLAST output (qseq & hseq: aligned sequences incl. gaps)
+    """
+
+    def __init__(self, name, ref_length, query_from, hit_from, qseq, hseq, query_length):
+        self.name = name
+        self.ref_length = ref_length
+        self.query_length = query_length
+        self.query_from = query_from
+        self.query_to = query_from + len(qseq) - qseq.count("-") - 1
+        self.hit_from = hit_from
+        self.hit_to = hit_from + len(hseq) - hseq.count("-") - 1
+        self.qseq = qseq
+        self.hseq = hseq
+        self.align_length = len(qseq)
+        self.identities = sum(q == h for (q, h) in zip(qseq, hseq))
+        self.gaps = qseq.count("-") + hseq.count("-")
+        mismatches = self.align_length - self.identities - self.gaps
+        self.score = self.identities - 2 * mismatches - 2.5 * self.gaps  # BLAST defaults for megablast
+
+    @property
+    def midline(self):
+        return "".join("|" if q == h else " " for (q, h) in zip(self.qseq, self.hseq))
+
+    @property
+    def btop(self):
+        """returns the alignment as BTOP string (as given in compact BLAST output)
+        """
+        btop = []
+        identical = 0
+        for (q, h) in zip(self.qseq, self.hseq):
+            if q == h:
+                identical += 1
+            else:
+                if identical:
+                    btop.append(str(identical))
+                    identical = 0
+                btop.append(q + h)
+        if identical:
+            btop.append(str(identical))
+        return "".join(btop)
 
 
 ###################################################
 
+def get_query_fasta_file(blast_filename):
+    """returns the path of the query fasta file belonging to a BLAST output file
+    """
+    for ext in [BLAST_XML_EXT, BLAST_TABLE_EXT]:
+        if blast_filename.endswith(ext):
+            return blast_filename[:-len(ext)] + ".fa"
+    return blast_filename.replace("blast.xml", "fa")
+
+
+def read_blast_table_blocks(handle):
+    """reads compact BLAST output (-outfmt 7), yields the lines of each query
+    (without the final '# BLAST processed' line)
+    """
+    block = []
+    for line in handle:
+        if line.startswith("# BLAST") and block:  # start of next query or end of the output
+            yield block
+            block = []
+        if not line.startswith("# BLAST processed"):
+            block.append(line)
+    if block:
+        yield block
+
+
+def parse_blast_table(handle):
+    """lean parser for compact BLAST output (-outfmt 7 with BLAST_TABLE_FIELDS):
+    yields one CompactRecord per query, containing only the first HSP of its top hit
+    """
+    record = None
+    database = ""
+    for line in handle:
+        if line.startswith("#"):
+            if line.startswith("# Query:"):
+                if record:
+                    yield record
+                query = line[len("# Query:"):].split()
+                record = CompactRecord(query[0] if query else "", database)
+            elif line.startswith("# Database:"):
+                database = line[len("# Database:"):].strip()
+                if record:
+                    record.database = database
+            continue
+        if record is None or record.alignments:  # only the top hit is needed
+            continue
+        [_, sseqid, qlen, qstart, sstart, send, length, btop, stitle] = line.rstrip("\n").split("\t", 8)
+        record.query_length = int(qlen)
+        hsp = CompactHsp(int(qstart), int(sstart), int(send), int(length), btop)
+        record.alignments.append(CompactAlignment(sseqid, stitle, [hsp]))
+    if record:
+        yield record
+
 
 def get_closest_known_alleles(blast_xml_filename, target_family, settings, log):
     with open(blast_xml_filename) as xmlHandle:
-        xmlParser = NCBIXML.parse(xmlHandle)
+        if blast_xml_filename.endswith(BLAST_TABLE_EXT):
+            xmlParser = parse_blast_table(xmlHandle)
+        else:
+            xmlParser = NCBIXML.parse(xmlHandle)
 
         # get the associated fasta file
-        query_fasta_file = blast_xml_filename.replace("blast.xml", "fa")
+        query_fasta_file = get_query_fasta_file(blast_xml_filename)
         closestAllelesData = parse_blast(xmlParser, target_family, query_fasta_file, settings, log)
     return closestAllelesData
 
 
+def get_reference_fasta(database, settings, log):
+    """returns the reference fasta file used to read the sequences of the BLAST hits
+    (always the one of the complete reference, also for BLAST runs against restricted databases or shards)
+    """
+    database_name = os.path.basename(database)
+    if database_name.startswith("parsedKIR.fa"):
+        return os.path.join(settings["dat_path"], settings["general_dir"], settings["reference_dir"],
+                            "parsedKIR.fa")
+    elif database_name.startswith("parsedhla.fa"):
+        return os.path.join(settings["dat_path"], settings["general_dir"], settings["reference_dir"],
+                            "parsedhla.fa")
+    log.error(f"Unknown reference file (in closestallele.py): {database}")
+    return database
+
+
+def get_hit_name(alignment, target_family):
+    """returns the name of the reference allele of a BLAST hit
+    """
+    hit_name = alignment.hit_def
+    if hit_name.find(target_family) == -1:
+        if not (hit_name.startswith("MIC") and target_family == "HLA"):
+            hit_name = alignment.hit_id
+    return hit_name
+
+
+def read_top_hits(blast_filename, target_family, settings, log):
+    """reads the first HSP of the top hit of each query from a BLAST output file (XML or compact)
+
+    :return: dict of format {query_id: AlignedHit}; None for queries without hit or with a hit on the minus strand
+    """
+    top_hits = {}
+    query_sequences = None
+    with open(blast_filename) as f:
+        records = parse_blast_table(f) if blast_filename.endswith(BLAST_TABLE_EXT) else NCBIXML.parse(f)
+        for record in records:
+            top_hits[record.query_id] = None
+            if not record.alignments:
+                continue
+            alignment = record.alignments[0]
+            hsp = alignment.hsps[0]
+            if hsp.sbjct_start > hsp.sbjct_end:
+                continue
+            hit_name = get_hit_name(alignment, target_family)
+            ref_sequence = read_reference_sequence(get_reference_fasta(record.database, settings, log), hit_name, log)
+            if isinstance(hsp, CompactHsp):
+                if query_sequences is None:
+                    query_sequences = SeqIO.to_dict(SeqIO.parse(get_query_fasta_file(blast_filename), "fasta"))
+                hsp.expand(ref_sequence, query_sequences[record.query_id].seq)
+            top_hits[record.query_id] = AlignedHit(hit_name, len(ref_sequence), hsp.query_start, hsp.sbjct_start,
+                                                   hsp.query, hsp.sbjct, record.query_length)
+    return top_hits
+
+
 def print_me(hsp_query, hsp_subject, hsp_match, concat_HSPs, hsp_start, hsp_align_len, query_length):
     """little debugging function
     """
@@ -64,18 +293,11 @@ def parse_blast(xml_records, target_family, query_fasta_file, settings, log):
     """
 
     closestAlleles = {}
+    query_sequences = None  # read only once
     hsp_start = 1
     for xmlRecord in xml_records:
         queryId = xmlRecord.query_id
-        output_db = xmlRecord.database
-        if output_db.endswith("parsedKIR.fa"):
-            output_db = os.path.join(settings["dat_path"], settings["general_dir"], settings["reference_dir"],
-                                     "parsedKIR.fa")
-        elif output_db.endswith("parsedhla.fa"):
-            output_db = os.path.join(settings["dat_path"], settings["general_dir"], settings["reference_dir"],
-                                     "parsedhla.fa")
-        else:
-            log.error("Unknown reference file (in closestallele.py):", output_db)
+        output_db = get_reference_fasta(xmlRecord.database, settings, log)
         alignments = xmlRecord.alignments
         queryLength = xmlRecord.query_length
         if not alignments:
@@ -86,15 +308,10 @@ def parse_blast(xml_records, target_family, query_fasta_file, settings, log):
         potentialClosestAlleleAlignment = alignments[0]
         hsps = potentialClosestAlleleAlignment.hsps
 
-        closestAlleleName = potentialClosestAlleleAlignment.hit_def
-        if closestAlleleName.find(target_family) == -1:
-            if closestAlleleName.startswith("MIC") and target_family == "HLA":
-                pass
-            else:
-                closestAlleleName = potentialClosestAlleleAlignment.hit_id
+        closestAlleleName = get_hit_name(potentialClosestAlleleAlignment, target_family)
 
         try:
-            ref_sequence = SeqIO.to_dict(SeqIO.parse(output_db, "fasta"))[closestAlleleName].seq
+            ref_sequence = read_reference_sequence(output_db, closestAlleleName, log)
         except KeyError:
             local_name = os.path.splitext(os.path.basename(query_fasta_file))[0]
             msg = f"Could not find {closestAlleleName} in current reference db!\n" \
@@ -103,7 +320,11 @@ def parse_blast(xml_records, target_family, query_fasta_file, settings, log):
                   f"Please consult the user manual under 'Error: database changed between submissions' " \
                   f"for instructions how to proceed from here."
             raise KeyError(msg)
-        query_sequence = SeqIO.to_dict(SeqIO.parse(query_fasta_file, "fasta"))[queryId].seq
+        if query_sequences is None:
+            query_sequences = SeqIO.to_dict(SeqIO.parse(query_fasta_file, "fasta"))
+        query_sequence = query_sequences[queryId].seq
+        if isinstance(hsps[0], CompactHsp):
+            hsps[0].expand(ref_sequence, query_sequence)
         results = puzzle_HSPs_from_first_hit(hsps, ref_sequence, query_sequence, query_fasta_file)
         hsp_query, hsp_subject, hsp_match, concatHSPS, hsp_start, hsp_align_len = results
         query_start_overhang = 0
@@ -149,6 +370,28 @@ def make_global_alignment(ref_seq, query_seq, log):
     return alignments
 
 
+def align_start_region(ref_seq, query_seq, hsp_start, hsp_query, log):
+    """aligns only the start region of query and reference sequence instead of the complete sequences:
+    the query bases before the HSP plus its first END_WINDOW bases,
+    against the reference bases before the HSP start (at most END_BAND more than the query bases)
+    plus END_WINDOW + END_BAND bases of the HSP;
+    same scoring as make_global_alignment, the first optimal alignment is used
+
+    :return: (first aligned position of the reference, first aligned position of the query) (both 0-based),
+             or None if no alignment was found
+    """
+    hsp_query_bases = hsp_query.replace("-", "")[:END_WINDOW]
+    query_to = max(query_seq.find(hsp_query_bases), 0) + len(hsp_query_bases)
+    ref_from = max(0, hsp_start - 1 - (query_to - len(hsp_query_bases)) - END_BAND)
+    ref_to = hsp_start - 1 + END_WINDOW + END_BAND
+    alignments = make_global_alignment(ref_seq[ref_from:ref_to], query_seq[:query_to], log)
+    try:
+        a = alignments[0]
+    except IndexError:
+        return None
+    return ref_from + int(a.aligned[0][0][0]), int(a.aligned[1][0][0])
+
+
 def remove_end_gaps(ref, matched, query):
     """
     removes end gaps ('-'-characters on the right side) from an alignment incl. its sequences
@@ -163,21 +406,14 @@ def remove_end_gaps(ref, matched, query):
 
 def fix_incomplete_alignment(ref_seq, query_seq, hsp_start, hsp_align_len, query_length,
                              hsp_query, hsp_subject, hsp_match, closest_allele_name, log):
-    alignments = make_global_alignment(ref_seq, query_seq, log)
-    log.debug(f"=> found {len(alignments)} alignments")
-    if not alignments:
+    start_region = align_start_region(ref_seq, query_seq, hsp_start, hsp_query, log)
+    if not start_region:
         log.error("No alignment found, sorry! Aborting...")
         return hsp_query, hsp_subject, hsp_match, hsp_align_len, hsp_start, None
-    if len(alignments) > 1:
-        log.warning(f"Found {len(alignments)} possible alignments, choosing one at random (might not be the best one)!")
-
-    a = alignments[0]
 
-    log.info("Adding info from global alignment to local alignment...")
+    log.info("Adding info from start region alignment to local alignment...")
     # find alignment positions:
-    aligned_query = a.aligned[0]
-    q_start = aligned_query[0][0]
-    query_start_overhang = a.aligned[1][0][0]  # relevant if query has longer 5' UTR than reference
+    (q_start, query_start_overhang) = start_region  # overhang: relevant if query has longer 5' UTR than reference
 
     # fix alignments:
 
@@ -296,22 +532,31 @@ def fix_incomplete_alignment(ref_seq, query_seq, hsp_start, hsp_align_len, query
 def closest_allele_items(hsp_query, hsp_subject, hsp_match, closest_allele_name, concat_HSPs, hsp_start, hsp_align_len,
                          query_length, query_start_overhang):
     # "-" in the query means a deletion, "-" in the hit means an insertion, a gap in the alignment is a mismatch
-    deletionPositions = [pos + 1 for pos in range(len(hsp_query)) if hsp_query[pos] == "-"]
-    insertionPositions = [pos + 1 for pos in range(len(hsp_subject)) if hsp_subject[pos] == "-"]
-    mismatchPositions = [pos + 1 for pos in range(len(hsp_match)) if ((hsp_match[pos] == " ")
-                                                                      and ((pos + 1) not in deletionPositions) and (
-                                                                              (pos + 1) not in insertionPositions))]
+    # (compared as byte arrays, all positions are 1-based)
+    query = np.frombuffer(str(hsp_query).encode(), dtype=np.uint8)
+    subject = np.frombuffer(str(hsp_subject).encode(), dtype=np.uint8)
+    is_deletion = query == ord("-")
+    is_insertion = subject == ord("-")
+    is_mismatch = np.frombuffer(str(hsp_match).encode(), dtype=np.uint8) == ord(" ")
+    is_mismatch[:len(is_deletion)] &= ~is_deletion[:len(is_mismatch)]
+    is_mismatch[:len(is_insertion)] &= ~is_insertion[:len(is_mismatch)]
+
+    deletion_indices = np.flatnonzero(is_deletion)
+    insertion_indices = np.flatnonzero(is_insertion)
+    mismatch_indices = np.flatnonzero(is_mismatch)
+    deletionPositions = (deletion_indices + 1).tolist()
+    insertionPositions = (insertion_indices + 1).tolist()
+    mismatchPositions = (mismatch_indices + 1).tolist()
     # bases
-    deletions = [hsp_subject[deletionPos - 1] for deletionPos in deletionPositions]
-    insertions = [hsp_query[insertionPos - 1] for insertionPos in insertionPositions]
+    deletions = list(subject[deletion_indices].tobytes().decode())
+    insertions = list(query[insertion_indices].tobytes().decode())
 
     if not (len(deletionPositions) or len(insertionPositions) or len(mismatchPositions)):
         exactMatch = True
     else:
         exactMatch = False
 
-    mismatches = list(zip([hsp_query[mismatchPos - 1] for mismatchPos in mismatchPositions],
-                          [hsp_subject[mismatchPos - 1] for mismatchPos in mismatchPositions]))
+    mismatches = list(zip(query[mismatch_indices].tobytes().decode(), subject[mismatch_indices].tobytes().decode()))
 
     # catch cases with undetected mismatches near end: (BLAST misses these)
     if hsp_align_len < query_length:  # if not whole of query sequence could be aligned
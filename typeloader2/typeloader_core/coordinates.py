@@ -8,11 +8,17 @@ import re
 import os
 from Bio import SeqIO
 from collections import defaultdict
-from .closestallele import get_closest_known_alleles
-from .hla_embl_parser import read_dat_file
+from .closestallele import get_closest_known_alleles, get_query_fasta_file
+from .reference_index import read_alleles, read_gene_model
+from .hla_embl_parser import make_gene_model, get_codons, get_num_workers
+from .reference_cache import reference_cache
+from . import result_cache
+from .update_reference import reference_lock
 from .imgtTransform import changeToImgtCoords
 from .errors import MissingUTRError, IncompleteSequenceWarning
 
+from bisect import bisect_left, bisect_right
+from concurrent.futures import ProcessPoolExecutor
 from copy import copy
 from math import ceil, floor
 from pickle import load
@@ -30,7 +36,10 @@ def getSpecificCodonChords(closestallele, exon1Length):
     return numExon1Coords
 
 
-def getMismatchData(annotations):
+def getMismatchData(annotations, gene_model=None):
+    """returns the codons affected by each mismatch (empty tuple for non-CDS positions);
+    gene_model: the gene model of the closest allele (see reference_index.read_gene_model), if known
+    """
 
     cdsMap = annotations["cdsMap"]
     query_start_overhang = annotations["queryStartOverhang"]
@@ -54,6 +63,26 @@ def getMismatchData(annotations):
     exon1Length = cdsExonCoords[0][1]
     numExon1Coords = getSpecificCodonChords(closestallele, exon1Length)
 
+    # codons of both sequences (the codons of the closest allele are precomputed with its gene model):
+    closestAlleleCodons = gene_model["codons"] if gene_model else get_codons(closestAlleleCdsSeq)
+    cdsCodonHash, closestAlleleCodonHash = {}, {}
+    startPos = 0
+    for index in range(1, (len(cdsSeq) // 3) + 1):
+        cdsCodonHash[index] = cdsSeq[startPos:startPos + 3]
+        closestAlleleCodonHash[index] = closestAlleleCodons[index - 1] if index <= len(closestAlleleCodons) else ""
+        startPos += 3
+    len_dif = len(closestAlleleCdsSeq) - len(cdsSeq)
+
+    needs_shifting = defaultdict(lambda: 0)
+    if len_dif > 2: # target allele contains deletion => cdsSeq does not align with complete reference seq
+        startPos = len(cdsSeq) + 3
+        for index in range(len(cdsSeq)//3 + 1, len(closestAlleleCdsSeq)//3 + 1):
+            cdsCodonHash[index] = cdsSeq[-3:]
+            mycodon = closestAlleleCdsSeq[startPos:startPos+3]
+            closestAlleleCodonHash[index] = mycodon
+            startPos += 3
+            needs_shifting[index] = 1
+
     for mmIndex in range(len(annotations["differences"]["mismatches"])):
         genomicPos = annotations["differences"]["mismatchPositions"][mmIndex]
         cdsPos = annotations["imgtDifferences_orig"]["mismatchPositions"][mmIndex][0]
@@ -104,24 +133,6 @@ def getMismatchData(annotations):
             actualCodonSeq, closestCodonSeq = cdsSeq[cdsPos - 2 : cdsPos + 1], closestAlleleCdsSeq[cdsPos - 2  : cdsPos + 1]
         """
 
-        cdsCodonHash, closestAlleleCodonHash = {},{}
-        startPos = 0
-
-        for index in range(1,(len(cdsSeq)//3) + 1):
-            cdsCodonHash[index] = cdsSeq[startPos:startPos+3]
-            closestAlleleCodonHash[index] = closestAlleleCdsSeq[startPos:startPos+3]
-            startPos += 3
-        len_dif = len(closestAlleleCdsSeq) - len(cdsSeq)
-        
-        needs_shifting = defaultdict(lambda: 0)
-        if len_dif > 2: # target allele contains deletion => cdsSeq does not align with complete reference seq
-            startPos = len(cdsSeq) + 3
-            for index in range(len(cdsSeq)//3 + 1, len(closestAlleleCdsSeq)//3 + 1):
-                cdsCodonHash[index] = cdsSeq[-3:]
-                mycodon = closestAlleleCdsSeq[startPos:startPos+3]
-                closestAlleleCodonHash[index] = mycodon
-                startPos += 3
-                needs_shifting[index] = 1
         try:
             if cdsCodonHash[canonicalMMCodonNum] != closestAlleleCodonHash[canonicalMMCodonNum]:
                 mmCodons.append((imgtMMCodonNum,(cdsCodonHash[canonicalMMCodonNum], closestAlleleCodonHash[canonicalMMCodonNum - needs_shifting[canonicalMMCodonNum]])))
@@ -135,50 +146,155 @@ def getMismatchData(annotations):
     return mmCodons
 
 
-def getCoordinates(blastXmlFilename, allelesFilename, targetFamily, settings, log, isENA=True,
-                   incomplete_ok=False):
+def get_alleles_file(allelesFilename, settings):
+    """returns the reference .dat file to read the closest alleles from
+    (always the one of the complete reference, also for BLAST runs against restricted databases)
+    """
     if "restricted_db" in allelesFilename:
         allelesFilename = os.path.join(settings["root_path"], settings["general_dir"],
                                        settings["reference_dir"],
                                        os.path.basename(allelesFilename))
-    allAlleles, _ = read_dat_file(allelesFilename, targetFamily, isENA)
-    closestAlleles = get_closest_known_alleles(blastXmlFilename, targetFamily, settings, log)
-    seqsFile = blastXmlFilename.replace(".blast.xml", ".fa")
+    return allelesFilename
+
+
+def read_query_sequences(blastXmlFilename):
+    """returns the query fasta file belonging to a BLAST output file
+    and its sequences (dict of format {query_id: SeqRecord})
+    """
+    seqsFile = get_query_fasta_file(blastXmlFilename)
 
     try: 
         seqsHandle = open(seqsFile)
     except IOError:
-        seqsFile = blastXmlFilename.replace(".blast.xml",".fasta")
+        seqsFile = os.path.splitext(seqsFile)[0] + ".fasta"
         seqsHandle = open(seqsFile)
 
     seqsHash = SeqIO.to_dict(SeqIO.parse(seqsHandle, "fasta"))
-    annotations = processAlleles(closestAlleles, allAlleles, seqsHash, incomplete_ok)
-    # for cell_line in annotations:
-    #     for key in annotations[cell_line]:
-    #         item = annotations[cell_line][key]
-    #         if isinstance(item, dict):
-    #             print("'{}' : {}".format(key, "{"))
-    #             for key2 in item:
-    #                 print("\t'{}' : {}".format(key2, item[key2]))
-    #             print("\t}")
-    #         else:
-    #             if key == 'closestAlleleSequence':
-    #                 print("'{}' : {}...".format(key, annotations[cell_line][key][:20]))
-    #             else:
-    #                 print("'{}' : {}".format(key, annotations[cell_line][key]))
+    seqsHandle.close()
+    return seqsFile, seqsHash
+
+
+def annotateQueries(closestAlleles, allAlleles, seqsHash, incomplete_ok, geneModels):
+    """annotates the query sequences of one BLAST output file based on their closest alleles
+    (including the sequences and the mismatching codons)
+    """
+    annotations = processAlleles(closestAlleles, allAlleles, seqsHash, incomplete_ok, geneModels)
 
     for gendxAllele in list(annotations.keys()):
         if not annotations[gendxAllele]:
             continue
         alleleSeq = str(seqsHash[gendxAllele].seq)
         annotations[gendxAllele]["sequence"] = alleleSeq
-        annotations[gendxAllele]["imgtDifferences"]["mmCodons"] = getMismatchData(annotations[gendxAllele])
-        
-    seqsHandle.close()
+        annotations[gendxAllele]["imgtDifferences"]["mmCodons"] = \
+            getMismatchData(annotations[gendxAllele], geneModels.get(annotations[gendxAllele]["closestAllele"]))
+    return annotations
+
 
+def getCoordinates(blastXmlFilename, allelesFilename, targetFamily, settings, log, isENA=True,
+                   incomplete_ok=False):
+    [annotations] = getCoordinates_batch([(blastXmlFilename, allelesFilename, targetFamily)], settings, log,
+                                         incomplete_ok)
+    if isinstance(annotations, Exception):
+        raise annotations
     return annotations
 
 
+def getCoordinates_batch(items, settings, log, incomplete_ok=False, workers=1):
+    """annotates the query sequences of many BLAST output files,
+    reading the needed alleles of each reference only once;
+    errors are returned instead of raised, so one bad allele does not abort the batch
+
+    :param items: list of (blastXmlFilename, allelesFilename, targetFamily)
+    :param workers: number of processes used for annotating (0 = use all available cores)
+    :return: list of annotations (see getCoordinates) or Exception, in the order of items
+    """
+    results = [None] * len(items)
+    jobs = {}  # item index => (blastXmlFilename, allelesFilename, targetFamily, seqsFile, seqsHash, cache_keys,
+    #                            closestAlleles)
+    closestAlleleNames = defaultdict(set)  # (allelesFilename, targetFamily) => names of closest alleles
+    references = {}  # (allelesFilename, targetFamily) => (alleles, gene models) or Exception
+
+    with reference_lock:  # reference files must not be replaced while reading them
+        for (i, (blastXmlFilename, allelesFilename, targetFamily)) in enumerate(items):
+            try:
+                allelesFilename = get_alleles_file(allelesFilename, settings)
+                (seqsFile, seqsHash) = read_query_sequences(blastXmlFilename)
+                annotations = result_cache.load_sample_annotations(blastXmlFilename, seqsFile, targetFamily,
+                                                                   allelesFilename, incomplete_ok, settings, log)
+                if annotations:
+                    results[i] = annotations
+                    continue
+                cache_keys = result_cache.get_annotation_keys(blastXmlFilename, seqsHash, targetFamily,
+                                                              allelesFilename, incomplete_ok, settings, log)
+                annotations = result_cache.load_annotations(cache_keys, settings, log)
+                if annotations:
+                    result_cache.store_sample_annotations(blastXmlFilename, seqsFile, targetFamily, allelesFilename,
+                                                          incomplete_ok, annotations, settings, log)
+                    results[i] = annotations
+                    continue
+                closestAlleles = get_closest_known_alleles(blastXmlFilename, targetFamily, settings, log)
+            except Exception as E:
+                results[i] = E
+                continue
+            jobs[i] = (blastXmlFilename, allelesFilename, targetFamily, seqsFile, seqsHash, cache_keys,
+                       closestAlleles)
+            # only parse the reference records actually needed:
+            closestAlleleNames[(allelesFilename, targetFamily)].update(
+                closestAlleles[query]["name"] for query in closestAlleles if closestAlleles[query])
+
+        for ((allelesFilename, targetFamily), alleleNames) in closestAlleleNames.items():
+            try:
+                allAlleles = read_alleles(allelesFilename, targetFamily, alleleNames, log)
+                geneModels = {alleleName: read_gene_model(allelesFilename, targetFamily, allele, log)
+                              for (alleleName, allele) in allAlleles.items()}
+            except Exception as E:
+                references[(allelesFilename, targetFamily)] = E
+                continue
+            references[(allelesFilename, targetFamily)] = (allAlleles, geneModels)
+
+    annotation_args = {}  # item index => arguments of annotateQueries
+    for (i, (_, allelesFilename, targetFamily, _, seqsHash, _, closestAlleles)) in jobs.items():
+        reference = references[(allelesFilename, targetFamily)]
+        if isinstance(reference, Exception):
+            results[i] = reference
+            continue
+        (allAlleles, geneModels) = reference
+        alleleNames = {closestAlleles[query]["name"] for query in closestAlleles if closestAlleles[query]}
+        annotation_args[i] = ({closestAllele: allAlleles[closestAllele]
+                               for closestAllele in alleleNames if closestAllele in allAlleles},
+                              seqsHash, closestAlleles,
+                              {closestAllele: geneModels[closestAllele]
+                               for closestAllele in alleleNames if closestAllele in geneModels})
+
+    workers = min(get_num_workers(workers), len(annotation_args))
+    if workers > 1:
+        log.debug(f"\tAnnotating {len(annotation_args)} BLAST results with {workers} processes...")
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {i: executor.submit(annotateQueries, closestAlleles, alleles, seqsHash, incomplete_ok, models)
+                       for (i, (alleles, seqsHash, closestAlleles, models)) in annotation_args.items()}
+            for (i, future) in futures.items():
+                try:
+                    results[i] = future.result()
+                except Exception as E:
+                    results[i] = E
+    else:
+        for (i, (alleles, seqsHash, closestAlleles, models)) in annotation_args.items():
+            try:
+                results[i] = annotateQueries(closestAlleles, alleles, seqsHash, incomplete_ok, models)
+            except Exception as E:
+                results[i] = E
+
+    for (i, (blastXmlFilename, allelesFilename, targetFamily, seqsFile, _, cache_keys, _)) in jobs.items():
+        if isinstance(results[i], Exception):
+            continue
+        result_cache.store_annotations(cache_keys, results[i], settings, log)
+        result_cache.store_sample_annotations(blastXmlFilename, seqsFile, targetFamily, allelesFilename,
+                                              incomplete_ok, results[i], settings, log)
+    reference_cache.report(log)
+
+    return results
+
+
 def shift_coordinates_for_missing_bp(missing_bp, coordinates):
     """if part of UTR5 is missing, shift coordinates in 5' direction 
     """
@@ -272,7 +388,10 @@ def shift_differences_for_missing_bp(missing_bp, differences, imgtDifferences, c
     return new_differences, new_imgtDifferences
 
 
-def processAlleles(closestAlleles, allAlleles, hashOfQuerySequences, incomplete_ok = False):
+def processAlleles(closestAlleles, allAlleles, hashOfQuerySequences, incomplete_ok = False, geneModels = None):
+    """annotates the query sequences based on their closest alleles;
+    geneModels: dict of format {allele name: gene model (see reference_index.read_gene_model)}, if known
+    """
 
     annotations = {}
     for alleleQuery in list(closestAlleles.keys()):
@@ -291,7 +410,8 @@ def processAlleles(closestAlleles, allAlleles, hashOfQuerySequences, incomplete_
 
         features, coordinates, extraInformation, closestAlleleCdsSequence, \
             closestAlleleSequence = calculateCoordinates(closestAlleleName, allAlleles, differences,
-                                                        len(hashOfQuerySequences[alleleQuery]), missing_bp)
+                                                        len(hashOfQuerySequences[alleleQuery]), missing_bp,
+                                                        (geneModels or {}).get(closestAlleleName))
         
         coordinates = shift_coordinates_for_missing_bp(missing_bp, coordinates)
         
@@ -323,125 +443,54 @@ def processAlleles(closestAlleles, allAlleles, hashOfQuerySequences, incomplete_
         
     return annotations
 
-def getClosestAlleleCoordinates(alleleData, queryLength):
-
-    features = []
-    coordinates = []
-    exonIds = []
-    extraInformation = {"pseudoexon":{}, "exon_number":{}, "intron_number":{}}
-    closestAlleleCdsSequence = ""
-    closestAlleleSequence = ""
-
-    if "utr5" in alleleData.utrpos_dic:
-        features.append("utr5")
-        coordinates.append((alleleData.utrpos_dic["utr5"][0] + 1, alleleData.utrpos_dic["utr5"][1]))
-
-    for exon, pseudoexon in alleleData.pseudo_exon_dic.items():
-        extraInformation["pseudoexon"][exon] = pseudoexon
-    for exon, exon_number in alleleData.exon_num_dic.items():
-        extraInformation["exon_number"][exon] = exon_number
-    for intron, intron_number in alleleData.intron_num_dic.items():
-        extraInformation["intron_number"][intron] = intron_number
-
-    #exonIds = [(exonNumber,"e") for exonNumber in alleleData.exonpos_dic.keys()]
-    for exonNumber in list(alleleData.exonpos_dic.keys()):
-        if extraInformation["pseudoexon"][exonNumber]:
-            exonIds.append((exonNumber, "epseudo"))
-        else:
-            exonIds.append((exonNumber, "e"))
-
-    intronIds = [(intronNumber, "i") for intronNumber in list(alleleData.intronpos_dic.keys())]
-
-    cdsIds = copy(exonIds)
-    cdsIds.extend(intronIds)
-    cdsIds.sort()
-    features.extend(cdsIds)
-
-    for cdsId in cdsIds:
-        if cdsId[1] == "e":
-            coordinates.append((alleleData.exonpos_dic[cdsId[0]][0] + 1, alleleData.exonpos_dic[cdsId[0]][1]))
-            closestAlleleCdsSequence += alleleData.seq[alleleData.exonpos_dic[cdsId[0]][0]:alleleData.exonpos_dic[cdsId[0]][1]]
-        elif cdsId[1] == "epseudo":
-            coordinates.append((alleleData.exonpos_dic[cdsId[0]][0] + 1, alleleData.exonpos_dic[cdsId[0]][1]))
-        else: coordinates.append((alleleData.intronpos_dic[cdsId[0]][0] + 1, alleleData.intronpos_dic[cdsId[0]][1]))
-
-    if "utr3" in alleleData.utrpos_dic:
-        features.append("utr3")
-        coordinates.append((alleleData.utrpos_dic["utr3"][0] + 1, queryLength))
-
-    closestAlleleSequence = alleleData.seq
+def getClosestAlleleCoordinates(alleleData, queryLength, gene_model=None):
+    """returns features, coordinates, extraInformation, CDS sequence and sequence of the closest allele
+    (copied from its gene model, which is created if not given)
+    """
+    if not gene_model:
+        gene_model = make_gene_model(alleleData)
+    features = list(gene_model["features"])
+    coordinates = list(gene_model["coordinates"])  # modified by calculateCoordinates
+    if features and features[-1] == "utr3":
+        coordinates[-1] = (coordinates[-1][0], queryLength)
+    extraInformation = {key: dict(value) for (key, value) in gene_model["extraInformation"].items()}
 
-    return (features, coordinates, extraInformation, closestAlleleCdsSequence, closestAlleleSequence)
+    return (features, coordinates, extraInformation, gene_model["cdsSequence"], alleleData.seq)
 
-def calculateCoordinates(alleleName, alleles, differences, queryLength, missing_bp):
+def calculateCoordinates(alleleName, alleles, differences, queryLength, missing_bp, gene_model=None):
 
     allele = alleles[alleleName]
     features, coordinates, extraInformation, closestAlleleCdsSequence, \
-        closestAlleleSequence = getClosestAlleleCoordinates(allele, queryLength)
+        closestAlleleSequence = getClosestAlleleCoordinates(allele, queryLength, gene_model)
 
     #features = ['utr5', (1, 'e'), (1, 'i'), (2, 'e'), (2, 'i'), ... , 'utr3']
     #coordinates = [(1, 267), ... , (10737, 10561)]
 
-    insertions, deletions, mismatches = differences["insertionPositions"], differences["deletionPositions"], \
-                                        differences["mismatchPositions"]
-    
-    # shift positions to alignment if missing_bp:
-    myinsertions = [pos + missing_bp for pos in insertions]
-    mydeletions = [pos + missing_bp for pos in deletions]
-    mymismatches = [pos + missing_bp for pos in mismatches]
+    # shift positions to alignment if missing_bp (sorted, to count them per feature by bisection):
+    myinsertions = sorted(pos + missing_bp for pos in differences["insertionPositions"])
+    mydeletions = sorted(pos + missing_bp for pos in differences["deletionPositions"])
 
     """
-    The logic for assigning the co-ordinates for the new allele is quite complex. The steps are listed below :
-
-    1. Iterate through the gene model features
-    2. For each feature, check the number of insertions and deletions that lie within that feature
-    3. (numInsertions - numDeletions) will be the change in the 3' end of that feature, even if an insertion or deletion is at the boundary
-    4. If there are mismatches within that region, these are checked individually if they are before or after an insertion or deletion and changes made
-    5. Every feature following that feature has its boundaries changed by (numInsertions - numDeletions)
-    6. Every mismatch in every following feature is also changed by (numInsertions - numDeletions)
-
-    Note : We take advantage of the fact that a list is mutable, but have to keep in mind tuples are not
+    The coordinates of the new allele are calculated from the gene model of the closest allele:
+
+    1. Iterate through the gene model features; their boundaries are shifted by the summed size change
+       of all preceding features (offset)
+    2. For each feature, count the insertions and deletions that lie within the shifted feature
+       (positions are sorted => two bisections per feature)
+    3. (numInsertions - numDeletions) will be the change in the 3' end of that feature, even if an insertion or deletion
+       is at the boundary, and is added to the offset of all following features
+    4. Only the start of the 3' UTR is shifted; its end is the sequence length
     """
 
-    #Step 1
-    for coordIndex in range(len(coordinates)):
-        #Step 2
-        regionBegin, regionEnd = coordinates[coordIndex]
-        regionInsertions = [insertion for insertion in myinsertions if ((insertion >= regionBegin) and (insertion <= regionEnd))]
-        regionDeletions = [deletion for deletion in mydeletions if ((deletion >= regionBegin) and (deletion <= regionEnd))]
-
-
-        coordChange = len(regionInsertions) - len(regionDeletions)
-        if not coordChange: continue
-
-        # Step 3
-        if coordIndex != len(coordinates) - 1:
-            coordinates[coordIndex] = (coordinates[coordIndex][0], coordinates[coordIndex][1]+coordChange)
-        else:
-            # no position pushing in the last iteration has to be done
-            # start of 3' UTR was pushed already in step5, if there are insertions/deletions
-            # end of 3' UTR = sequence length
-            coordinates[coordIndex] = (coordinates[coordIndex][0], coordinates[coordIndex][1])
-
-        #Step 4
-        for mismatchIndex in range(len(mymismatches)):
-            mismatch = mymismatches[mismatchIndex]
-            if (mismatch >= regionBegin) and (mismatch <= regionEnd):
-                for regionInsertion in regionInsertions:
-                    if mismatch > regionInsertion: mymismatches[mismatchIndex] += 1
-                for regionDeletion in regionDeletions:
-                    if mismatch > regionDeletion: mymismatches[mismatchIndex] -= 1
-            #Step 6
-            if mismatch > regionEnd:
-                mymismatches[mismatchIndex] += coordChange
-
-        #Step 5
-        for nextFeatureIndex in range(coordIndex + 1, len(coordinates)):
-            translated_region = (coordinates[nextFeatureIndex][0] + coordChange, coordinates[nextFeatureIndex][1] + coordChange)
-            utr_end = coordinates[nextFeatureIndex] = (coordinates[nextFeatureIndex][0] + coordChange, coordinates[nextFeatureIndex][1])
-            # push only the start of 3' UTR, if there are insertions/deletions
-            # no entry if coordIndex + 1 = len(coordinates), see Step 3
-            coordinates[nextFeatureIndex] = translated_region if nextFeatureIndex != len(coordinates) - 1 else utr_end
+    offset = 0
+    for coordIndex in range(len(coordinates) - 1):
+        regionBegin, regionEnd = coordinates[coordIndex][0] + offset, coordinates[coordIndex][1] + offset
+        numInsertions = bisect_right(myinsertions, regionEnd) - bisect_left(myinsertions, regionBegin)
+        numDeletions = bisect_right(mydeletions, regionEnd) - bisect_left(mydeletions, regionBegin)
+        offset += numInsertions - numDeletions
+        coordinates[coordIndex] = (regionBegin, regionEnd + numInsertions - numDeletions)
+    if coordinates:
+        coordinates[-1] = (coordinates[-1][0] + offset, coordinates[-1][1])
 
     return (features, coordinates, extraInformation, closestAlleleCdsSequence, closestAlleleSequence)
 
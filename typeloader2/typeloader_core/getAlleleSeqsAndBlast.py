@@ -2,9 +2,18 @@
 
 import re
 import os
+import math
+import shutil
+from concurrent.futures import ThreadPoolExecutor
 from subprocess import run, PIPE
 from collections import defaultdict
+from xml.sax.saxutils import escape
 from .EMBLfunctions import fasta_generator
+from .update_reference import reference_lock
+from .closestallele import BLAST_XML_EXT, BLAST_TABLE_EXT, BLAST_TABLE_FIELDS, read_blast_table_blocks, AlignedHit, \
+    read_top_hits
+from .reference_index import find_reference_match, read_reference_sequence
+from . import kmer_search, result_cache, reference_shards
 from .xmlfuncs import *
 
 """
@@ -36,11 +45,29 @@ def getAlleleSequences(xmlFile, log):
     return alleles, data_dic
 
 
+def get_blast_output_format(settings):
+    """returns the BLAST output format chosen in the user settings:
+    XML (5) or compact tabular output with the fields needed by closestallele (7)
+    """
+    if settings.get("blast_output") == "compact":
+        return f"7 {BLAST_TABLE_FIELDS}"
+    return "5"
+
+
+def get_blast_output_file(inputFastaFile, blastOutputFormat="5"):
+    """returns the path of the BLAST output file belonging to a query fasta file
+    """
+    ext = BLAST_TABLE_EXT if blastOutputFormat.startswith("7") else BLAST_XML_EXT
+    return inputFastaFile.replace(".fasta", ext).replace(".fa", ext)
+
+
 def blastSequences(inputFastaFile, parsedFasta, settings, log,
-                   blastOutputFormat="5"):  # 5 corresponds to XML BLAST output
+                   blastOutputFormat=None, num_threads=1):  # 5 corresponds to XML BLAST output
     blast = settings["blast_path"]
     database = parsedFasta
-    blastXmlOutputFile = inputFastaFile.replace(".fasta", ".blast.xml").replace(".fa", ".blast.xml")
+    if not blastOutputFormat:
+        blastOutputFormat = get_blast_output_format(settings)
+    blastXmlOutputFile = get_blast_output_file(inputFastaFile, blastOutputFormat)
     blast_command = [blast,
                      "-query", inputFastaFile,
                      "-parse_deflines",
@@ -49,6 +76,8 @@ def blastSequences(inputFastaFile, parsedFasta, settings, log,
                      "-soft_masking", "false",
                      "-outfmt", blastOutputFormat,
                      "-out", blastXmlOutputFile]
+    if num_threads > 1:
+        blast_command += ["-num_threads", str(num_threads)]
     log.debug("Blast command:")
     log.debug(" ".join(blast_command))
 
@@ -65,6 +94,326 @@ def blastSequences(inputFastaFile, parsedFasta, settings, log,
     return blastXmlOutputFile
 
 
+def split_blast_xml(batch_xml_file, output_files, log):
+    """splits the XML output of a multi-query BLAST run into one XML file per query file,
+    each looking like the output of a BLAST run with this query file alone
+
+    :param batch_xml_file: BLAST XML output (outfmt 5) of the concatenated queries
+    :param output_files: list of (output_file, number of queries), in the order of the queries
+    :param log: logger instance
+    :return: list of the output files written completely
+    """
+    log.debug(f"\tSplitting {batch_xml_file} into {len(output_files)} files...")
+    header = []
+    iteration = []
+    written = []
+    targets = iter(output_files)
+    g = None
+    query_nr = num_queries = 0
+    with open(batch_xml_file) as f:
+        for line in f:
+            if not header or not header[-1].strip().startswith("<BlastOutput_iterations>"):
+                header.append(line)
+                continue
+            if not iteration and not line.strip().startswith("<Iteration>"):
+                continue  # end of the iterations
+            iteration.append(line)
+            if not line.strip().startswith("</Iteration>"):
+                continue
+
+            if g is None:  # first query of the next output file
+                (output_file, num_queries) = next(targets)
+                query_nr = 0
+                g = open(output_file, "w")
+            query_nr += 1
+            text = "".join(iteration)
+            text = re.sub(r"<Iteration_iter-num>\d+<", f"<Iteration_iter-num>{query_nr}<", text)
+            text = re.sub(r"<Iteration_query-ID>Query_\d+<", f"<Iteration_query-ID>Query_{query_nr}<", text)
+            if query_nr == 1:  # the header describes the first query
+                query_data = dict(re.findall(r"<Iteration_(query-ID|query-def|query-len)>(.*)</Iteration_", text))
+                for header_line in header:
+                    g.write(re.sub(r"<BlastOutput_(query-ID|query-def|query-len)>.*</BlastOutput_",
+                                   lambda m: f"<BlastOutput_{m.group(1)}>{query_data.get(m.group(1), '')}"
+                                             f"</BlastOutput_", header_line))
+            g.write(text)
+            iteration = []
+            if query_nr == num_queries:
+                g.write("</BlastOutput_iterations>\n</BlastOutput>\n")
+                g.close()
+                g = None
+                written.append(output_file)
+    if g is not None:  # batch output ended early
+        g.close()
+    return written
+
+
+def split_blast_table(batch_table_file, output_files, log):
+    """splits the compact output of a multi-query BLAST run into one file per query file,
+    each looking like the output of a BLAST run with this query file alone
+
+    :param batch_table_file: compact BLAST output (-outfmt 7) of the concatenated queries
+    :param output_files: list of (output_file, number of queries), in the order of the queries
+    :param log: logger instance
+    :return: list of the output files written completely
+    """
+    log.debug(f"\tSplitting {batch_table_file} into {len(output_files)} files...")
+    written = []
+    targets = iter(output_files)
+    g = None
+    query_nr = num_queries = 0
+    with open(batch_table_file) as f:
+        for block in read_blast_table_blocks(f):
+            if g is None:  # first query of the next output file
+                (output_file, num_queries) = next(targets)
+                query_nr = 0
+                g = open(output_file, "w")
+            query_nr += 1
+            g.writelines(block)
+            if query_nr == num_queries:
+                g.write(f"# BLAST processed {num_queries} queries\n")
+                g.close()
+                g = None
+                written.append(output_file)
+    if g is not None:  # batch output ended early
+        g.close()
+    return written
+
+
+def blast_batch(query_files, parsedFasta, settings, log, batch_name="batch"):
+    """BLASTs the sequences of several fasta files against the same reference with a single BLAST run,
+    then splits the results into one BLAST output file per fasta file (named like those of blastSequences)
+
+    :param query_files: list of fasta files
+    :param parsedFasta: path to the reference BLAST database
+    :param settings: the current user's settings (dictionary)
+    :param log: logger instance
+    :param batch_name: name of the temporary multi-query fasta file (in settings["temp_dir"])
+    :return: dict of format {query_file: BLAST output file}; query files without result are left out
+    """
+    batch_fasta = os.path.join(settings["temp_dir"], f"{batch_name}.fa")
+    blast_format = get_blast_output_format(settings)
+    output_files = {}  # query_file => (BLAST output file, number of queries)
+    log.debug(f"\tWriting {len(query_files)} query files to {batch_fasta}...")
+    with open(batch_fasta, "w") as g:
+        for query_file in query_files:
+            records = list(fasta_generator(query_file))
+            for (header, seq) in records:
+                g.write(f">{header}\n{seq}\n")
+            if records:
+                output_files[query_file] = (get_blast_output_file(query_file, blast_format), len(records))
+
+    num_threads = min(len(output_files), os.cpu_count() or 1)
+    results = {}
+    try:
+        batch_xml_file = blastSequences(batch_fasta, parsedFasta, settings, log, blast_format,
+                                        num_threads=num_threads)
+        if batch_xml_file:
+            if batch_xml_file.endswith(BLAST_TABLE_EXT):
+                written = set(split_blast_table(batch_xml_file, list(output_files.values()), log))
+            else:
+                written = set(split_blast_xml(batch_xml_file, list(output_files.values()), log))
+            results = {query_file: xml_file for (query_file, (xml_file, _)) in output_files.items()
+                       if xml_file in written}
+            os.remove(batch_xml_file)
+    finally:
+        os.remove(batch_fasta)
+    log.debug(f"\t=> {len(results)} of {len(query_files)} query files BLASTed")
+    return results
+
+
+def write_blast_output(fastaFilename, parsedFasta, hits, settings, log):
+    """writes alignments found without BLAST as BLAST output in the chosen output format,
+    so they can be processed like the results of a BLAST run
+
+    :param hits: list of (fasta header, closestallele.AlignedHit) per query
+    :return: path of the written output file
+    """
+    blast_format = get_blast_output_format(settings)
+    output_file = get_blast_output_file(fastaFilename, blast_format)
+    log.debug(f"\tWriting BLAST output to {output_file}...")
+    with open(output_file, "w") as g:
+        if output_file.endswith(BLAST_TABLE_EXT):
+            for (header, hit) in hits:
+                g.write(f"# BLASTN (TypeLoader)\n# Query: {header}\n# Database: {parsedFasta}\n"
+                        f"# Fields: {BLAST_TABLE_FIELDS}\n# 1 hits found\n")
+                values = [header.split()[0], hit.name, hit.query_length, hit.query_from, hit.hit_from, hit.hit_to,
+                          hit.align_length, hit.btop, hit.name]
+                g.write("\t".join(str(value) for value in values) + "\n")
+            g.write(f"# BLAST processed {len(hits)} queries\n")
+            return output_file
+
+        iterations = []
+        for (i, (header, hit)) in enumerate(hits):
+            (query_id, _, query_def) = header.partition(" ")
+            query_def = query_def.strip() or "No definition line"
+            bit_score = (1.28 * hit.score + math.log(1 / 0.46)) / math.log(2)  # reward 1, penalty -2
+            iterations.append(f"""<Iteration>
+  <Iteration_iter-num>{i + 1}</Iteration_iter-num>
+  <Iteration_query-ID>{escape(query_id)}</Iteration_query-ID>
+  <Iteration_query-def>{escape(query_def)}</Iteration_query-def>
+  <Iteration_query-len>{hit.query_length}</Iteration_query-len>
+<Iteration_hits>
+<Hit>
+  <Hit_num>1</Hit_num>
+  <Hit_id>{escape(hit.name)}</Hit_id>
+  <Hit_def>{escape(hit.name)}</Hit_def>
+  <Hit_accession>{escape(hit.name)}</Hit_accession>
+  <Hit_len>{hit.ref_length}</Hit_len>
+  <Hit_hsps>
+    <Hsp>
+      <Hsp_num>1</Hsp_num>
+      <Hsp_bit-score>{bit_score:.3f}</Hsp_bit-score>
+      <Hsp_score>{int(hit.score)}</Hsp_score>
+      <Hsp_evalue>0</Hsp_evalue>
+      <Hsp_query-from>{hit.query_from}</Hsp_query-from>
+      <Hsp_query-to>{hit.query_to}</Hsp_query-to>
+      <Hsp_hit-from>{hit.hit_from}</Hsp_hit-from>
+      <Hsp_hit-to>{hit.hit_to}</Hsp_hit-to>
+      <Hsp_query-frame>1</Hsp_query-frame>
+      <Hsp_hit-frame>1</Hsp_hit-frame>
+      <Hsp_identity>{hit.identities}</Hsp_identity>
+      <Hsp_positive>{hit.identities}</Hsp_positive>
+      <Hsp_gaps>{hit.gaps}</Hsp_gaps>
+      <Hsp_align-len>{hit.align_length}</Hsp_align-len>
+      <Hsp_qseq>{hit.qseq}</Hsp_qseq>
+      <Hsp_hseq>{hit.hseq}</Hsp_hseq>
+      <Hsp_midline>{hit.midline}</Hsp_midline>
+    </Hsp>
+  </Hit_hsps>
+</Hit>
+</Iteration_hits>
+</Iteration>
+""")
+        (header, first_hit) = hits[0]
+        (query_id, _, query_def) = header.partition(" ")
+        g.write(f"""<?xml version="1.0"?>
+<!DOCTYPE BlastOutput PUBLIC "-//NCBI//NCBI BlastOutput/EN" "http://www.ncbi.nlm.nih.gov/dtd/NCBI_BlastOutput.dtd">
+<BlastOutput>
+  <BlastOutput_program>blastn</BlastOutput_program>
+  <BlastOutput_version>BLASTN (TypeLoader)</BlastOutput_version>
+  <BlastOutput_reference></BlastOutput_reference>
+  <BlastOutput_db>{escape(parsedFasta)}</BlastOutput_db>
+  <BlastOutput_query-ID>{escape(query_id)}</BlastOutput_query-ID>
+  <BlastOutput_query-def>{escape(query_def.strip() or "No definition line")}</BlastOutput_query-def>
+  <BlastOutput_query-len>{first_hit.query_length}</BlastOutput_query-len>
+  <BlastOutput_param>
+    <Parameters>
+      <Parameters_expect>10</Parameters_expect>
+      <Parameters_sc-match>1</Parameters_sc-match>
+      <Parameters_sc-mismatch>-2</Parameters_sc-mismatch>
+      <Parameters_gap-open>0</Parameters_gap-open>
+      <Parameters_gap-extend>0</Parameters_gap-extend>
+      <Parameters_filter>F</Parameters_filter>
+    </Parameters>
+  </BlastOutput_param>
+<BlastOutput_iterations>
+{"".join(iterations)}</BlastOutput_iterations>
+</BlastOutput>
+""")
+    return output_file
+
+
+def blast_exact_matches(fastaFilename, parsedFasta, settings, log):
+    """checks whether all sequences of a fasta file are identical to or contained in a reference sequence
+    (e.g., confirmations of known alleles), using the sequence index of the reference;
+    if so, their BLAST output is created directly, without running BLAST
+
+    :return: path of the BLAST output file, or False if BLAST is needed
+    """
+    hits = []
+    try:
+        for (header, seq) in fasta_generator(fastaFilename):
+            match = find_reference_match(parsedFasta, seq, log)
+            if not match:
+                return False
+            (name, start) = match
+            ref_length = len(read_reference_sequence(parsedFasta, name, log))
+            hits.append((header, AlignedHit(name, ref_length, 1, start, seq.upper(), seq.upper(), len(seq))))
+    except Exception as E:  # e.g., reference files missing => BLAST takes care of the error handling
+        log.warning(f"Could not check for exact reference matches: {repr(E)}")
+        return False
+    if not hits:
+        return False
+    for (header, hit) in hits:
+        log.info(f"\t{header.split()[0]} is contained in {hit.name} (from position {hit.hit_from}) => no BLAST needed")
+    return write_blast_output(fastaFilename, parsedFasta, hits, settings, log)
+
+
+def search_without_blast(fastaFilename, parsedFasta, targetFamily, settings, log):
+    """tries to find the closest alleles of all sequences of a fasta file without BLAST:
+    via the sequence index (exact matches), the result cache,
+    then, if the user chose the k-mer engine, via kmer_search
+
+    :return: path of the BLAST output file, or False if BLAST is needed
+    """
+    output_file = blast_exact_matches(fastaFilename, parsedFasta, settings, log)
+    if output_file:
+        return output_file
+    hits = result_cache.load_hits(fastaFilename, parsedFasta, targetFamily, settings, log)
+    if hits:
+        return write_blast_output(fastaFilename, parsedFasta, hits, settings, log)
+    if settings.get("closest_allele_engine", "blast") != "kmer":
+        return False
+    try:
+        hits = kmer_search.search_closest_alleles(fastaFilename, parsedFasta, log)
+    except Exception as E:
+        log.warning(f"K-mer search failed, using BLAST instead: {repr(E)}")
+        return False
+    if not hits:
+        return False
+    output_file = write_blast_output(fastaFilename, parsedFasta, hits, settings, log)
+    result_cache.store_hits(output_file, fastaFilename, parsedFasta, targetFamily, settings, log)
+    return output_file
+
+
+def blast_shards(fastaFilename, parsedFasta, shard_dbs, targetFamily, settings, log):
+    """BLASTs the sequences of a fasta file against the given per-locus BLAST databases (in parallel)
+    and keeps the best hit of each sequence
+
+    :param shard_dbs: list of BLAST databases (see reference_shards.get_shard_dbs)
+    :return: path of the BLAST output file, or False if the complete reference has to be searched
+    """
+    if len(shard_dbs) == 1:
+        log.debug("\tBlasting sequence...")
+        return blastSequences(fastaFilename, shard_dbs[0], settings, log)
+
+    log.debug(f"\tBlasting sequence against {len(shard_dbs)} loci...")
+    blast_format = get_blast_output_format(settings)
+    base = os.path.splitext(fastaFilename)[0]
+    query_files = [f"{base}_shard{i}.fa" for i in range(len(shard_dbs))]  # one per BLAST run (=> output file)
+    output_files = []
+    try:
+        for query_file in query_files:
+            shutil.copyfile(fastaFilename, query_file)
+        with ThreadPoolExecutor(max_workers=min(len(shard_dbs), os.cpu_count() or 1)) as executor:
+            futures = [executor.submit(blastSequences, query_file, shard_db, settings, log, blast_format)
+                       for (query_file, shard_db) in zip(query_files, shard_dbs)]
+            output_files = [future.result() for future in futures]
+        if not all(output_files):
+            return False
+
+        best_hits = {}  # query_id => (score, index of shard, AlignedHit)
+        for (i, output_file) in enumerate(output_files):
+            for (query_id, hit) in read_top_hits(output_file, targetFamily, settings, log).items():
+                if hit and (query_id not in best_hits or hit.score > best_hits[query_id][0]):
+                    best_hits[query_id] = (hit.score, i, hit)
+        headers = [header for (header, _) in fasta_generator(fastaFilename)]
+        if not headers or any(header.split()[0] not in best_hits for header in headers):
+            return False
+
+        output_file = get_blast_output_file(fastaFilename, blast_format)
+        best_shards = {best_hits[header.split()[0]][1] for header in headers}
+        if len(best_shards) == 1:  # use the BLAST output as it is (contains all HSPs of the top hit)
+            os.replace(output_files[best_shards.pop()], output_file)
+            return output_file
+        hits = [(header, best_hits[header.split()[0]][2]) for header in headers]
+        return write_blast_output(fastaFilename, parsedFasta, hits, settings, log)
+    finally:
+        for myfile in query_files + [output_file for output_file in output_files if output_file]:
+            if os.path.isfile(myfile):
+                os.remove(myfile)
+
+
 def parse_fasta_header(fasta_header):
     """parses header of a fastq file
     """
@@ -116,8 +465,44 @@ def sanity_check_seq(seq, log):
     return ok, msg
 
 
-def blast_raw_seqs(input_filename, filetype, settings, log, use_given_reference=False):
-    """parses raw allele file (fasta or XML)
+def get_target_family(seq_name, header_data, settings):
+    """determines the target family (HLA or KIR) of a sequence from its fasta header
+    """
+    kir = settings["gene_kir"]
+    hla = settings["gene_hla"]
+    locus = header_data["locus"]
+    if locus:  # if DRS2 fasta file
+        if locus.startswith("KIR"):
+            return kir
+        return hla
+    if re.search(kir, seq_name):
+        return kir
+    return hla
+
+
+def get_reference_files(targetFamily, settings, use_given_reference=False):
+    """returns the paths of the parsed fasta file (BLAST database), .dat file and version file
+    of the reference of the given target family
+    """
+    if use_given_reference:
+        reference_path = use_given_reference
+    else:
+        reference_path = os.path.join(settings["dat_path"], settings["general_dir"],
+                                      settings["reference_dir"])
+    if targetFamily == settings["gene_kir"]:
+        parsedFasta = os.path.join(reference_path, settings["parsed_kir"])
+        allelesFilename = os.path.join(reference_path, settings["kir_dat"])
+        versionFilename = os.path.join(reference_path, settings["kir_version"])
+    else:
+        parsedFasta = os.path.join(reference_path, settings["parsed_hla"])
+        allelesFilename = os.path.join(reference_path, settings["hla_dat"])
+        versionFilename = os.path.join(reference_path, settings["hla_version"])
+    return parsedFasta, allelesFilename, versionFilename
+
+
+def blast_raw_seqs(input_filename, filetype, settings, log, use_given_reference=False, blast_xml_file=False):
+    """parses raw allele file (fasta or XML);
+    if blast_xml_file is given (result of a previous batch BLAST run), the sequences are not BLASTed again
     """
     if filetype == "XML":
         log.debug("\tConverting xml to fasta...")
@@ -133,9 +518,6 @@ def blast_raw_seqs(input_filename, filetype, settings, log, use_given_reference=
         fastaFilename = input_filename
         xml_data_dic = {}
 
-    kir = settings["gene_kir"]
-    hla = settings["gene_hla"]
-
     log.debug("\tReading fasta for sanity check...")
     header = ""
     for myfasta in fasta_generator(fastaFilename):
@@ -146,45 +528,30 @@ def blast_raw_seqs(input_filename, filetype, settings, log, use_given_reference=
 
     log.debug("\tParsing fasta header...")
     seq_name, header_data = parse_fasta_header(header)
-    locus = header_data["locus"]
-    if locus:  # if DRS2 fasta file
-        if locus.startswith("KIR"):
-            targetFamily = kir
-        else:
-            targetFamily = hla
-    else:
-        if re.search(kir, seq_name):
-            targetFamily = kir
-        else:
-            targetFamily = hla
+    targetFamily = get_target_family(seq_name, header_data, settings)
+    parsedFasta, allelesFilename, versionFilename = get_reference_files(targetFamily, settings,
+                                                                        use_given_reference)
 
-    if use_given_reference:
-        reference_path = use_given_reference
+    if blast_xml_file and os.path.isfile(blast_xml_file):
+        log.debug("\tUsing result of batch BLAST run...")
+        BlastXMLFile = blast_xml_file
     else:
-        reference_path = os.path.join(settings["dat_path"], settings["general_dir"],
-                                      settings["reference_dir"])
-    parsed_kir = settings["parsed_kir"]
-    parsed_hla = settings["parsed_hla"]
-    hla_dat = settings["hla_dat"]
-    kir_dat = settings["kir_dat"]
-    hla_version = settings["hla_version"]
-    kir_version = settings["kir_version"]
-
-    if targetFamily == kir:
-        parsedFasta = os.path.join(reference_path, parsed_kir)
-        allelesFilename = os.path.join(reference_path, kir_dat)
-        versionFilename = os.path.join(reference_path, kir_version)
-    else:
-        parsedFasta = os.path.join(reference_path, parsed_hla)
-        allelesFilename = os.path.join(reference_path, hla_dat)
-        versionFilename = os.path.join(reference_path, hla_version)
-
-    log.debug("\tBlasting sequence...")
-    try:
-        BlastXMLFile = blastSequences(fastaFilename, parsedFasta, settings, log)
-    except Exception as E:
-        log.exception(E)
-        return False, "Error while trying to BLAST raw sequence", repr(E)
+        try:
+            with reference_lock:
+                BlastXMLFile = search_without_blast(fastaFilename, parsedFasta, targetFamily, settings, log)
+                if not BlastXMLFile:
+                    shard_dbs = reference_shards.get_shard_dbs(parsedFasta, header_data, log)
+                    if shard_dbs:
+                        BlastXMLFile = blast_shards(fastaFilename, parsedFasta, shard_dbs, targetFamily,
+                                                    settings, log)
+                if not BlastXMLFile:
+                    log.debug("\tBlasting sequence...")
+                    BlastXMLFile = blastSequences(fastaFilename, parsedFasta, settings, log)
+                    if BlastXMLFile:
+                        result_cache.store_hits(BlastXMLFile, fastaFilename, parsedFasta, targetFamily, settings, log)
+        except Exception as E:
+            log.exception(E)
+            return False, "Error while trying to BLAST raw sequence", repr(E)
     if not BlastXMLFile:
         msg = "BlastXMLFile not generated!\n"
         msg += "Please make sure the BLAST path in your user settings is correct!\n"
@@ -203,6 +570,56 @@ def blast_raw_seqs(input_filename, filetype, settings, log, use_given_reference=
     return BlastXMLFile, targetFamily, fastaFilename, allelesFilename, header_data, xml_data_dic
 
 
+def blast_raw_seqs_batch(fasta_files, settings, log):
+    """BLASTs the sequences of several raw fasta files with one BLAST run per BLAST database
+    (the shard of their locus, or the complete reference of their target family; used for bulk uploads);
+    files failing the sanity checks are skipped, so they can be handled (and reported) by blast_raw_seqs as usual
+
+    :return: dict of format {fasta_file: BLAST output file}
+    """
+    log.info(f"Blasting {len(fasta_files)} fasta files in batch mode...")
+    batches = defaultdict(list)  # BLAST database => list of fasta files
+    references = {}  # fasta file => (parsedFasta, target family) (of the files to BLAST)
+    results = {}
+    for fasta_file in fasta_files:
+        try:
+            header = ""
+            ok = True
+            for (header, seq) in fasta_generator(fasta_file):
+                (ok, _) = sanity_check_seq(seq, log)
+                if not ok:
+                    break
+        except ValueError:  # invalid fasta format
+            continue
+        if not ok or not header:
+            continue
+        seq_name, header_data = parse_fasta_header(header)
+        targetFamily = get_target_family(seq_name, header_data, settings)
+        (parsedFasta, _, _) = get_reference_files(targetFamily, settings)
+        with reference_lock:
+            output_file = search_without_blast(fasta_file, parsedFasta, targetFamily, settings, log)
+        if output_file:
+            results[fasta_file] = output_file
+        else:  # files with a locus in the header are BLASTed against its shard, the others against the complete reference
+            shard_dbs = reference_shards.get_shard_dbs(parsedFasta, header_data, log)
+            database = shard_dbs[0] if len(shard_dbs) == 1 else parsedFasta
+            batches[database].append(fasta_file)
+            references[fasta_file] = (parsedFasta, targetFamily)
+
+    for (i, database) in enumerate(batches):
+        try:
+            with reference_lock:
+                batch_results = blast_batch(batches[database], database, settings, log,
+                                            batch_name=f"batch_blast_{i}")
+                for (fasta_file, output_file) in batch_results.items():
+                    (parsedFasta, targetFamily) = references[fasta_file]
+                    result_cache.store_hits(output_file, fasta_file, parsedFasta, targetFamily, settings, log)
+            results.update(batch_results)
+        except Exception as E:  # the affected files are BLASTed one by one instead
+            log.exception(E)
+    return results
+
+
 if __name__ == '__main__':
     xmlFile = r"T:\nobackup\typeloader_temp\xmlfiles\0ID14893565.xml"
     getAlleleSequences(xmlFile, None)
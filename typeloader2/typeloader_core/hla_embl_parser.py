@@ -11,209 +11,491 @@ parser functions for repeat use
 #import modules:
 
 import os, re
-from pickle import dump
+import json
+import logging
+import zlib
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO, StringIO
+from pickle import dump, dumps, load, Pickler, EMPTY_DICT, PROTO, SETITEM, STOP
 import sys
 
 #===========================================================
 #classes:
 
 class Allele:
-    def __init__(self, ID, locus, name, seq, length, UTR5, UTR3, exon_dic, intron_dic, exonpos_dic, intronpos_dic, utrpos_dic, pseudo_exon_dic, exon_num_dic, intron_num_dic, target):
+    """compact representation of a reference allele:
+    only the full sequence is stored, feature positions are kept as integer arrays
+    and all feature sequences (exons, introns, UTRs, CDS) are sliced from the sequence on demand
+    """
+    __slots__ = ("ID", "locus", "name", "seq", "is_ref",
+                 "exon_nums", "exon_pos", "exon_labels", "pseudo_exons",
+                 "intron_nums", "intron_pos", "intron_labels", "utr5_pos", "utr3_pos")
+
+    def __init__(self, ID, locus, name, seq, exonpos_dic, intronpos_dic, utrpos_dic, pseudo_exon_dic, exon_num_dic, intron_num_dic, target):
         self.ID = ID # Accession number or name
         self.locus = locus # gene
         self.name = name # allele name
         self.seq = seq.upper() # full sequence in upper case
-        self.length = len(seq) # length of sequence
-        self.UTR3 = UTR3 # sequence of UTR3
-        self.UTR5 = UTR5 # sequence of UTR5
-        self.exon_dic = exon_dic # dict of format {1:'EXON1_SEQ', 2:'EXON2_SEQ'...}
-        self.intron_dic = intron_dic # dict of format {1:'INTRON1_SEQ', 2:'INTRON2_SEQ'...}
-        self.exonpos_dic = exonpos_dic
-        self.intronpos_dic = intronpos_dic
-        self.utrpos_dic = utrpos_dic
-        self.pseudo_exon_dic = pseudo_exon_dic # dict of format {1:'False', 2:'True', ...}
-        self.exon_num_dic = exon_num_dic # dict of formart {1: '1', 3: '3/4', ...}
-        self.intron_num_dic = intron_num_dic # dict of formart {1: '1', 2: '2', ...}
         self.is_ref = False
-        self.full_seq = False # True if at least some introns are known, otherwise false
-        if len(list(intron_dic.keys())) > 0:
-            self.full_seq = True
+        # features in order of the .dat file; positions as flat arrays of format [start1, end1, start2, end2...]:
+        self.exon_nums = array("H", exonpos_dic.keys())
+        self.exon_pos = array("I", [pos for (start, end) in exonpos_dic.values() for pos in (start, end)])
+        self.exon_labels = compact_labels(exon_num_dic, exonpos_dic) # None if all labels are just the numbers
+        self.pseudo_exons = tuple(exon for exon in exonpos_dic if pseudo_exon_dic.get(exon))
+        self.intron_nums = array("H", intronpos_dic.keys())
+        self.intron_pos = array("I", [pos for (start, end) in intronpos_dic.values() for pos in (start, end)])
+        self.intron_labels = compact_labels(intron_num_dic, intronpos_dic)
+        self.utr5_pos = utrpos_dic.get("utr5")
+        self.utr3_pos = utrpos_dic.get("utr3")
+
+    def __repr__(self):
+        return self.name
+
+    @property
+    def length(self):
+        """length of sequence"""
+        return len(self.seq)
+
+    @property
+    def exonpos_dic(self):
+        """dict of format {1: (start, end), 2: (start, end)...}"""
+        return dict(zip(self.exon_nums, zip(self.exon_pos[::2], self.exon_pos[1::2])))
+
+    @property
+    def intronpos_dic(self):
+        """dict of format {1: (start, end), 2: (start, end)...}"""
+        return dict(zip(self.intron_nums, zip(self.intron_pos[::2], self.intron_pos[1::2])))
+
+    @property
+    def utrpos_dic(self):
+        """dict of format {'utr5': (start, end), 'utr3': (start, end)}"""
+        utrpos_dic = {}
+        if self.utr5_pos:
+            utrpos_dic["utr5"] = self.utr5_pos
+        if self.utr3_pos:
+            utrpos_dic["utr3"] = self.utr3_pos
+        return utrpos_dic
+
+    @property
+    def exon_dic(self):
+        """dict of format {1:'EXON1_SEQ', 2:'EXON2_SEQ'...}"""
+        return {exon: self.seq[start:end] for (exon, (start, end)) in self.exonpos_dic.items()}
+
+    @property
+    def intron_dic(self):
+        """dict of format {1:'INTRON1_SEQ', 2:'INTRON2_SEQ'...}"""
+        return {intron: self.seq[start:end] for (intron, (start, end)) in self.intronpos_dic.items()}
+
+    @property
+    def pseudo_exon_dic(self):
+        """dict of format {1: False, 2: True, ...}"""
+        return {exon: exon in self.pseudo_exons for exon in self.exon_nums}
+
+    @property
+    def exon_num_dic(self):
+        """dict of format {1: '1', 3: '3/4', ...}"""
+        return expand_labels(self.exon_labels, self.exon_nums)
+
+    @property
+    def intron_num_dic(self):
+        """dict of format {1: '1', 2: '2', ...}"""
+        return expand_labels(self.intron_labels, self.intron_nums)
+
+    @property
+    def UTR5(self):
+        """sequence of UTR5"""
+        return self.seq[self.utr5_pos[0]:self.utr5_pos[1]] if self.utr5_pos else ""
+
+    @property
+    def UTR3(self):
+        """sequence of UTR3"""
+        return self.seq[self.utr3_pos[0]:self.utr3_pos[1]] if self.utr3_pos else ""
+
+    @property
+    def CDS(self):
+        """all exon sequences, concatenated in order of their numbers"""
+        exon_dic = self.exon_dic
+        return "".join(exon_dic[exon] for exon in sorted(exon_dic))
+
+    @property
+    def full_seq(self):
+        """True if at least some introns are known, otherwise false"""
+        return len(self.intron_nums) > 0
+
+    @property
+    def fasta_header(self):
+        name = self.name
         if name.startswith("HLA"):
             name = name.split("-")[1]
-#         self.fasta_header = ">%s:%s_%s %s bp" % (target, ID, name, self.length)
-        self.fasta_header = ">%s %s bp" % (name, self.length)
+        return ">%s %s bp" % (name, self.length)
 
-        # calculate CDS:
-        exons = list(exon_dic.keys())
-        exons.sort()
-        self.CDS = ""
-        for exon in exons:
-            self.CDS += exon_dic[exon]
 
-    def __repr__(self):
-        return self.name
+def compact_labels(num_dic, pos_dic):
+    """returns the feature labels (e.g., '3/4') in order of pos_dic,
+    or None if every label is just the feature number
+    """
+    labels = tuple(num_dic[num] for num in pos_dic)
+    if all(label == str(num) for (label, num) in zip(labels, pos_dic)):
+        return None
+    return labels
+
+
+def expand_labels(labels, nums):
+    """reverses compact_labels: returns dict of format {1: '1', 3: '3/4', ...}
+    """
+    if labels is None:
+        return {num: str(num) for num in nums}
+    return dict(zip(nums, labels))
+
+#===========================================================
+# parameters:
+
+# HLA.dat contains other loci, too - MIC, TAP...
+usable_loci = ["HLA-A*", "HLA-B*", "HLA-C*", "HLA-E*", "HLA-DPB1*", "HLA-DQB1*",
+               "HLA-DRB", "MICA", "MICB", "HLA-DPA1", "HLA-DQA1",
+               "HLA-DMA", "HLA-DMB", "HLA-DOA", "HLA-DOB",
+               "HLA-F", "HLA-G", "HLA-H", "HLA-K", "HLA-J"]
 
 #===========================================================
 # reading functions:
 
-def read_dat_file(dat_file, target, log, isENA = False, verbose = False):
-    """reads content of a .dat file (EMBL format),
-    returns list of allele objects.
-    The parameter 'target' expects one of the following: "HLA", "Blutgruppen","CCR5", "KIR".
+def get_release_regex(target):
+    """returns the regex to find the release version in the DT lines of a .dat file
     """
-    alleles = []
-    version = ""
     if target == "KIR":
         curr_release_pattern1 = "\(rel. (.*?), current release"
-        curr_release_regex1 = re.compile(curr_release_pattern1)
     else:
         curr_release_pattern1 = "\(rel. (.*?), last updated"
-        curr_release_regex1 = re.compile(curr_release_pattern1)
+    return re.compile(curr_release_pattern1)
 
-    if verbose:
-        log.info("Reading {}...".format(dat_file))
-    with open(dat_file, "r") as f:
-        data = f.readlines()
-        for i in range(len(data)):
-            line = data[i]
+
+def iter_raw_records(dat_file, start=0, end=None):
+    """reads a .dat file (EMBL format) record by record,
+    yields (offset, length, lines) for every '//'-terminated record,
+    with offset and length given in bytes.
+    If start and end are given, only the records within this byte range are read
+    (start must be the beginning of a record).
+    """
+    with open(dat_file, "rb") as f:
+        f.seek(start)
+        offset = start
+        length = 0
+        lines = []
+        for line in f:
+            if end is not None and offset >= end:
+                break
+            length += len(line)
+            lines.append(line.decode("latin-1").rstrip("\r\n"))
+            if line.startswith(b"//"):
+                yield offset, length, lines
+                offset += length
+                length = 0
+                lines = []
+
+
+def get_chunk_ranges(dat_file, num_chunks):
+    """splits a .dat file into up to num_chunks byte ranges of similar size,
+    each starting and ending at a record boundary;
+    returns list of (start, end)
+    """
+    file_size = os.path.getsize(dat_file)
+    boundaries = [0]
+    with open(dat_file, "rb") as f:
+        for i in range(1, num_chunks):
+            pos = max(file_size * i // num_chunks, boundaries[-1])
+            if pos > 0:
+                f.seek(pos - 1)
+                if f.read(1) != b"\n":  # inside a line: skip to the start of the next line
+                    pos += len(f.readline())
+            for line in iter(f.readline, b""):
+                pos += len(line)
+                if line.startswith(b"//"):
+                    break
+            if pos >= file_size:
+                break
+            if pos > boundaries[-1]:
+                boundaries.append(pos)
+    boundaries.append(file_size)
+    return [(start, end) for (start, end) in zip(boundaries[:-1], boundaries[1:])]
+
+
+def read_raw_record(dat_file, offset, length):
+    """reads the record starting at byte offset from a .dat file,
+    returns it as list of lines
+    """
+    with open(dat_file, "rb") as f:
+        f.seek(offset)
+        data = f.read(length)
+    return data.decode("latin-1").splitlines()
+
+
+def get_record_name(lines, target):
+    """returns the allele name of a .dat record, as used by read_dat_file
+    """
+    for line in lines:
+        if target in ["Blutgruppen", "CCR5"]:
             if line.startswith("ID"):
-                s = line.split()
-                allele_ID = s[1].replace(";","")
-                length = s[5]
-                seq = ""
-                UTR3 = ""
-                UTR5 = ""
-                UTR5_start = False
-                UTR5_end = False
-                UTR3_start = False
-                UTR3_end = False
-                exon_dic = {}
-                exonpos_dic = {}
-                intron_dic = {}
-                intronpos_dic = {}
-                utrpos_dic = {}
-                pseudo_exon_dic = {}
-                intron_num_dic = {}
-                exon_num_dic = {}
-
-                if target in ["Blutgruppen","CCR5"]:
-                    allele = allele_ID
-                    if allele.find("*")>0:
-                        locus = allele.split("*")[0]
-                    elif allele.find("_")>0:
-                        locus = allele.split("_")[0]
-                    else:
-                        log.error("!!!Cannot see Locus of Allele %s! Please adjust Input file!" % allele)
-                        log.error(line)
-                        sys.exit()
-
-            elif line.startswith("DT"):
-                line = line.lower()
-                match = curr_release_regex1.search(line)
-                if match:
-                    version = match.groups()[0]
-
-            elif line.startswith("DE"):
-                s = line.split()
-                if target in ["HLA", "HLA_23_with_introns", "Phasing_HLA_23", "KIR"]:
-                    allele = s[1][:-1]
-                    locus = allele.split("*")[0]
+                return line.split()[1].replace(";", "")
+        elif line.startswith("DE"):
+            return line.split()[1][:-1]
+    return None
+
 
-            elif line.startswith("FT"):
-                s = line.split()
-                if s[1] == "UTR":
-                    start = int(s[-1].split(".")[0]) - 1
-                    end = int(s[-1].split(".")[-1])
-
-                    if start == 0:
-                        UTR5_start = start
-                        UTR5_end = end
-                        utrpos_dic["utr5"] = (start, end)
-                    else:
-                        UTR3_start = start
-                        UTR3_end = end
-                        utrpos_dic["utr3"] = (start, end)
-                elif s[1] == "exon":
-                    start = int(s[-1].split(".")[0]) - 1
-                    end = int(s[-1].split(".")[-1])
-                    next_line = data[i+1]
-                    assert next_line.find("number") > 0, "Cannot find exon number in %s:\n '%s'\n '%s'" % (allele, line, next_line)
-                    # doublesplit, because of [/number="3/4"] lines
-                    exon_num = int(next_line.split('"')[-2].split('/')[0])
-                    exonpos_dic[exon_num] = (start, end)
-                    exon_num_dic[exon_num] = next_line.split('"')[-2]
-                    # look at line + 2, to find pseudoexon
-                    next_line = data[i+2]
-                    pseudo_exon_dic[exon_num] = True if next_line.find("pseudo") > 0 else False
-
-                elif s[1] == "intron":
-                    start = int(s[-1].split(".")[0]) - 1
-                    end = int(s[-1].split(".")[-1])
-                    next_line = data[i+1]
-                    assert next_line.find("number") > 0, "Cannot find intron number in %s:\n '%s'\n '%s'" % (allele, line, next_line)
-                    # doublesplit, because of [/number="3/4"] lines
-                    intron_num = int(next_line.split('"')[-2].split('/')[0])
-                    intronpos_dic[intron_num] = (start, end)
-                    intron_num_dic[intron_num] = intron_num = next_line.split('"')[-2]
-
-            elif line.startswith("SQ"):
-                read_on = True
-                j = 0
-                while read_on:
-                    j += 1
-                    s = data[i+j]
-                    if s.startswith("//"):
-                        read_on = False
-                    else:
-                        myseq = "".join(s.split()[:-1]).upper()
-                        seq += myseq
-
-            elif line.startswith("//"):
-                for exon in exonpos_dic:
-                    (start,end) = exonpos_dic[exon]
-                    exon_seq = seq[start:end]
-                    exon_dic[exon] = exon_seq
-
-                for intron in intronpos_dic:
-                    (start,end) = intronpos_dic[intron]
-                    intron_seq = seq[start:end]
-                    intron_dic[intron] = intron_seq
-
-                if UTR5_end:
-                    UTR5 = seq[UTR5_start:UTR5_end].upper()
-                if UTR3_end:
-                    UTR3 = seq[UTR3_start:UTR3_end].upper()
-
-                myAllele = Allele(allele_ID, locus, allele, seq, length, UTR5, UTR3, exon_dic, intron_dic, exonpos_dic, intronpos_dic, utrpos_dic, pseudo_exon_dic, exon_num_dic, intron_num_dic, target)
-                if target == "HLA": # HLA.dat contains other loci, too - MIC, TAP...
-                    usable = False
-                    usable_loci = ["HLA-A*", "HLA-B*", "HLA-C*", "HLA-E*", "HLA-DPB1*", "HLA-DQB1*",
-                                   "HLA-DRB", "MICA", "MICB", "HLA-DPA1", "HLA-DQA1",
-                                   "HLA-DMA", "HLA-DMB", "HLA-DOA", "HLA-DOB",
-                                   "HLA-F", "HLA-G", "HLA-H", "HLA-K", "HLA-J"]
-                    for loc in usable_loci:
-                        if allele.startswith(loc): # HLA.dat contains other loci, too - MIC, TAP...
-                            usable = True
-                    if usable:
-                        alleles.append(myAllele)
+def is_usable(allele_name, target):
+    """checks whether an allele belongs to a locus supported by TypeLoader
+    (HLA.dat contains other loci, too - MIC, TAP...)
+    """
+    if target != "HLA":
+        return True
+    for loc in usable_loci:
+        if allele_name.startswith(loc):
+            return True
+    return False
+
+
+def get_record_version(lines, curr_release_regex):
+    """returns the release version found in the DT lines of a .dat record ("" if none)
+    """
+    version = ""
+    for line in lines:
+        if line.startswith("DT"):
+            match = curr_release_regex.search(line.lower())
+            if match:
+                version = match.groups()[0]
+    return version
+
+
+def parse_dat_record(data, target, log, curr_release_regex=None):
+    """parses the lines of one '//'-terminated record of a .dat file (EMBL format),
+    returns the allele object (None if the allele's locus is not usable) and the release version
+    found in the record ("" if none)
+    """
+    if not curr_release_regex:
+        curr_release_regex = get_release_regex(target)
+    myAllele = None
+    version = ""
+    for i in range(len(data)):
+        line = data[i]
+        if line.startswith("ID"):
+            s = line.split()
+            allele_ID = s[1].replace(";","")
+            seq = ""
+            exonpos_dic = {}
+            intronpos_dic = {}
+            utrpos_dic = {}
+            pseudo_exon_dic = {}
+            intron_num_dic = {}
+            exon_num_dic = {}
+
+            if target in ["Blutgruppen","CCR5"]:
+                allele = allele_ID
+                if allele.find("*")>0:
+                    locus = allele.split("*")[0]
+                elif allele.find("_")>0:
+                    locus = allele.split("_")[0]
                 else:
-                    alleles.append(myAllele)
-    if verbose:
-        log.info("\t=> successfully read {} of {} alleles!" % (len(alleles), target))
+                    log.error("!!!Cannot see Locus of Allele %s! Please adjust Input file!" % allele)
+                    log.error(line)
+                    sys.exit()
+
+        elif line.startswith("DT"):
+            line = line.lower()
+            match = curr_release_regex.search(line)
+            if match:
+                version = match.groups()[0]
+
+        elif line.startswith("DE"):
+            s = line.split()
+            if target in ["HLA", "HLA_23_with_introns", "Phasing_HLA_23", "KIR"]:
+                allele = s[1][:-1]
+                locus = allele.split("*")[0]
+
+        elif line.startswith("FT"):
+            s = line.split()
+            if s[1] == "UTR":
+                start = int(s[-1].split(".")[0]) - 1
+                end = int(s[-1].split(".")[-1])
+
+                if start == 0:
+                    utrpos_dic["utr5"] = (start, end)
+                else:
+                    utrpos_dic["utr3"] = (start, end)
+            elif s[1] == "exon":
+                start = int(s[-1].split(".")[0]) - 1
+                end = int(s[-1].split(".")[-1])
+                next_line = data[i+1]
+                assert next_line.find("number") > 0, "Cannot find exon number in %s:\n '%s'\n '%s'" % (allele, line, next_line)
+                # doublesplit, because of [/number="3/4"] lines
+                exon_num = int(next_line.split('"')[-2].split('/')[0])
+                exonpos_dic[exon_num] = (start, end)
+                exon_num_dic[exon_num] = next_line.split('"')[-2]
+                # look at line + 2, to find pseudoexon
+                next_line = data[i+2]
+                pseudo_exon_dic[exon_num] = True if next_line.find("pseudo") > 0 else False
+
+            elif s[1] == "intron":
+                start = int(s[-1].split(".")[0]) - 1
+                end = int(s[-1].split(".")[-1])
+                next_line = data[i+1]
+                assert next_line.find("number") > 0, "Cannot find intron number in %s:\n '%s'\n '%s'" % (allele, line, next_line)
+                # doublesplit, because of [/number="3/4"] lines
+                intron_num = int(next_line.split('"')[-2].split('/')[0])
+                intronpos_dic[intron_num] = (start, end)
+                intron_num_dic[intron_num] = intron_num = next_line.split('"')[-2]
+
+        elif line.startswith("SQ"):
+            read_on = True
+            j = 0
+            while read_on:
+                j += 1
+                s = data[i+j]
+                if s.startswith("//"):
+                    read_on = False
+                else:
+                    myseq = "".join(s.split()[:-1]).upper()
+                    seq += myseq
+
+        elif line.startswith("//"):
+            if is_usable(allele, target):
+                myAllele = Allele(allele_ID, locus, allele, seq, exonpos_dic, intronpos_dic, utrpos_dic, pseudo_exon_dic, exon_num_dic, intron_num_dic, target)
+    return myAllele, version
 
+
+def iter_dat_file(dat_file, target, log, start=0, end=None):
+    """reads a .dat file (EMBL format) record by record,
+    yields (allele object, version) for every record;
+    records of unusable loci are skipped before parsing and yield (None, version).
+    If start and end are given, only the records within this byte range are read.
+    """
+    curr_release_regex = get_release_regex(target)
+    for (_, _, lines) in iter_raw_records(dat_file, start, end):
+        allele_name = get_record_name(lines, target)
+        if allele_name and not is_usable(allele_name, target):
+            yield None, get_record_version(lines, curr_release_regex)
+            continue
+        yield parse_dat_record(lines, target, log, curr_release_regex)
+
+
+def read_dat_file(dat_file, target, log, isENA = False, verbose = False):
+    """reads content of a .dat file (EMBL format),
+    returns dict of allele objects of format {allele_name: allele} and the release version.
+    The parameter 'target' expects one of the following: "HLA", "Blutgruppen","CCR5", "KIR".
+    """
     alleleHash = {}
-    for allele in alleles:
-        #if not isENA:
-        #    if allele.name.find("DQB1") != -1:
-        #       if ((allele.name != "HLA-DQB1*05:03:01:01") or (allele.name != "HLA-DQB1*06:01:01")): continue
-        alleleHash[allele.name] = allele
+    version = ""
+
+    if verbose:
+        log.info("Reading {}...".format(dat_file))
+    for myAllele, record_version in iter_dat_file(dat_file, target, log):
+        if record_version:
+            version = record_version
+        if myAllele:
+            alleleHash[myAllele.name] = myAllele
+    if verbose:
+        log.info("\t=> successfully read {} of {} alleles!".format(len(alleleHash), target))
 
     return alleleHash, version
 
 
+#===========================================================
+# gene models:
+
+def make_gene_model(allele):
+    """returns the gene model of a reference allele as used for annotation (see coordinates.py):
+    dict with the features (['utr5', (1, 'e'), (1, 'i'), (2, 'e'), ... , 'utr3']),
+    their 1-based coordinates (the end of the 3' UTR is None: it is set to the length of the annotated sequence),
+    the extraInformation (pseudoexons, exon & intron numbers) and the CDS sequence
+    """
+    exonpos_dic = allele.exonpos_dic
+    intronpos_dic = allele.intronpos_dic
+    utrpos_dic = allele.utrpos_dic
+    extraInformation = {"pseudoexon": dict(allele.pseudo_exon_dic), "exon_number": dict(allele.exon_num_dic),
+                        "intron_number": dict(allele.intron_num_dic)}
+    features = []
+    coordinates = []
+    cds_sequence = ""
+
+    if "utr5" in utrpos_dic:
+        features.append("utr5")
+        coordinates.append((utrpos_dic["utr5"][0] + 1, utrpos_dic["utr5"][1]))
+
+    exonIds = [(exonNumber, "epseudo" if extraInformation["pseudoexon"][exonNumber] else "e")
+               for exonNumber in exonpos_dic]
+    intronIds = [(intronNumber, "i") for intronNumber in intronpos_dic]
+    cdsIds = sorted(exonIds + intronIds)
+    features.extend(cdsIds)
+    for (number, kind) in cdsIds:
+        (start, end) = intronpos_dic[number] if kind == "i" else exonpos_dic[number]
+        coordinates.append((start + 1, end))
+        if kind == "e":
+            cds_sequence += allele.seq[start:end]
+
+    if "utr3" in utrpos_dic:
+        features.append("utr3")
+        coordinates.append((utrpos_dic["utr3"][0] + 1, None))
+
+    return {"features": features, "coordinates": coordinates, "extraInformation": extraInformation,
+            "cdsSequence": cds_sequence}
+
+
+def get_codons(seq):
+    """returns the codons of a CDS sequence (the last one may be incomplete)
+    """
+    return tuple(seq[i:i + 3] for i in range(0, len(seq), 3))
+
+
 #===========================================================
 # writing functions:
 
+class DictDumpWriter:
+    """writes a pickled dict to an open binary file item by item,
+    so the complete dict never has to be kept in memory.
+    The resulting file can be read with pickle.load() like any dumped dict.
+    """
+    def __init__(self, f, write_header=True):
+        self.f = f
+        self.buffer = BytesIO()
+        self.pickler = Pickler(self.buffer, protocol=3)  # protocols < 4 use explicit memo indices
+        if write_header:  # if False, only items are written (to be concatenated to a complete dump later)
+            self.f.write(PROTO + bytes([3]) + EMPTY_DICT)
+
+    def _pickle(self, obj):
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        self.pickler.dump(obj)
+        return self.buffer.getvalue()[2:-1]  # strip PROTO header & STOP
+
+    def add(self, key, value):
+        self.f.write(self._pickle(key) + self._pickle(value) + SETITEM)
+        self.pickler.clear_memo()
+
+    def close(self):
+        self.f.write(STOP)
+
+
+class GeneModelWriter:
+    """writes the gene models of alleles (see make_gene_model) to an open binary file one by one
+    (as compressed pickles), remembering the (offset, length) of each one for the reference index
+    """
+    def __init__(self, f):
+        self.f = f
+        self.offsets = {}
+
+    def add(self, allele):
+        data = zlib.compress(dumps(make_gene_model(allele), protocol=4))
+        self.offsets[allele.name] = (self.f.tell(), len(data))
+        self.f.write(data)
+
+    def add_written(self, data, offsets):
+        """adds the gene models written by another GeneModelWriter (its written bytes & offsets)
+        """
+        start = self.f.tell()
+        self.f.write(data)
+        for (allele_name, (offset, length)) in offsets.items():
+            self.offsets[allele_name] = (start + offset, length)
+
+
 def write_fasta(alleles, output_fasta, no_UTR = False, verbose = False):
     """takes a list of allele objects,
     writes a fasta-file containing their full sequences
@@ -225,17 +507,107 @@ def write_fasta(alleles, output_fasta, no_UTR = False, verbose = False):
             if no_UTR: # only use sequence without UTR (not always fully known)
                 start_utr3 = len(allele.UTR3) * -1
                 if start_utr3 == 0:
-                    allele.print_seq = allele.seq[len(allele.UTR5):]
+                    print_seq = allele.seq[len(allele.UTR5):]
                 else:
-                    allele.print_seq = allele.seq[len(allele.UTR5): -1 * len(allele.UTR3)]
+                    print_seq = allele.seq[len(allele.UTR5): -1 * len(allele.UTR3)]
             else:
-                allele.print_seq = allele.seq
-            g.write("%s\n%s\n" % (allele.fasta_header, allele.print_seq))
+                print_seq = allele.seq
+            g.write("%s\n%s\n" % (allele.fasta_header, print_seq))
     if verbose:
         print("\tFertig!")
 
 
-def make_parsed_files(target, ref_dir, log, restricted_to=None, target_dir=None):
+def write_parsed_allele(allele_data, target, restricted_to, fasta_file, dump_writer, allele_names, log,
+                        model_writer=None):
+    """writes one allele to the given fasta file and DictDumpWriter (if it is to be used)
+    and its gene model to model_writer (if given, not used for restricted databases),
+    adds its name to allele_names if it is not a CDS-only allele
+    """
+    allele_name = allele_data.name
+    if allele_data.full_seq:  # allele is not a CDS-only allele
+        allele_names.append(allele_name)
+
+    if restricted_to:
+        if allele_name in restricted_to:
+            log.debug(f"\t\t\tAdding {allele_name} to database...")
+            fasta_file.write(">%s\n" % allele_name)
+            fasta_file.write("%s\n" % allele_data.seq)
+            dump_writer.add(allele_name, allele_data)  # limit dump file to chosen alleles
+        return
+
+    if target == "hla":
+        if allele_name.startswith("MIC"): # take only full length MIC alleles
+            if len(allele_data.UTR3) > 0 and len(allele_data.UTR5) > 0:
+                fasta_file.write(">%s\n" % allele_name)
+                fasta_file.write("%s\n" % allele_data.seq)
+        else:
+            fasta_file.write(">%s\n" % allele_name)
+            fasta_file.write("%s\n" % allele_data.seq)
+    elif target == "KIR":
+        # take only full length KIR alleles
+        if len(allele_data.UTR3) > 0 and len(allele_data.UTR5) > 0:
+            fasta_file.write(">%s\n" % allele_name)
+            fasta_file.write("%s\n" % allele_data.seq)
+    else:
+        pass
+    dump_writer.add(allele_name, allele_data)
+    if model_writer:
+        model_writer.add(allele_data)
+
+
+def write_parsed_records(ipd_file, target, restricted_to, fasta_file, dump_writer, log, start=0, end=None,
+                         model_writer=None):
+    """parses the records of an IPD .dat file (or of the given byte range of it),
+    writes the alleles to be used to the given fasta file and DictDumpWriter (and their gene models to model_writer)
+
+    :return: list of names of all non-CDS-only alleles, release version, number of alleles found
+    """
+    allele_names = []
+    version = ""
+    num_alleles = 0
+    for allele_data, record_version in iter_dat_file(ipd_file, target.upper(), log, start, end):
+        if record_version:
+            version = record_version
+        if not allele_data:
+            continue
+        num_alleles += 1
+        write_parsed_allele(allele_data, target, restricted_to, fasta_file, dump_writer, allele_names, log,
+                            model_writer)
+    return allele_names, version, num_alleles
+
+
+def parse_chunk(ipd_file, target, restricted_to, start, end, log_name):
+    """worker function for parallel parsing: parses one byte range of an IPD .dat file,
+    returns its fasta text, dump items (bytes), allele names, release version, number of alleles
+    and its gene models (bytes & offsets, see GeneModelWriter; empty for restricted databases)
+    """
+    log = logging.getLogger(log_name)
+    fasta_file = StringIO()
+    dump_buffer = BytesIO()
+    model_writer = GeneModelWriter(BytesIO()) if not restricted_to else None
+    allele_names, version, num_alleles = write_parsed_records(ipd_file, target, restricted_to, fasta_file,
+                                                              DictDumpWriter(dump_buffer, write_header=False),
+                                                              log, start, end, model_writer)
+    if not model_writer:
+        return fasta_file.getvalue(), dump_buffer.getvalue(), allele_names, version, num_alleles, b"", {}
+    return (fasta_file.getvalue(), dump_buffer.getvalue(), allele_names, version, num_alleles,
+            model_writer.f.getvalue(), model_writer.offsets)
+
+
+def get_num_workers(workers):
+    """translates the parse_workers setting into a number of worker processes
+    (0 = use all available cores)
+    """
+    try:
+        workers = int(workers)
+    except (TypeError, ValueError):
+        workers = 1
+    if workers <= 0:
+        workers = os.cpu_count() or 1
+    return workers
+
+
+def make_parsed_files(target, ref_dir, log, restricted_to=None, target_dir=None, workers=1):
     """creates the parsed reference files from IPD's files
 
     :param target: designates target database, either 'KIR' or 'hla'
@@ -244,7 +616,13 @@ def make_parsed_files(target, ref_dir, log, restricted_to=None, target_dir=None)
     :param restricted_to: if used, a list of allele names; then the created database will only
                           contain the listed alleles
     :param target_dir: path where to create the databases; only used if restricted_to is not None
+    :param workers: number of processes used to parse the .dat file (0 = all available cores);
+                    the created files are identical for any number of workers
     """
+    from .reference_index import make_reference_index, make_fasta_index, make_sequence_index, \
+        get_gene_model_file, add_gene_models
+    from .reference_cache import reference_cache
+
     if restricted_to:
         if not target_dir:
             raise ValueError("Please specify a target_dir for the restricted reference database!")
@@ -259,60 +637,192 @@ def make_parsed_files(target, ref_dir, log, restricted_to=None, target_dir=None)
     dump_file = os.path.join(myref_dir, f"parsed{target}.dump")
     version_file = os.path.join(myref_dir, f"curr_version_{target}.txt")
     allelename_file = os.path.join(ref_dir, f"{target}_allelenames.dump")
+    model_file = get_gene_model_file(ipd_file) if not restricted_to else os.devnull  # restricted: no gene models
     
     log.debug("\t\tReading alleles from {}...".format(ipd_file))
-    alleles, version = read_dat_file(ipd_file, target.upper(), log)
-    log.debug(f"\t\t\t=> found {len(alleles)} alleles")
+    log.debug("\t\tWriting {} and {}...".format(fa_file, dump_file))
+    workers = get_num_workers(workers)
+    with open(fa_file, "w") as fasta_file, open(dump_file, "wb") as g, open(model_file, "wb") as g_models:
+        dump_writer = DictDumpWriter(g)
+        model_writer = GeneModelWriter(g_models) if not restricted_to else None
+        if workers == 1:
+            allele_names, version, num_alleles = write_parsed_records(ipd_file, target, restricted_to,
+                                                                      fasta_file, dump_writer, log,
+                                                                      model_writer=model_writer)
+        else:
+            chunks = get_chunk_ranges(ipd_file, workers * 4)
+            log.debug(f"\t\t\tParsing {len(chunks)} chunks with {workers} processes...")
+            allele_names = []
+            version = ""
+            num_alleles = 0
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = [executor.submit(parse_chunk, ipd_file, target, restricted_to, start, end, log.name)
+                           for (start, end) in chunks]
+                for future in futures:  # merge in the order of the chunks => files identical to serial parsing
+                    (fasta_text, dump_items, chunk_allele_names, chunk_version, chunk_num_alleles,
+                     model_data, model_offsets) = future.result()
+                    fasta_file.write(fasta_text)
+                    g.write(dump_items)
+                    if model_writer:
+                        model_writer.add_written(model_data, model_offsets)
+                    allele_names.extend(chunk_allele_names)
+                    if chunk_version:
+                        version = chunk_version
+                    num_alleles += chunk_num_alleles
+        dump_writer.close()
+    log.debug(f"\t\t\t=> found {num_alleles} alleles")
+
+    # alleles occurring in several records are only listed once (as in the dump file):
+    seen = set()
+    unique_names = []
+    for allele_name in allele_names:
+        if allele_name not in seen:
+            seen.add(allele_name)
+            unique_names.append(allele_name)
+    allele_names = unique_names
+
+    log.debug("\t\tWriting {}...".format(allelename_file))
+    with open(allelename_file, "wb") as g:
+        dump(allele_names, g)
+
+    log.debug("\t\tWriting {}...".format(version_file))
+    with open(version_file, "w") as g:
+        g.write(version)
+
+    make_fasta_index(fa_file, log)
+    make_sequence_index(fa_file, log)
+    if not restricted_to:  # restricted databases use the index of the complete .dat file
+        index = make_reference_index(ipd_file, target.upper(), log, write=False)
+        add_gene_models(ipd_file, index, model_writer.offsets, log)
+
+    reference_cache.invalidate(myref_dir)
+    reference_cache.invalidate(ref_dir)
+    return version
+
+
+def get_manifest_file(ref_dir, target):
+    """returns the path of the change manifest of a reference update
+    """
+    return os.path.join(ref_dir, f"{target}_changes.json")
+
+
+def read_change_manifest(ref_dir, target):
+    """returns the change manifest written by the last reference update of target (None if there is none);
+    dict with keys target, mode ('incremental' or 'full'), old_version, new_version
+    and the lists added, changed and removed (None if the reference could not be compared)
+    """
+    try:
+        with open(get_manifest_file(ref_dir, target)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def patch_parsed_files(target, ref_dir, old_ref_dir, new_index, diff, log):
+    """creates the parsed reference files for the .dat file in ref_dir by reusing the parsed alleles
+    of the previous version in old_ref_dir; only added and changed records are parsed.
+    The files are identical to those created by make_parsed_files.
+    """
+    ipd_file = os.path.join(ref_dir, f"{target}.dat")
+    fa_file = os.path.join(ref_dir, f"parsed{target}.fa")
+    dump_file = os.path.join(ref_dir, f"parsed{target}.dump")
+    version_file = os.path.join(ref_dir, f"curr_version_{target}.txt")
+    allelename_file = os.path.join(ref_dir, f"{target}_allelenames.dump")
+    from .reference_index import make_fasta_index, make_sequence_index, get_gene_model_file, add_gene_models
+    from .reference_cache import reference_cache
+    model_file = get_gene_model_file(ipd_file)
 
+    log.debug(f"\t\tReading previous alleles from {old_ref_dir}...")
+    with open(os.path.join(old_ref_dir, f"parsed{target}.dump"), "rb") as f:
+        old_alleles = load(f)
+
+    new_records = set(diff["added"]) | set(diff["changed"])
+    release_regex = get_release_regex(target.upper())
     allele_names = []
-    log.debug("\t\tWriting {}...".format(fa_file))
-    with open(fa_file, "w") as fasta_file:
-        for allele_name in list(alleles.keys()):
-            allele_data = alleles[allele_name]
-            if allele_data.intron_dic:  # allele is not a CDS-only allele
-                allele_names.append(allele_name)
-
-            if restricted_to:
-                if allele_name in restricted_to:
-                    log.debug(f"\t\t\tAdding {allele_name} to database...")
-                    fasta_file.write(">%s\n" % allele_name)
-                    fasta_file.write("%s\n" % allele_data.seq)
+    log.debug("\t\tWriting {} and {}...".format(fa_file, dump_file))
+    with open(fa_file, "w") as fasta_file, open(dump_file, "wb") as g, open(model_file, "wb") as g_models:
+        dump_writer = DictDumpWriter(g)
+        model_writer = GeneModelWriter(g_models)
+        for (allele_name, (offset, length)) in new_index["offsets"].items():
+            if not is_usable(allele_name, target.upper()):
+                continue
+            if allele_name in new_records:
+                lines = read_raw_record(ipd_file, offset, length)
+                allele_data, _ = parse_dat_record(lines, target.upper(), log, release_regex)
             else:
-                if target == "hla":
-                    if allele_name.startswith("MIC"): # take only full length MIC alleles
-                        if len(allele_data.UTR3) > 0 and len(allele_data.UTR5) > 0:
-                            fasta_file.write(">%s\n" % allele_name)
-                            fasta_file.write("%s\n" % allele_data.seq)
-                    else:
-                        fasta_file.write(">%s\n" % allele_name)
-                        fasta_file.write("%s\n" % allele_data.seq)
-                elif target == "KIR":
-                    # take only full length KIR alleles
-                    if len(allele_data.UTR3) > 0 and len(allele_data.UTR5) > 0:
-                        fasta_file.write(">%s\n" % allele_name)
-                        fasta_file.write("%s\n" % allele_data.seq)
-                else:
-                    pass
-    
-    log.debug("\t\tWriting {}...".format(dump_file))
-    if restricted_to:  # limit dump file to chosen alleles
-        alleles2 = {}
-        for allele in alleles:
-            if allele in restricted_to:
-                alleles2[allele] = alleles[allele]
-        alleles = alleles2
-    with open(dump_file, "wb") as g:
-        dump(alleles, g)
+                allele_data = old_alleles[allele_name]  # KeyError => previous files inconsistent
+            if allele_data:
+                write_parsed_allele(allele_data, target, None, fasta_file, dump_writer, allele_names, log,
+                                    model_writer)
+        dump_writer.close()
+
+    make_fasta_index(fa_file, log)
+    make_sequence_index(fa_file, log)
+    add_gene_models(ipd_file, new_index, model_writer.offsets, log)
 
     log.debug("\t\tWriting {}...".format(allelename_file))
     with open(allelename_file, "wb") as g:
         dump(allele_names, g)
 
+    version = new_index["version"]
     log.debug("\t\tWriting {}...".format(version_file))
     with open(version_file, "w") as g:
         g.write(version)
-
+    reference_cache.invalidate(ref_dir)
     return version
 
+
+def make_parsed_files_incremental(target, ref_dir, old_ref_dir, log, workers=1, max_changes=0.3):
+    """creates the parsed reference files for a new .dat file in ref_dir,
+    only parsing the records that changed compared to the previous version in old_ref_dir.
+    Falls back to a full rebuild (make_parsed_files) if the previous version is missing or inconsistent
+    or if more than max_changes (fraction) of all records changed.
+    Writes a change manifest (see read_change_manifest) to ref_dir.
+
+    :return: release version, change manifest (dict)
+    """
+    from .reference_index import make_reference_index, load_reference_index, diff_indices
+
+    ipd_file = os.path.join(ref_dir, f"{target}.dat")
+    old_ipd_file = os.path.join(old_ref_dir, f"{target}.dat")
+    manifest = {"target": target, "mode": "full", "old_version": None, "new_version": None,
+                "added": None, "changed": None, "removed": None}
+    try:
+        with open(os.path.join(old_ref_dir, f"curr_version_{target}.txt")) as f:
+            manifest["old_version"] = f.read().strip()
+    except OSError:
+        pass
+
+    version = None
+    if os.path.isfile(old_ipd_file):
+        try:
+            log.debug("\t\tComparing new reference file to previous version...")
+            new_index = make_reference_index(ipd_file, target.upper(), log)
+            old_index = load_reference_index(old_ipd_file, target.upper(), log)
+            diff = diff_indices(old_index, new_index)
+            manifest.update(diff)
+            num_changes = len(diff["added"]) + len(diff["changed"]) + len(diff["removed"])
+            log.debug(f"\t\t\t=> {len(diff['added'])} added, {len(diff['changed'])} changed, "
+                      f"{len(diff['removed'])} removed records")
+            if len(new_index["offsets"]) != new_index["records"]:
+                log.info("\t\tReference file contains records with duplicate or missing names => full rebuild")
+            elif num_changes > max_changes * max(len(new_index["offsets"]), 1):
+                log.info("\t\tToo many changed records for an incremental update => full rebuild")
+            else:
+                version = patch_parsed_files(target, ref_dir, old_ref_dir, new_index, diff, log)
+                manifest["mode"] = "incremental"
+        except Exception as E:
+            log.warning(f"Incremental reference update failed, falling back to full rebuild: {repr(E)}")
+
+    if manifest["mode"] == "full":
+        version = make_parsed_files(target, ref_dir, log, workers=workers)
+    manifest["new_version"] = version
+
+    manifest_file = get_manifest_file(ref_dir, target)
+    log.debug(f"\t\tWriting {manifest_file}...")
+    with open(manifest_file, "w") as g:
+        json.dump(manifest, g, indent=1)
+    return version, manifest
+
 if __name__ == '__main__':
     pass
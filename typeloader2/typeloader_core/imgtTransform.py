@@ -1,5 +1,9 @@
 #!/usr/bin/env python
 
+from bisect import bisect_left, insort
+from collections import Counter
+from itertools import accumulate
+
 def constructCDS(features, coordinates):
     exonCoordinates = [coordinates[featureIndex] for featureIndex in range(len(features)) if features[featureIndex][1] == "e"]
     cdsMap = {}
@@ -13,18 +17,36 @@ def constructCDS(features, coordinates):
 
     return cdsMap
 
-def transformPos(pos_orig, cdsMap, sum_deletes_before, sum_inserts_before, sum_cds_deletes_before, sum_cds_inserts_before):
+def getCdsTable(cdsMap):
+    """returns the exon interval table of a cdsMap: the exon regions in sorted order
+    and the running maximum of their end positions
+    """
+    cdsRegions = sorted(cdsMap.keys())
+    return cdsRegions, list(accumulate((region[1] for region in cdsRegions), max))
+
+def findCdsRegion(pos, cdsTable):
+    """returns the first exon region (in sorted order) containing pos, or None
+    """
+    cdsRegions, maxEnds = cdsTable
+    # all regions before the first one whose running maximum end reaches pos end before pos:
+    regionIndex = bisect_left(maxEnds, pos)
+    if regionIndex < len(cdsRegions) and cdsRegions[regionIndex][0] <= pos:
+        return cdsRegions[regionIndex]
+    return None
+
+def transformPos(pos_orig, cdsMap, sum_deletes_before, sum_inserts_before, sum_cds_deletes_before, sum_cds_inserts_before,
+                 cdsTable=None):
     
     pos = pos_orig - sum_deletes_before
-    cdsRegions = list(cdsMap.keys())
-    cdsRegions.sort()
+    if cdsTable is None:
+        cdsTable = getCdsTable(cdsMap)
 
-    for region in cdsRegions:
-        if (pos >= region[0]) and (pos <= region[1]):
-            newRegion = cdsMap[region]
-            newPosition = newRegion[0] + (pos - region[0]) - sum_cds_inserts_before + sum_cds_deletes_before
-            codonIndex = newPosition / 3 # codon length = 3
-            return (newPosition, codonIndex)
+    region = findCdsRegion(pos, cdsTable)
+    if region:
+        newRegion = cdsMap[region]
+        newPosition = newRegion[0] + (pos - region[0]) - sum_cds_inserts_before + sum_cds_deletes_before
+        codonIndex = newPosition / 3 # codon length = 3
+        return (newPosition, codonIndex)
 
     return (pos_orig - sum_inserts_before, None)
 
@@ -53,27 +75,40 @@ def changeToImgtCoords(features, coordinates, differences, utr5Length = 0):
         
         imgtCoordinates.append((ft_start, ft_end))
 
-    # shift positions for preceding inDels:
-    ins_in_cds = []
-    del_in_cds = []
+    # shift positions for preceding inDels
+    # (the inDels before each position are counted by bisection in sorted position lists;
+    # inDels located in the CDS are recognized by their position, as they are added to ins_in_cds & del_in_cds):
+    cdsTable = getCdsTable(cdsMap)
+    ins_in_cds = set()
+    del_in_cds = set()
     for key in ["deletionPositions", "insertionPositions", "mismatchPositions"]:
         imgtDifferences[key] = []
         new_diff = []
+        deletions = sorted(differences["deletionPositions"])
+        insertions = sorted(differences["insertionPositions"])
+        cds_deletions = [posx for posx in deletions if posx in del_in_cds]
+        cds_insertions = [posx for posx in insertions if posx in ins_in_cds]
+        num_occurrences = Counter(differences[key])
         for pos in differences[key]:
-            sum_deletes_before = sum([1 for posx in differences["deletionPositions"] if posx < pos])
-            sum_cds_deletes_before = sum([1 for posx in differences["deletionPositions"] if posx < pos and posx in del_in_cds])
-            sum_inserts_before = sum([1 for posx in differences["insertionPositions"] if posx < pos])
-            sum_cds_inserts_before = sum([1 for posx in differences["insertionPositions"] if posx < pos and posx in ins_in_cds])
-            newpos = transformPos(pos, cdsMap, sum_deletes_before, sum_inserts_before, sum_cds_deletes_before, sum_cds_inserts_before)
+            sum_deletes_before = bisect_left(deletions, pos)
+            sum_cds_deletes_before = bisect_left(cds_deletions, pos)
+            sum_inserts_before = bisect_left(insertions, pos)
+            sum_cds_inserts_before = bisect_left(cds_insertions, pos)
+            newpos = transformPos(pos, cdsMap, sum_deletes_before, sum_inserts_before, sum_cds_deletes_before, sum_cds_inserts_before,
+                                  cdsTable)
             imgtDifferences[key].append(newpos)
-#             print(key, pos, sum_inserts_before, sum_deletes_before, sum_cds_deletes_before, sum_cds_inserts_before, newpos)
             # adjust differences[key] for preceding insertions:
             if newpos[1]: # if change located in CDS
                 new_diff.append(pos)
-                if key == "insertionPositions":
-                    ins_in_cds.append(pos)
-                elif key == "deletionPositions":
-                    del_in_cds.append(pos)
+                # (all occurrences of the position count as CDS changes for the following positions)
+                if key == "insertionPositions" and pos not in ins_in_cds:
+                    ins_in_cds.add(pos)
+                    for _ in range(num_occurrences[pos]):
+                        insort(cds_insertions, pos)
+                elif key == "deletionPositions" and pos not in del_in_cds:
+                    del_in_cds.add(pos)
+                    for _ in range(num_occurrences[pos]):
+                        insort(cds_deletions, pos)
             else:
                 new_diff.append(newpos[0])
         differences[key] = new_diff
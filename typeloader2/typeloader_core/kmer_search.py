@@ -0,0 +1,353 @@
+#!/usr/bin/env python
+
+"""
+kmer_search.py
+
+in-process closest allele search of TypeLoader, used instead of BLAST if the user setting
+'closest_allele_engine' is 'kmer':
+the reference alleles are indexed by their k-mer minimizers (numpy arrays saved next to the parsed fasta file),
+candidate alleles are ranked by the number of minimizers they share with the query,
+and the best candidates are aligned to the query along chained exact k-mer anchors;
+only the stretches between anchors and the sequence ends are aligned by dynamic programming
+(within a band around the anchors)
+"""
+import os
+from bisect import bisect_left
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+try:
+    from .reference_index import get_file_stamp, read_reference_sequence
+    from .reference_cache import reference_cache, get_version_token
+    from .closestallele import AlignedHit
+except ImportError:
+    from reference_index import get_file_stamp, read_reference_sequence
+    from reference_cache import reference_cache, get_version_token
+    from closestallele import AlignedHit
+
+KMER_INDEX_FORMAT = 1  # increase if the content of the k-mer index file changes
+KMER_LENGTH = 16  # 2 bits per base => fits into uint32
+MINIMIZER_WINDOW = 8  # one minimizer is chosen from each window of MINIMIZER_WINDOW consecutive k-mers
+MAX_CANDIDATES = 10  # number of candidate alleles aligned per query
+CANDIDATE_FRACTION = 0.9  # candidates need at least this fraction of the best number of shared minimizers
+BAND = 50  # additional reference bases aligned at the sequence ends
+
+BASE_CODES = np.full(256, 255, dtype=np.uint8)
+for (code, bases) in enumerate(["Aa", "Cc", "Gg", "Tt"]):
+    for base in bases:
+        BASE_CODES[ord(base)] = code
+
+
+# ===========================================================
+# k-mers & index:
+
+def get_kmer_codes(seq):
+    """returns the 2-bit encoded k-mers starting at each position of seq (numpy uint32 array)
+    and a boolean array marking the valid ones (containing only A, C, G & T)
+    """
+    bases = BASE_CODES[np.frombuffer(str(seq).encode(), dtype=np.uint8)]
+    num = len(bases) - KMER_LENGTH + 1
+    if num <= 0:
+        return np.zeros(0, dtype=np.uint32), np.zeros(0, dtype=bool)
+    codes = np.zeros(num, dtype=np.uint32)
+    invalid = np.zeros(num, dtype=bool)
+    for i in range(KMER_LENGTH):
+        window = bases[i:i + num]
+        codes = (codes << np.uint32(2)) | (window & 3).astype(np.uint32)
+        invalid |= window > 3
+    return codes, ~invalid
+
+
+def get_minimizers(seq):
+    """returns the minimizers of seq (k-mer codes, numpy array): from each window of MINIMIZER_WINDOW
+    consecutive k-mers, the one with the smallest hash value is chosen
+    """
+    (codes, valid) = get_kmer_codes(seq)
+    hashes = codes * np.uint32(0x9E3779B1)  # scrambles the k-mers, so minimizers are not biased towards poly-A
+    hashes ^= hashes >> np.uint32(16)
+    hashes[~valid] = np.iinfo(np.uint32).max
+    if len(hashes) < MINIMIZER_WINDOW:
+        return codes[valid]
+    windows = sliding_window_view(hashes, MINIMIZER_WINDOW)
+    positions = np.unique(windows.argmin(axis=1) + np.arange(len(windows)))
+    return codes[positions[valid[positions]]]
+
+
+def get_kmer_index_file(fasta_file):
+    """returns the path of the k-mer index file belonging to a reference fasta file
+    """
+    return fasta_file + ".kmeridx"
+
+
+def make_kmer_index(fasta_file, log, write=True):
+    """creates the k-mer index of a reference fasta file: the minimizers of all reference sequences,
+    sorted, with the number of the reference sequence containing them
+
+    :param fasta_file: path to the reference fasta file
+    :param log: logger instance
+    :param write: if True, the index is saved next to the fasta file
+    :return: the index (dict of numpy arrays)
+    """
+    from Bio.SeqIO.FastaIO import SimpleFastaParser
+
+    log.debug(f"\t\tCreating k-mer index of {fasta_file}...")
+    names = []
+    minimizers = []
+    with open(fasta_file) as f:
+        for (header, seq) in SimpleFastaParser(f):
+            names.append(header.split()[0] if header else "")
+            minimizers.append(np.unique(get_minimizers(seq)))
+
+    refs = np.repeat(np.arange(len(names), dtype=np.uint32), [len(codes) for codes in minimizers])
+    kmers = np.concatenate(minimizers) if minimizers else np.zeros(0, dtype=np.uint32)
+    order = np.argsort(kmers, kind="stable")  # stable => sorted by reference number per k-mer
+    index = {"format": np.array(KMER_INDEX_FORMAT),
+             "stamp": np.array(get_file_stamp(fasta_file)),
+             "names": np.array(names),
+             "kmers": kmers[order],
+             "refs": refs[order]}
+    log.debug(f"\t\t\t=> indexed {len(names)} sequences with {len(kmers)} minimizers")
+
+    if write:
+        with open(get_kmer_index_file(fasta_file), "wb") as g:
+            np.savez(g, **index)
+    return index
+
+
+def load_kmer_index(fasta_file, log):
+    """reads the k-mer index of a reference fasta file;
+    if it does not exist yet or belongs to an older version of the fasta file, the index is (re-)created
+    """
+    index_file = get_kmer_index_file(fasta_file)
+    index = None
+    if os.path.isfile(index_file):
+        try:
+            with np.load(index_file) as data:
+                index = {key: data[key] for key in data.files}
+        except (ValueError, KeyError, OSError) as E:
+            log.warning(f"Could not read k-mer index {index_file}: {repr(E)}")
+    if index and index.get("format") == KMER_INDEX_FORMAT \
+            and tuple(index["stamp"]) == get_file_stamp(fasta_file):
+        return index
+
+    log.info(f"K-mer index of {os.path.basename(fasta_file)} missing or outdated, creating it...")
+    try:
+        return make_kmer_index(fasta_file, log)
+    except OSError as E:  # e.g., no write permission in the reference dir
+        log.warning(f"Could not save k-mer index: {repr(E)}")
+        return make_kmer_index(fasta_file, log, write=False)
+
+
+def get_kmer_index(fasta_file, log):
+    """returns the k-mer index of a reference fasta file from the shared reference cache
+    """
+    (path, version_token) = get_version_token(fasta_file)
+    return reference_cache.get(("kmer_index", path, version_token),
+                               lambda: load_kmer_index(fasta_file, log),
+                               lambda index: sum(value.nbytes for value in index.values()))
+
+
+def rank_candidates(index, seq):
+    """ranks the reference sequences by the number of minimizers they share with seq
+
+    :return: list of reference numbers (most shared minimizers first, then in order of the fasta file)
+    """
+    codes = np.unique(get_minimizers(seq))
+    first = np.searchsorted(index["kmers"], codes, side="left")
+    counts = np.searchsorted(index["kmers"], codes, side="right") - first
+    if not counts.sum():
+        return []
+    positions = np.repeat(first - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+    scores = np.bincount(index["refs"][positions], minlength=len(index["names"]))
+    candidates = np.flatnonzero(scores >= CANDIDATE_FRACTION * scores.max())
+    candidates = candidates[np.argsort(-scores[candidates], kind="stable")]
+    return [int(ref_id) for ref_id in candidates[:MAX_CANDIDATES]]
+
+
+# ===========================================================
+# alignment:
+
+def get_aligner(free_start=False, free_end=False):
+    """returns a Biopython aligner using the BLAST scores for megablast;
+    gaps before (free_start) or after (free_end) the aligned sequences are not penalized
+    """
+    from Bio import Align
+
+    aligner = Align.PairwiseAligner()
+    aligner.mode = "global"
+    aligner.match_score = 1
+    aligner.mismatch_score = -2
+    aligner.gap_score = -2.5
+    if free_start:
+        aligner.target_left_gap_score = 0
+        aligner.query_left_gap_score = 0
+    if free_end:
+        aligner.target_right_gap_score = 0
+        aligner.query_right_gap_score = 0
+    return aligner
+
+
+def align_segment(ref_seg, query_seg, aligner):
+    """aligns two (short) sequence stretches, returns the aligned reference & query (strings incl. gaps)
+    """
+    if not ref_seg or not query_seg:
+        return ref_seg + "-" * len(query_seg), query_seg + "-" * len(ref_seg)
+    alignment = aligner.align(ref_seg, query_seg)[0]
+    return alignment[0], alignment[1]
+
+
+def get_anchors(ref_seq, query_seq):
+    """finds exact matches between both sequences via k-mers occurring only once in each,
+    chains them colinearly (longest increasing chain) and merges them into non-overlapping anchors
+
+    :return: list of (query start, reference start, length)
+    """
+    (query_codes, query_valid) = get_kmer_codes(query_seq)
+    (ref_codes, ref_valid) = get_kmer_codes(ref_seq)
+
+    def unique_kmers(codes, valid):
+        (values, first, counts) = np.unique(codes[valid], return_index=True, return_counts=True)
+        return values[counts == 1], np.flatnonzero(valid)[first[counts == 1]]
+
+    (query_values, query_positions) = unique_kmers(query_codes, query_valid)
+    (ref_values, ref_positions) = unique_kmers(ref_codes, ref_valid)
+    (_, query_i, ref_i) = np.intersect1d(query_values, ref_values, assume_unique=True, return_indices=True)
+    order = np.argsort(query_positions[query_i])
+    hits = list(zip(query_positions[query_i][order].tolist(), ref_positions[ref_i][order].tolist()))
+
+    # longest chain of hits increasing in both sequences:
+    tails = []  # reference positions ending the best chain of each length
+    tail_hits = []
+    previous = [None] * len(hits)
+    for (i, (_, ref_pos)) in enumerate(hits):
+        n = bisect_left(tails, ref_pos)
+        previous[i] = tail_hits[n - 1] if n else None
+        if n == len(tails):
+            tails.append(ref_pos)
+            tail_hits.append(i)
+        else:
+            tails[n] = ref_pos
+            tail_hits[n] = i
+    chain = []
+    i = tail_hits[-1] if tail_hits else None
+    while i is not None:
+        chain.append(hits[i])
+        i = previous[i]
+    chain.reverse()
+
+    # merge hits on the same diagonal, then remove overlaps between consecutive anchors:
+    runs = []
+    for (query_pos, ref_pos) in chain:
+        if runs and query_pos == runs[-1][0] + runs[-1][2] - KMER_LENGTH + 1 \
+                and ref_pos == runs[-1][1] + runs[-1][2] - KMER_LENGTH + 1:
+            runs[-1][2] += 1
+        else:
+            runs.append([query_pos, ref_pos, KMER_LENGTH])
+    anchors = []
+    for (query_pos, ref_pos, length) in runs:
+        if anchors:
+            (last_query, last_ref, last_length) = anchors[-1]
+            overlap = max(last_query + last_length - query_pos, last_ref + last_length - ref_pos, 0)
+            if overlap >= length:
+                continue
+            (query_pos, ref_pos, length) = (query_pos + overlap, ref_pos + overlap, length - overlap)
+        anchors.append((query_pos, ref_pos, length))
+    return anchors
+
+
+def align_to_reference(ref_seq, query_seq):
+    """aligns a query to a reference sequence along their exact k-mer anchors;
+    like in BLAST, the alignment starts and ends with identical bases,
+    so unaligned query bases at either end are left out (to be handled by closestallele.fix_incomplete_alignment)
+
+    :return: (query start, reference start (both 0-based), aligned query, aligned reference), or None
+    """
+    anchors = get_anchors(ref_seq, query_seq)
+    if not anchors:
+        return None
+    aligned_query, aligned_ref = [], []
+
+    # sequence start (only BAND more reference bases than query bases are considered):
+    (query_pos, ref_pos, _) = anchors[0]
+    ref_from = max(0, ref_pos - query_pos - BAND)
+    (ref_part, query_part) = align_segment(ref_seq[ref_from:ref_pos], query_seq[:query_pos],
+                                           get_aligner(free_start=True))
+    aligned_query.append(query_part)
+    aligned_ref.append(ref_part)
+
+    inner_aligner = get_aligner()
+    for (i, (query_pos, ref_pos, length)) in enumerate(anchors):
+        aligned_query.append(query_seq[query_pos:query_pos + length])
+        aligned_ref.append(ref_seq[ref_pos:ref_pos + length])
+        if i + 1 < len(anchors):
+            (next_query, next_ref, _) = anchors[i + 1]
+            (ref_part, query_part) = align_segment(ref_seq[ref_pos + length:next_ref],
+                                                   query_seq[query_pos + length:next_query], inner_aligner)
+            aligned_query.append(query_part)
+            aligned_ref.append(ref_part)
+
+    # sequence end:
+    (query_end, ref_end) = (query_pos + length, ref_pos + length)
+    ref_to = ref_end + len(query_seq) - query_end + BAND
+    (ref_part, query_part) = align_segment(ref_seq[ref_end:ref_to], query_seq[query_end:],
+                                           get_aligner(free_end=True))
+    aligned_query.append(query_part)
+    aligned_ref.append(ref_part)
+
+    aligned_query = "".join(aligned_query)
+    aligned_ref = "".join(aligned_ref)
+    first = 0
+    while aligned_query[first] != aligned_ref[first]:
+        first += 1
+    last = len(aligned_query)
+    while aligned_query[last - 1] != aligned_ref[last - 1]:
+        last -= 1
+    query_start = len(aligned_query[:first]) - aligned_query[:first].count("-")
+    ref_start = ref_from + len(aligned_ref[:first]) - aligned_ref[:first].count("-")
+    return query_start, ref_start, aligned_query[first:last], aligned_ref[first:last]
+
+
+# ===========================================================
+# search:
+
+def find_closest_allele(parsedFasta, seq, log):
+    """finds the closest reference allele of a sequence: the best scoring alignment among the candidates
+    sharing the most minimizers with the sequence
+
+    :return: closestallele.AlignedHit, or None if no similar reference allele was found
+    """
+    index = get_kmer_index(parsedFasta, log)
+    seq = str(seq).upper()
+    best_hit = None
+    for ref_id in rank_candidates(index, seq):
+        name = str(index["names"][ref_id])
+        ref_seq = str(read_reference_sequence(parsedFasta, name, log)).upper()
+        alignment = align_to_reference(ref_seq, seq)
+        if not alignment:
+            continue
+        (query_start, ref_start, aligned_query, aligned_ref) = alignment
+        hit = AlignedHit(name, len(ref_seq), query_start + 1, ref_start + 1, aligned_query, aligned_ref, len(seq))
+        if not best_hit or hit.score > best_hit.score:  # ties: first candidate wins
+            best_hit = hit
+    return best_hit
+
+
+def search_closest_alleles(fastaFilename, parsedFasta, log):
+    """finds the closest reference allele of each sequence of a fasta file
+
+    :return: list of (fasta header, closestallele.AlignedHit), or False if any sequence has no similar allele
+    """
+    from Bio.SeqIO.FastaIO import SimpleFastaParser
+
+    hits = []
+    with open(fastaFilename) as f:
+        for (header, seq) in SimpleFastaParser(f):
+            log.debug(f"\tSearching closest allele of {header.split()[0]} via k-mers...")
+            hit = find_closest_allele(parsedFasta, seq, log)
+            if not hit:
+                log.info(f"\t=> no similar allele found for {header.split()[0]}")
+                return False
+            log.debug(f"\t=> {hit.name} ({hit.identities}/{hit.align_length} identical)")
+            hits.append((header, hit))
+    return hits
@@ -1,14 +1,18 @@
 #!/usr/bin/env python
 
 import contextlib
-import re, os
+import logging
+import re, os, sys
+from logging.handlers import BufferingHandler
+from concurrent.futures import ProcessPoolExecutor
 from zipfile import ZipFile
 from configparser import ConfigParser
 
 from .befundparser import getOtherAlleles
-from .coordinates import getCoordinates
+from .coordinates import getCoordinates, getCoordinates_batch
 from .imgt_text_generator import make_imgt_text
 from .errors import BothAllelesNovelError, InvalidPretypingError
+from .hla_embl_parser import get_num_workers
 from os import path
 from functools import reduce
 
@@ -111,6 +115,99 @@ def update_IPD_counter(new_value, cf, config_file, lock_file, log):
     return True
 
 
+def get_target_reference(gene, geneMap, settings):
+    """returns the target family and the reference .dat file of a gene
+    """
+    # search the current targetfamily and allele DB
+    # FF from ENA Email
+    if re.search(geneMap["gene"][1], gene):
+        targetFamily = geneMap["gene"][1]
+        allelesFilename = os.path.join(settings["dat_path"], settings["general_dir"],
+                                       settings["reference_dir"], settings["kir_dat"])
+    else:
+        targetFamily = geneMap["gene"][0]
+        allelesFilename = os.path.join(settings["dat_path"], settings["general_dir"],
+                                       settings["reference_dir"], settings["hla_dat"])
+    return targetFamily, allelesFilename
+
+
+def annotate_samples(project_dir, samples, file_dic, geneMapENA, geneMap, settings, log):
+    """annotates the alleles of all samples of a submission in one batch, reading each reference only once
+    (serially: annotating one allele takes only milliseconds, less than starting worker processes);
+    samples with missing files or gene are left out (they are reported by make_imgt_data)
+
+    :return: dict of format {blast.xml path: annotations or Exception}
+    """
+    items = []
+    for (sample, local_name, _) in samples:
+        try:
+            blastOp = path.join(project_dir, sample, file_dic[local_name]["blast_xml"])
+            gene = geneMapENA[local_name]
+        except (KeyError, TypeError):
+            continue
+        if path.exists(blastOp):
+            (targetFamily, allelesFilename) = get_target_reference(gene, geneMap, settings)
+            items.append((blastOp, allelesFilename, targetFamily))
+    log.debug(f"\tAnnotating {len(items)} alleles...")
+    results = getCoordinates_batch(items, settings, log, incomplete_ok=True)
+    return {blastOp: annotations for ((blastOp, _, _), annotations) in zip(items, results)}
+
+
+def render_imgt_text(text_args, settings, log_name, log_level):
+    """worker function for parallel IPD file creation: renders the IPD text of one allele
+    (text_args = arguments of make_imgt_text without settings & log);
+    returns the text (or the error raised) plus the log records written meanwhile,
+    so the main process can pass them to its own log handlers
+    (worker processes don't have these handlers, e.g. on Windows)
+    """
+    log = logging.Logger(log_name, log_level)  # independent of any handlers of the worker process
+    handler = BufferingHandler(sys.maxsize)
+    log.addHandler(handler)
+    try:
+        result = make_imgt_text(*text_args, settings, log)
+    except Exception as E:
+        result = E
+    records = []
+    for record in handler.buffer:  # make the records picklable
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        records.append(record)
+    return result, records
+
+
+def render_imgt_texts(text_args_list, settings, log):
+    """renders the IPD texts of all alleles, using several processes if configured;
+    BothAllelesNovelError and InvalidPretypingError are returned instead of raised
+
+    :return: list of IPD texts or errors, in the order of text_args_list
+    """
+    workers = min(get_num_workers(settings.get("parse_workers", 1)), len(text_args_list))
+    results = []
+    if workers > 1:
+        log.debug(f"\tCreating {len(text_args_list)} IPD texts with {workers} processes...")
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(render_imgt_text, text_args, settings, log.name, log.getEffectiveLevel())
+                       for text_args in text_args_list]
+            for future in futures:
+                (result, records) = future.result()
+                for record in records:
+                    log.handle(record)
+                if isinstance(result, Exception) and \
+                        not isinstance(result, (BothAllelesNovelError, InvalidPretypingError)):
+                    raise result
+                results.append(result)
+    else:
+        for text_args in text_args_list:
+            try:
+                results.append(make_imgt_text(*text_args, settings, log))
+            except (BothAllelesNovelError, InvalidPretypingError) as E:
+                results.append(E)
+    return results
+
+
 def make_imgt_data(project_dir, samples, file_dic, allele_dic, cellEnaIdMap, geneMapENA, befund_csv_file,
                    settings, log):
     log.debug("Making IPD data...")
@@ -147,6 +244,10 @@ def make_imgt_data(project_dir, samples, file_dic, allele_dic, cellEnaIdMap, gen
     variablePartLength = settings["ipd_submission_length"]
     multi_dic = {}  # contains alleles with multiple novel alleles
     problem_dic = {}  # contains alleles with invalid pretypings
+    text_jobs = []  # (submissionId, sample, local_name) per IPD text to render
+    text_args_list = []
+
+    batch_annotations = annotate_samples(project_dir, samples, file_dic, geneMapENA, geneMap, settings, log)
 
     for (sample, local_name, IPD_ID) in samples:
         enafile = path.join(project_dir, sample, file_dic[local_name]["ena_file"])
@@ -181,16 +282,7 @@ def make_imgt_data(project_dir, samples, file_dic, allele_dic, cellEnaIdMap, gen
                 os.remove(lock_file)
             return False, msg, None
 
-        # search the current targetfamily and allele DB
-        # FF from ENA Email
-        if re.search(geneMap["gene"][1], gene):
-            targetFamily = geneMap["gene"][1]
-            allelesFilename = os.path.join(settings["dat_path"], settings["general_dir"],
-                                           settings["reference_dir"], settings["kir_dat"])
-        else:
-            targetFamily = geneMap["gene"][0]
-            allelesFilename = os.path.join(settings["dat_path"], settings["general_dir"],
-                                           settings["reference_dir"], settings["hla_dat"])
+        (targetFamily, allelesFilename) = get_target_reference(gene, geneMap, settings)
         geneMap["targetFamily"] = targetFamily
 
         try:
@@ -206,8 +298,12 @@ def make_imgt_data(project_dir, samples, file_dic, allele_dic, cellEnaIdMap, gen
 
         newAlleleStub = getNewAlleleNameFromEna(enafile).split(":")[0]
         try:
-            annotations = getCoordinates(blastOp, allelesFilename, targetFamily, settings, log, isENA=False,
-                                         incomplete_ok=True)
+            annotations = batch_annotations.get(blastOp)
+            if annotations is None:
+                annotations = getCoordinates(blastOp, allelesFilename, targetFamily, settings, log, isENA=False,
+                                             incomplete_ok=True)
+            elif isinstance(annotations, Exception):
+                raise annotations
         except KeyError as E:
             log.exception(E)
             with contextlib.suppress(FileNotFoundError):
@@ -263,16 +359,21 @@ def make_imgt_data(project_dir, samples, file_dic, allele_dic, cellEnaIdMap, gen
         else:
             cell_line = local_name
 
-        try:
-            imgt_data[submissionId] = make_imgt_text(submissionId, cell_line, local_name, allele_dic[local_name],
-                                                     enaId, befund,
-                                                     closestAllele, diffToClosest, imgtDiff,
-                                                     enafile, sequence, geneMap, missing_bp, missing_bp_end,
-                                                     settings, log)
-        except BothAllelesNovelError as E:
-            multi_dic[local_name] = [sample, local_name, E.allele, E.alleles]
-        except InvalidPretypingError as E:
-            problem_dic[local_name] = [sample, local_name, E.locus, E.allele_name, E.alleles, E.problem]
+        text_jobs.append((submissionId, sample, local_name))
+        text_args_list.append((submissionId, cell_line, local_name, allele_dic[local_name], enaId, befund,
+                               closestAllele, diffToClosest, imgtDiff,
+                               enafile, sequence, dict(geneMap), missing_bp, missing_bp_end))
+
+    # render the IPD texts (submission IDs are already assigned above, so the result doesn't depend on the order):
+    for ((submissionId, sample, local_name), result) in zip(text_jobs,
+                                                             render_imgt_texts(text_args_list, settings, log)):
+        if isinstance(result, BothAllelesNovelError):
+            multi_dic[local_name] = [sample, local_name, result.allele, result.alleles]
+        elif isinstance(result, InvalidPretypingError):
+            problem_dic[local_name] = [sample, local_name, result.locus, result.allele_name, result.alleles,
+                                       result.problem]
+        else:
+            imgt_data[submissionId] = result
 
     if settings["modus"] == "productive":
         update_IPD_counter(submissionCounter, counter_cf, config_file, lock_file, log)
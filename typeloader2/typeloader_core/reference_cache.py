@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+
+"""
+reference_cache.py
+
+process-wide cache for parsed reference data (reference alleles, reference fasta sequences),
+shared by all reference lookups of one TypeLoader session.
+
+Entries are keyed by file path plus the reference version & MD5 checksum of the reference they belong to,
+so files replaced by a reference update are never served from the cache.
+The version token of each reference file is only read once and kept until its directory is invalidated
+(which every function writing reference files does) or the size or modification time of the file change
+(e.g., because another TypeLoader session updated the shared reference files).
+If the cache grows beyond its memory cap, the least recently used entries are evicted.
+"""
+import os
+import threading
+from collections import OrderedDict
+
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024  # memory cap of the shared cache
+
+
+# ===========================================================
+# classes:
+
+class ReferenceCache:
+    """LRU cache for parsed reference data with a memory cap (in bytes, estimated by the caller)
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # key => (value, size)
+        self.tokens = {}  # absolute path of a reference file => its version token
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.RLock()
+
+    def get(self, key, load_func, size_func=None):
+        """returns the cached value for key;
+        on a cache miss, the value is created by calling load_func() and stored
+
+        :param key: hashable key; by convention a tuple starting with (kind, path, version_token)
+        :param load_func: function without arguments that creates the value
+        :param size_func: function returning the estimated size of the value in bytes
+        """
+        with self.lock:
+            if key in self.entries:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                return self.entries[key][0]
+            self.misses += 1
+
+        value = load_func()
+        size = size_func(value) if size_func else 0
+
+        with self.lock:
+            if key not in self.entries:
+                self.entries[key] = (value, size)
+                self.size += size
+                self.evict()
+        return value
+
+    def evict(self):
+        """removes least recently used entries until the cache fits into its memory cap
+        (the most recent entry is always kept)
+        """
+        with self.lock:
+            while self.size > self.max_bytes and len(self.entries) > 1:
+                (_, (_, size)) = self.entries.popitem(last=False)
+                self.size -= size
+                self.evictions += 1
+
+    def get_token(self, ref_file):
+        """returns the absolute path of a reference file plus its version token (see read_version_token),
+        which is only read once (until the directory of the file is invalidated);
+        if the file was changed meanwhile, all entries of its directory are removed and the token is read again
+        """
+        ref_file = os.path.abspath(ref_file)
+        stamp = read_file_stamp(ref_file)
+        with self.lock:
+            if ref_file in self.tokens:
+                if self.tokens[ref_file][-2:] == stamp:
+                    return ref_file, self.tokens[ref_file]
+                self.invalidate(os.path.dirname(ref_file))  # replaced without invalidating the cache
+        (_, token) = read_version_token(ref_file)
+        if token[-1] is not None:  # files not existing yet are checked again next time
+            with self.lock:
+                token = self.tokens.setdefault(ref_file, token)
+        return ref_file, token
+
+    def invalidate(self, ref_dir=None):
+        """removes all entries and version tokens belonging to files in ref_dir
+        (or all of them, if no ref_dir is given)
+        """
+        with self.lock:
+            if ref_dir is None:
+                self.entries.clear()
+                self.tokens.clear()
+                self.size = 0
+                return
+            ref_dir = os.path.abspath(ref_dir)
+            for key in list(self.entries.keys()):
+                if os.path.dirname(key[1]) == ref_dir:
+                    (_, size) = self.entries.pop(key)
+                    self.size -= size
+            for ref_file in list(self.tokens.keys()):
+                if os.path.dirname(ref_file) == ref_dir:
+                    del self.tokens[ref_file]
+
+    def report(self, log):
+        """writes the hit/miss counters of the cache to the log
+        """
+        with self.lock:
+            log.debug(f"Reference cache: {self.hits} hits, {self.misses} misses, {self.evictions} evictions; "
+                      f"{len(self.entries)} entries using ~{self.size / 1024 / 1024:.1f} MB")
+
+
+# ===========================================================
+# functions:
+
+def get_version_token(ref_file):
+    """returns the absolute path of a reference file plus its version token (see read_version_token),
+    as kept by the shared reference cache
+    """
+    return reference_cache.get_token(ref_file)
+
+
+def read_version_token(ref_file):
+    """returns the absolute path of a reference file plus its version token:
+    the reference version and MD5 checksum stored in the curr_version_*.txt and curr_md5_*.txt files next to it
+    (None for each value that cannot be found), plus size and modification time of the file itself
+    """
+    ref_file = os.path.abspath(ref_file)
+    ref_dir = os.path.dirname(ref_file)
+    db_name = os.path.splitext(os.path.basename(ref_file))[0]
+    if db_name.startswith("parsed"):
+        db_name = db_name[len("parsed"):]
+
+    token = []
+    for prefix in ["curr_version", "curr_md5"]:
+        try:
+            with open(os.path.join(ref_dir, f"{prefix}_{db_name}.txt")) as f:
+                token.append(f.read().strip())
+        except OSError:
+            token.append(None)
+    token.extend(read_file_stamp(ref_file))
+    return ref_file, tuple(token)
+
+
+def read_file_stamp(ref_file):
+    """returns size and modification time (in seconds) of a file, (None, None) if it does not exist
+    """
+    try:
+        stat = os.stat(ref_file)
+    except OSError:
+        return None, None
+    return stat.st_size, int(stat.st_mtime)
+
+
+def estimate_allele_size(allele):
+    """estimates the memory used by an Allele object (sequence plus feature arrays)
+    """
+    if allele is None:
+        return 0
+    return len(allele.seq) + 500
+
+
+reference_cache = ReferenceCache()
+
+
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,508 @@
+#!/usr/bin/env python
+
+"""
+reference_index.py
+
+handles the indexed on-disk reference store of TypeLoader:
+for every IPD .dat file, an index file maps each allele name to the byte range of its record,
+so annotation only needs to parse the records of the alleles it actually uses
+instead of the complete .dat file;
+the index also maps each allele name to its gene model in the gene model table (created with the reference),
+so annotation can look up the features & coordinates of the closest allele directly
+"""
+import os
+import zlib
+from array import array
+from bisect import bisect_left, bisect_right
+from hashlib import md5
+from pickle import dump, load, loads, UnpicklingError
+
+try:
+    from . import hla_embl_parser
+    from .reference_cache import reference_cache, get_version_token, estimate_allele_size
+except ImportError:
+    import hla_embl_parser
+    from reference_cache import reference_cache, get_version_token, estimate_allele_size
+
+INDEX_FORMAT = 2  # increase if the content of the index file changes
+SEQUENCE_INDEX_FORMAT = 1  # increase if the content of the sequence index file changes
+SEED_LENGTH = 32  # length of the k-mers in the sequence index
+SEED_STEP = 64  # one k-mer is indexed every SEED_STEP bases of each reference sequence
+
+
+# ===========================================================
+# functions:
+
+def get_index_file(dat_file):
+    """returns the path of the index file belonging to a .dat file
+    """
+    return os.path.splitext(dat_file)[0] + ".idx"
+
+
+def get_file_stamp(dat_file):
+    """returns size and modification time (in seconds) of a file,
+    used to recognize whether an index still belongs to its .dat file
+    """
+    stat = os.stat(dat_file)
+    return stat.st_size, int(stat.st_mtime)
+
+
+def get_record_hash(lines):
+    """returns the content hash of a .dat record (list of lines)
+    """
+    return md5("\n".join(lines).encode("latin-1")).digest()
+
+
+def make_reference_index(dat_file, target, log, write=True):
+    """creates the index of a .dat file (EMBL format),
+    mapping every allele name to (offset, length) of its record in bytes
+    and to the content hash of its record (used for incremental reference updates)
+
+    :param dat_file: path to the IPD .dat file
+    :param target: either 'HLA' or 'KIR'
+    :param log: logger instance
+    :param write: if True, the index is saved next to the .dat file
+    :return: the index (dict)
+    """
+    log.debug(f"\t\tIndexing {dat_file}...")
+    offsets = {}
+    hashes = {}
+    num_records = 0
+    version = ""
+    release_regex = hla_embl_parser.get_release_regex(target)
+    for (offset, length, lines) in hla_embl_parser.iter_raw_records(dat_file):
+        num_records += 1
+        allele_name = hla_embl_parser.get_record_name(lines, target)
+        if allele_name:
+            offsets[allele_name] = (offset, length)
+            hashes[allele_name] = get_record_hash(lines)
+        record_version = hla_embl_parser.get_record_version(lines, release_regex)
+        if record_version:
+            version = record_version
+
+    index = {"format": INDEX_FORMAT,
+             "target": target,
+             "stamp": get_file_stamp(dat_file),
+             "offsets": offsets,
+             "hashes": hashes,
+             "records": num_records,  # number of '//'-terminated records in the file
+             "version": version}
+    log.debug(f"\t\t\t=> indexed {len(offsets)} records")
+
+    if write:
+        index_file = get_index_file(dat_file)
+        log.debug(f"\t\tWriting {index_file}...")
+        with open(index_file, "wb") as g:
+            dump(index, g)
+    return index
+
+
+def index_ok(index, dat_file, target):
+    """checks whether an index (dict) is up to date for the given .dat file
+    """
+    if not isinstance(index, dict):
+        return False
+    if index.get("format") != INDEX_FORMAT or index.get("target") != target:
+        return False
+    if index.get("stamp") != get_file_stamp(dat_file):
+        return False
+    return True
+
+
+def load_reference_index(dat_file, target, log):
+    """reads the index of a .dat file;
+    if it does not exist yet or belongs to an older version of the .dat file, the index is (re-)created
+    """
+    index_file = get_index_file(dat_file)
+    index = None
+    if os.path.isfile(index_file):
+        try:
+            with open(index_file, "rb") as f:
+                index = load(f)
+        except (EOFError, UnpicklingError, OSError) as E:
+            log.warning(f"Could not read reference index {index_file}: {repr(E)}")
+
+    if index_ok(index, dat_file, target):
+        return index
+
+    log.info(f"Reference index for {os.path.basename(dat_file)} missing or outdated, creating it...")
+    try:
+        index = make_reference_index(dat_file, target, log)
+    except OSError as E:  # e.g., no write permission in the reference dir
+        log.warning(f"Could not save reference index: {repr(E)}")
+        index = make_reference_index(dat_file, target, log, write=False)
+    return index
+
+
+def diff_indices(old_index, new_index):
+    """compares the indices of two versions of a .dat file record by record (using the content hashes),
+    returns dict with the lists of added, changed and removed allele names
+    """
+    old_hashes = old_index["hashes"]
+    new_hashes = new_index["hashes"]
+    added = [name for name in new_hashes if name not in old_hashes]
+    changed = [name for name in new_hashes if name in old_hashes and new_hashes[name] != old_hashes[name]]
+    removed = [name for name in old_hashes if name not in new_hashes]
+    return {"added": added, "changed": changed, "removed": removed}
+
+
+def get_reference_index(dat_file, target, log):
+    """returns the index of a .dat file from the shared reference cache
+    (reading or creating it only once per reference version)
+    """
+    (path, version_token) = get_version_token(dat_file)
+    return reference_cache.get(("index", path, version_token, target),
+                               lambda: load_reference_index(dat_file, target, log),
+                               lambda index: 200 * len(index["offsets"]) + 100 * len(index.get("gene_models", {})))
+
+
+def read_alleles(dat_file, target, allele_names, log):
+    """reads only the given alleles from a .dat file, using its index;
+    parsed alleles are kept in the shared reference cache
+
+    :param dat_file: path to the IPD .dat file
+    :param target: either 'HLA' or 'KIR'
+    :param allele_names: iterable of allele names
+    :param log: logger instance
+    :return: dict of format {allele_name: Allele object}; unknown or unusable alleles are left out
+    """
+    index = get_reference_index(dat_file, target, log)
+    (path, version_token) = get_version_token(dat_file)
+    release_regex = hla_embl_parser.get_release_regex(target)
+
+    def parse_allele(offset, length):
+        lines = hla_embl_parser.read_raw_record(dat_file, offset, length)
+        allele, _ = hla_embl_parser.parse_dat_record(lines, target, log, release_regex)
+        return allele
+
+    alleles = {}
+    for allele_name in allele_names:
+        try:
+            (offset, length) = index["offsets"][allele_name]
+        except KeyError:
+            log.warning(f"{allele_name} not found in reference index of {os.path.basename(dat_file)}")
+            continue
+        allele = reference_cache.get(("allele", path, version_token, target, allele_name),
+                                     lambda: parse_allele(offset, length),
+                                     estimate_allele_size)
+        if allele:
+            alleles[allele.name] = allele
+    return alleles
+
+
+def get_gene_model_file(dat_file):
+    """returns the path of the gene model table belonging to a .dat file
+    """
+    return os.path.splitext(dat_file)[0] + ".models"
+
+
+def add_gene_models(dat_file, index, gene_models, log):
+    """adds the positions of the gene models in the gene model table of a .dat file
+    (dict of format {allele_name: (offset, length)}, see hla_embl_parser.GeneModelWriter)
+    to the index of the .dat file and saves it
+    """
+    index["gene_models"] = gene_models
+    index["gene_model_stamp"] = get_file_stamp(get_gene_model_file(dat_file))
+    index_file = get_index_file(dat_file)
+    log.debug(f"\t\tWriting {index_file}...")
+    with open(index_file, "wb") as g:
+        dump(index, g)
+
+
+def read_gene_model(dat_file, target, allele, log):
+    """returns the gene model of a reference allele (see hla_embl_parser.make_gene_model) plus the codons of its CDS,
+    read from the gene model table of the .dat file with a single seek
+    (or created from the allele if the reference has no up-to-date gene model table);
+    gene models are kept in the shared reference cache
+    """
+    index = get_reference_index(dat_file, target, log)
+    (path, version_token) = get_version_token(dat_file)
+
+    def load_gene_model():
+        gene_model = None
+        model_file = get_gene_model_file(dat_file)
+        position = index.get("gene_models", {}).get(allele.name)
+        if position and os.path.isfile(model_file) and index["gene_model_stamp"] == get_file_stamp(model_file):
+            (offset, length) = position
+            try:
+                with open(model_file, "rb") as f:
+                    f.seek(offset)
+                    gene_model = loads(zlib.decompress(f.read(length)))
+            except (zlib.error, EOFError, UnpicklingError, OSError) as E:
+                log.warning(f"Could not read gene model of {allele.name}: {repr(E)}")
+        if not gene_model:
+            gene_model = hla_embl_parser.make_gene_model(allele)
+        gene_model["codons"] = hla_embl_parser.get_codons(gene_model["cdsSequence"])
+        return gene_model
+
+    return reference_cache.get(("gene_model", path, version_token, target, allele.name), load_gene_model,
+                               lambda gene_model: 60 * len(gene_model["codons"]) + 1000)
+
+
+def get_fasta_index_file(fasta_file):
+    """returns the path of the faidx-style index file belonging to a fasta file
+    """
+    return fasta_file + ".fai"
+
+
+def make_fasta_index(fasta_file, log, write=True):
+    """creates a faidx-style index of a fasta file (same format as 'samtools faidx'),
+    mapping every sequence name to (length, byte offset, bases per line, bytes per line)
+
+    :param fasta_file: path to the fasta file
+    :param log: logger instance
+    :param write: if True, the index is saved next to the fasta file
+    :return: the index (dict)
+    """
+    log.debug(f"\t\tIndexing {fasta_file}...")
+    index = {}
+    entry = None
+    offset = 0
+    with open(fasta_file, "rb") as f:
+        for line in f:
+            if line.startswith(b">"):
+                name = line[1:].split()[0].decode()
+                entry = [0, offset + len(line), 0, 0]
+                index[name] = entry
+            elif entry is not None:
+                num_bases = len(line.rstrip(b"\r\n"))
+                if not entry[2]:
+                    entry[2] = num_bases
+                    entry[3] = len(line)
+                entry[0] += num_bases
+            offset += len(line)
+    index = {name: tuple(entry) for (name, entry) in index.items()}
+
+    if write:
+        index_file = get_fasta_index_file(fasta_file)
+        with open(index_file, "w") as g:
+            for (name, entry) in index.items():
+                g.write("\t".join([name] + [str(value) for value in entry]) + "\n")
+    return index
+
+
+def load_fasta_index(fasta_file, log):
+    """reads the faidx-style index of a fasta file;
+    if it does not exist yet or is older than the fasta file, the index is (re-)created
+    """
+    index_file = get_fasta_index_file(fasta_file)
+    if os.path.isfile(index_file) and os.path.getmtime(index_file) >= os.path.getmtime(fasta_file):
+        index = {}
+        with open(index_file) as f:
+            for line in f:
+                [name, length, offset, line_bases, line_width] = line.split("\t")
+                index[name] = (int(length), int(offset), int(line_bases), int(line_width))
+        return index
+
+    log.info(f"Index of {os.path.basename(fasta_file)} missing or outdated, creating it...")
+    try:
+        return make_fasta_index(fasta_file, log)
+    except OSError as E:  # e.g., no write permission in the reference dir
+        log.warning(f"Could not save fasta index: {repr(E)}")
+        return make_fasta_index(fasta_file, log, write=False)
+
+
+def read_reference_sequence(fasta_file, allele_name, log):
+    """reads the sequence of one allele from a reference fasta file with a single seek, using its index;
+    index and sequence are kept in the shared reference cache
+
+    :return: the sequence (Bio.Seq.Seq); raises KeyError if the allele is not contained in the fasta file
+    """
+    from Bio.Seq import Seq
+
+    (path, version_token) = get_version_token(fasta_file)
+    index = reference_cache.get(("fasta_index", path, version_token),
+                                lambda: load_fasta_index(fasta_file, log),
+                                lambda index: 100 * len(index))
+    (length, offset, line_bases, line_width) = index[allele_name]
+
+    def read_sequence():
+        num_bytes = length + (length // line_bases) * (line_width - line_bases) if line_bases else 0
+        with open(fasta_file, "rb") as f:
+            f.seek(offset)
+            data = f.read(num_bytes)
+        return Seq(data.decode().replace("\n", "").replace("\r", ""))
+
+    return reference_cache.get(("sequence", path, version_token, allele_name), read_sequence,
+                               lambda seq: len(seq) + 100)
+
+
+def get_sequence_index_file(fasta_file):
+    """returns the path of the sequence index file belonging to a reference fasta file
+    """
+    return fasta_file + ".seqidx"
+
+
+def get_seed_hash(seq, pos):
+    """returns the hash of the k-mer starting at pos of seq (string)
+    """
+    return zlib.crc32(seq[pos:pos + SEED_LENGTH].encode())
+
+
+def make_sequence_index(fasta_file, log, write=True):
+    """creates the sequence index of a reference fasta file, used to recognize sequences
+    that are identical to or contained in a reference sequence without BLAST:
+    the MD5 hash of every complete sequence, plus the hashes of k-mers sampled every SEED_STEP bases
+    (sorted by hash, with their reference sequence & position)
+
+    :param fasta_file: path to the reference fasta file
+    :param log: logger instance
+    :param write: if True, the index is saved next to the fasta file
+    :return: the index (dict)
+    """
+    from Bio.SeqIO.FastaIO import SimpleFastaParser
+
+    log.debug(f"\t\tCreating sequence index of {fasta_file}...")
+    names = []
+    exact = {}
+    seed_hashes = array("I")
+    seed_refs = array("I")
+    seed_positions = array("I")
+    with open(fasta_file) as f:
+        for (header, seq) in SimpleFastaParser(f):
+            ref_id = len(names)
+            names.append(header.split()[0] if header else "")
+            seq = seq.upper()
+            exact.setdefault(md5(seq.encode()).digest(), ref_id)  # first one wins, like in BLAST
+            for pos in range(0, len(seq) - SEED_LENGTH + 1, SEED_STEP):
+                seed_hashes.append(get_seed_hash(seq, pos))
+                seed_refs.append(ref_id)
+                seed_positions.append(pos)
+
+    order = sorted(range(len(seed_hashes)), key=seed_hashes.__getitem__)  # stable => sorted by ref_id per hash
+    index = {"format": SEQUENCE_INDEX_FORMAT,
+             "stamp": get_file_stamp(fasta_file),
+             "names": names,
+             "exact": exact,
+             "seed_hashes": array("I", (seed_hashes[i] for i in order)),
+             "seed_refs": array("I", (seed_refs[i] for i in order)),
+             "seed_positions": array("I", (seed_positions[i] for i in order))}
+    log.debug(f"\t\t\t=> indexed {len(names)} sequences with {len(order)} k-mers")
+
+    if write:
+        with open(get_sequence_index_file(fasta_file), "wb") as g:
+            dump(index, g)
+    return index
+
+
+def load_sequence_index(fasta_file, log):
+    """reads the sequence index of a reference fasta file;
+    if it does not exist yet or belongs to an older version of the fasta file, the index is (re-)created
+    """
+    index_file = get_sequence_index_file(fasta_file)
+    index = None
+    if os.path.isfile(index_file):
+        try:
+            with open(index_file, "rb") as f:
+                index = load(f)
+        except (EOFError, UnpicklingError, OSError) as E:
+            log.warning(f"Could not read sequence index {index_file}: {repr(E)}")
+    if isinstance(index, dict) and index.get("format") == SEQUENCE_INDEX_FORMAT \
+            and index.get("stamp") == get_file_stamp(fasta_file):
+        return index
+
+    log.info(f"Sequence index of {os.path.basename(fasta_file)} missing or outdated, creating it...")
+    try:
+        return make_sequence_index(fasta_file, log)
+    except OSError as E:  # e.g., no write permission in the reference dir
+        log.warning(f"Could not save sequence index: {repr(E)}")
+        return make_sequence_index(fasta_file, log, write=False)
+
+
+def find_reference_match(fasta_file, seq, log):
+    """checks whether a sequence is identical to or completely contained in a sequence of a reference fasta file
+    (e.g., a known allele with shorter UTRs), using the sequence index
+
+    :param fasta_file: path to the reference fasta file
+    :param seq: the sequence (string)
+    :param log: logger instance
+    :return: (allele name, 1-based start position of seq in the reference sequence), or None if there is no match;
+             identical sequences are preferred, otherwise the first matching sequence of the fasta file is returned
+    """
+    (path, version_token) = get_version_token(fasta_file)
+    index = reference_cache.get(("sequence_index", path, version_token),
+                                lambda: load_sequence_index(fasta_file, log),
+                                lambda index: 12 * len(index["seed_hashes"]) + 150 * len(index["names"]))
+    seq = str(seq).upper()
+    ref_id = index["exact"].get(md5(seq.encode()).digest())
+    if ref_id is not None:
+        return index["names"][ref_id], 1
+
+    # a contained sequence covers the indexed k-mers of its reference sequence at one of SEED_STEP offsets:
+    hashes = index["seed_hashes"]
+    candidates = []
+    for offset in range(SEED_STEP):
+        query_positions = range(offset, len(seq) - SEED_LENGTH + 1, SEED_STEP)
+        if not query_positions:
+            break
+        ranges = []
+        for query_pos in query_positions:
+            seed_hash = get_seed_hash(seq, query_pos)
+            ranges.append((bisect_right(hashes, seed_hash) - bisect_left(hashes, seed_hash),
+                           bisect_left(hashes, seed_hash), query_pos))
+        ranges.sort()  # rarest k-mers first
+        matches = None
+        for (num, first, query_pos) in ranges:
+            starts = {(index["seed_refs"][i], index["seed_positions"][i] - query_pos)
+                      for i in range(first, first + num)}
+            matches = starts if matches is None else matches & starts
+            if not matches:
+                break
+        if matches:
+            candidates.extend(matches)
+
+    for (ref_id, start) in sorted(candidates):
+        if start < 0:
+            continue
+        name = index["names"][ref_id]
+        if str(read_reference_sequence(fasta_file, name, log)[start:start + len(seq)]).upper() == seq:
+            return name, start + 1
+    return None
+
+
+def make_restricted_parsed_files(target, ref_dir, restricted_to, target_dir, log):
+    """creates the parsed reference files of a database restricted to the given alleles,
+    reading only these alleles from the .dat file via its index
+    (creates the same files as make_parsed_files(restricted_to=...), without parsing the complete .dat file)
+
+    :param target: designates target database, either 'KIR' or 'hla'
+    :param ref_dir: path of the complete reference files
+    :param restricted_to: list of allele names
+    :param target_dir: path where to create the restricted files
+    :param log: logger instance
+    :return: version of the reference
+    """
+    dat_file = os.path.join(ref_dir, f"{target}.dat")
+    index = get_reference_index(dat_file, target.upper(), log)
+    restricted_to = set(restricted_to)
+    allele_names = [name for name in index["offsets"] if name in restricted_to]  # keep order of the .dat file
+    alleles = read_alleles(dat_file, target.upper(), allele_names, log)
+
+    os.makedirs(target_dir, exist_ok=True)
+    fa_file = os.path.join(target_dir, f"parsed{target}.fa")
+    dump_file = os.path.join(target_dir, f"parsed{target}.dump")
+    version_file = os.path.join(target_dir, f"curr_version_{target}.txt")
+
+    log.debug("\t\tWriting {} and {}...".format(fa_file, dump_file))
+    with open(fa_file, "w") as fasta_file, open(dump_file, "wb") as g:
+        dump_writer = hla_embl_parser.DictDumpWriter(g)
+        for allele_name in allele_names:
+            if allele_name in alleles:
+                log.debug(f"\t\t\tAdding {allele_name} to database...")
+                fasta_file.write(">%s\n" % allele_name)
+                fasta_file.write("%s\n" % alleles[allele_name].seq)
+                dump_writer.add(allele_name, alleles[allele_name])
+        dump_writer.close()
+    log.debug(f"\t\t\t=> found {len(alleles)} alleles")
+    make_fasta_index(fa_file, log)
+    make_sequence_index(fa_file, log)
+
+    log.debug("\t\tWriting {}...".format(version_file))
+    with open(version_file, "w") as g:
+        g.write(index["version"])
+    reference_cache.invalidate(target_dir)
+    return index["version"]
+
+
+if __name__ == '__main__':
+    pass
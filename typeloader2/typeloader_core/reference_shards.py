@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+
+"""
+reference_shards.py
+
+handles the per-locus BLAST databases ("shards") of TypeLoader's references:
+next to the BLAST database of a complete parsed reference fasta file (e.g. parsedhla.fa),
+one BLAST database is created per locus (e.g. parsedhla.fa.HLA-A),
+so sequences whose locus is given in their fasta header are only BLASTed against the alleles of this locus.
+
+The shards of a reference are listed in its shard manifest (e.g. parsedhla.fa.shards),
+which is written last, so incompletely created shards are never used.
+When a reference is updated, all shards not listed in its new manifest are removed
+(all of them, if the new shards could not be created).
+"""
+import os
+import re
+import json
+import subprocess
+from collections import defaultdict
+
+try:
+    from .EMBLfunctions import fasta_generator
+except ImportError:
+    from EMBLfunctions import fasta_generator
+
+SHARD_MANIFEST_EXT = ".shards"
+
+
+# ===========================================================
+# functions:
+
+def get_locus(allele_name):
+    """returns the locus of a reference allele (e.g., 'HLA-A' for 'HLA-A*01:01:01:01')
+    """
+    return allele_name.split("*")[0]
+
+
+def get_shard_db(fa_file, locus):
+    """returns the path of the BLAST database of the given locus of a parsed reference fasta file
+    """
+    safe_locus = re.sub(r"[^\w-]", "_", locus)
+    return f"{fa_file}.{safe_locus}"
+
+
+def get_manifest_file(fa_file):
+    """returns the path of the shard manifest belonging to a parsed reference fasta file
+    """
+    return fa_file + SHARD_MANIFEST_EXT
+
+
+def make_shard_dbs(fa_file, blast_path, log):
+    """creates one BLAST database per locus of a parsed reference fasta file,
+    then writes the shard manifest;
+    returns success (=BOOL), msg (=String if error; None if not)
+    """
+    log.debug("\tCreating per-locus blast databases...")
+    manifest_file = get_manifest_file(fa_file)
+    if os.path.isfile(manifest_file):
+        os.remove(manifest_file)
+
+    alleles = defaultdict(list)  # locus => list of (header, seq)
+    for (header, seq) in fasta_generator(fa_file):
+        alleles[get_locus(header.split()[0])].append((header, seq))
+
+    makeblastdb = os.path.join(blast_path, "makeblastdb")
+    shards = {}
+    for locus in sorted(alleles):
+        shard_db = get_shard_db(fa_file, locus)
+        with open(shard_db, "w") as g:
+            for (header, seq) in alleles[locus]:
+                g.write(f">{header}\n{seq}\n")
+        cmd_list = [makeblastdb, "-dbtype", "nucl", "-in", shard_db, "-out", shard_db]
+        try:
+            subprocess.run(cmd_list, check=True, shell=False, stdout=subprocess.DEVNULL)
+        except Exception as E:
+            log.exception(E)
+            msg = "Could not create blast database of {}:\n{}\n{}".format(locus, repr(E), " ".join(cmd_list))
+            return False, msg
+        finally:
+            os.remove(shard_db)  # the database contains the sequences
+        shards[locus] = os.path.basename(shard_db)
+
+    with open(manifest_file, "w") as g:
+        json.dump(shards, g, indent=1)
+    log.debug(f"\t=> {len(shards)} loci")
+    return True, None
+
+
+def get_known_loci(fa_file, log):
+    """returns the loci of a parsed reference fasta file plus those listed in its shard manifest
+    (i.e., all loci that may have a shard next to the fasta file)
+    """
+    loci = set(load_shards(fa_file, log))
+    if os.path.isfile(fa_file):
+        loci.update(get_locus(header.split()[0]) for (header, _) in fasta_generator(fa_file))
+    return loci
+
+
+def get_shard_files(ref_dir, fa_name, loci):
+    """returns the files of the per-locus BLAST databases of the given loci
+    of a parsed reference fasta file found in ref_dir (whether listed in the shard manifest or not)
+
+    :return: dict of format {name of shard database: list of file names}
+    """
+    shard_dbs = {get_shard_db(fa_name, locus) for locus in loci}
+    shard_files = defaultdict(list)
+    for myfile in os.listdir(ref_dir):
+        (shard_db, _) = os.path.splitext(myfile)
+        if shard_db in shard_dbs:
+            shard_files[shard_db].append(myfile)
+    return shard_files
+
+
+def remove_shard_files(ref_dir, fa_name, loci, log, keep=()):
+    """removes the files of the per-locus BLAST databases of the given loci
+    of a parsed reference fasta file from ref_dir, except those of the shard databases named in keep
+    """
+    for (shard_db, files) in get_shard_files(ref_dir, fa_name, loci).items():
+        if shard_db in keep:
+            continue
+        log.debug(f"\t\t- removing {shard_db}")
+        for myfile in files:
+            os.remove(os.path.join(ref_dir, myfile))
+
+
+def load_shards(fa_file, log):
+    """returns the per-locus BLAST databases of a parsed reference fasta file
+
+    :return: dict of format {locus: path of BLAST database}; empty if the reference has no shards
+    """
+    try:
+        with open(get_manifest_file(fa_file)) as f:
+            shards = json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as E:
+        log.warning(f"Could not read the shard manifest of {os.path.basename(fa_file)}: {repr(E)}")
+        return {}
+    ref_dir = os.path.dirname(fa_file)
+    return {locus: os.path.join(ref_dir, shard_db) for (locus, shard_db) in shards.items()}
+
+
+def find_locus(header_data, loci):
+    """determines the locus of an uploaded sequence from the locus given in its fasta header (DR2S)
+    (sample names are not used, as they may contain misleading locus names)
+
+    :param loci: the loci of the reference
+    :return: the locus, or None if it is unknown
+    """
+    locus = header_data["locus"]
+    if locus:
+        for candidate in [locus, f"HLA-{locus}"]:
+            if candidate in loci:
+                return candidate
+    return None
+
+
+def get_shard_dbs(fa_file, header_data, log):
+    """returns the BLAST databases to search for an uploaded sequence:
+    the shard of its locus if it is given in the fasta header, else all shards of the reference
+
+    :return: list of paths of BLAST databases; empty if the complete reference has to be searched
+    """
+    shards = load_shards(fa_file, log)
+    if not shards:
+        return []
+    locus = find_locus(header_data, shards)
+    if locus:
+        log.debug(f"\tSearching the reference alleles of {locus}...")
+        return [shards[locus]]
+    if header_data["locus"]:  # locus not in the reference => BLAST reports the error as usual
+        return []
+    return [shards[locus] for locus in sorted(shards)]
@@ -0,0 +1,327 @@
+#!/usr/bin/env python
+
+"""
+result_cache.py
+
+persistent, content-addressed cache for the results of processing new allele sequences,
+stored in the user's data directory:
+- the top BLAST hit of a sequence (so BLAST is not needed again for the same sequence & reference),
+- the annotation of a sequence (so neither alignment nor annotation are repeated,
+  e.g. when restarting an allele or creating the ENA & IPD files).
+
+Entries are keyed by the hash of the sequence, target family and the versions of the reference files used,
+so entries of outdated references are simply not found anymore;
+entries not used for a long time are evicted, as are the least recently used ones if the cache gets too big
+(checked at most once per hour).
+
+Additionally, the annotation of a sample is stored in its sample directory next to its BLAST output
+(e.g. 1234.blast.xml => 1234.annotation.pickle), together with the checksums of BLAST output and query fasta
+and the versions of the reference files, so the ENA & IPD steps can reuse it without reading the BLAST output.
+"""
+import os
+import time
+import threading
+from hashlib import sha1
+from pickle import dump, load, UnpicklingError
+
+try:
+    from .EMBLfunctions import fasta_generator
+    from .closestallele import AlignedHit, read_top_hits, BLAST_XML_EXT, BLAST_TABLE_EXT
+    from .reference_cache import get_version_token
+except ImportError:
+    from EMBLfunctions import fasta_generator
+    from closestallele import AlignedHit, read_top_hits, BLAST_XML_EXT, BLAST_TABLE_EXT
+    from reference_cache import get_version_token
+
+RESULT_CACHE_FORMAT = 1  # increase if the content of the cached results changes
+RESULT_CACHE_DIR = "result_cache"
+RESULT_CACHE_MAX_AGE = 180  # entries not used for this many days are removed
+RESULT_CACHE_MAX_BYTES = 200 * 1024 * 1024
+RESULT_CACHE_EVICT_INTERVAL = 60 * 60  # min. seconds between two evictions
+RESULT_CACHE_EVICT_MARKER = "last_eviction"  # its modification time is the time of the last eviction
+SAMPLE_ANNOTATION_EXT = ".annotation.pickle"
+
+
+# ===========================================================
+# storage:
+
+def get_cache_dir(settings):
+    """returns the directory of the result cache of the current user (None if there is no user directory)
+    """
+    if not settings.get("login_dir"):
+        return None
+    return os.path.join(settings["login_dir"], RESULT_CACHE_DIR)
+
+
+def get_key(kind, *values):
+    """returns the cache key (usable as file name) for the given kind of entry and the values it depends on
+    """
+    return f"{kind}_{sha1(repr((RESULT_CACHE_FORMAT,) + values).encode()).hexdigest()}"
+
+
+def read_pickle(path, log):
+    """returns the value pickled in path, or None if it does not exist or can't be read
+    """
+    try:
+        with open(path, "rb") as f:
+            return load(f)
+    except FileNotFoundError:
+        return None
+    except (EOFError, UnpicklingError, OSError) as E:
+        log.warning(f"Could not read cached result {os.path.basename(path)}: {repr(E)}")
+        return None
+
+
+def write_pickle(path, value, log):
+    """pickles value into path (written to a temporary file first, so readers never see half-written files)
+    """
+    temp_path = f"{path}.{os.getpid()}_{threading.get_ident()}.tmp"
+    try:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(temp_path, "wb") as g:
+            dump(value, g)
+        os.replace(temp_path, path)
+    except OSError as E:
+        log.warning(f"Could not cache result {os.path.basename(path)}: {repr(E)}")
+
+
+def load_entry(cache_dir, key, log):
+    """returns the cached value of key, or None if it is not cached;
+    marks the entry as recently used
+    """
+    path = os.path.join(cache_dir, key + ".pickle")
+    value = read_pickle(path, log)
+    if value is not None:
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+    return value
+
+
+def store_entry(cache_dir, key, value, log):
+    """stores value in the cache
+    """
+    write_pickle(os.path.join(cache_dir, key + ".pickle"), value, log)
+
+
+def evict_results(cache_dir, log, max_age=RESULT_CACHE_MAX_AGE, max_bytes=RESULT_CACHE_MAX_BYTES):
+    """removes cached results not used for more than max_age days,
+    then the least recently used ones until the cache fits into max_bytes
+    """
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.is_file() and entry.name.endswith(".pickle"):
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+    total_size = sum(size for (_, size, _) in entries)
+
+    oldest_allowed = time.time() - max_age * 24 * 60 * 60
+    removed = 0
+    for (last_used, size, path) in sorted(entries):
+        if last_used >= oldest_allowed and total_size <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total_size -= size
+        removed += 1
+    if removed:
+        log.debug(f"\tRemoved {removed} cached results")
+
+
+def evict_results_throttled(cache_dir, log, interval=RESULT_CACHE_EVICT_INTERVAL):
+    """calls evict_results unless the cache was already cleaned up during the last interval seconds
+    (so storing results does not scan the whole cache every time)
+    """
+    if not os.path.isdir(cache_dir):
+        return
+    marker = os.path.join(cache_dir, RESULT_CACHE_EVICT_MARKER)
+    try:
+        if time.time() - os.path.getmtime(marker) < interval:
+            return
+    except OSError:  # no eviction yet
+        pass
+    try:
+        with open(marker, "w"):
+            pass
+    except OSError as E:
+        log.warning(f"Could not mark the eviction of the result cache: {repr(E)}")
+    evict_results(cache_dir, log)
+
+
+# ===========================================================
+# BLAST hits:
+
+def get_hit_key(seq, target_family, parsedFasta, settings):
+    """returns the cache key of the top BLAST hit of a sequence
+    """
+    return get_key("hit", str(seq).upper(), target_family, get_version_token(parsedFasta),
+                   settings.get("closest_allele_engine", "blast"))
+
+
+def load_hits(fastaFilename, parsedFasta, target_family, settings, log):
+    """returns the cached top hits of all sequences of a fasta file
+
+    :return: list of (fasta header, closestallele.AlignedHit), or False if any of them is not cached
+    """
+    cache_dir = get_cache_dir(settings)
+    if not cache_dir:
+        return False
+    hits = []
+    for (header, seq) in fasta_generator(fastaFilename):
+        value = load_entry(cache_dir, get_hit_key(seq, target_family, parsedFasta, settings), log)
+        if not value:
+            return False
+        hits.append((header, AlignedHit(*value)))
+    if hits:
+        log.info(f"\tFound the closest alleles of {os.path.basename(fastaFilename)} in the result cache")
+    return hits
+
+
+def store_hits(blast_file, fastaFilename, parsedFasta, target_family, settings, log):
+    """stores the top hits of all sequences of a BLAST output file in the cache
+    """
+    cache_dir = get_cache_dir(settings)
+    if not cache_dir:
+        return
+    try:
+        top_hits = read_top_hits(blast_file, target_family, settings, log)
+        for (header, seq) in fasta_generator(fastaFilename):
+            hit = top_hits.get(header.split()[0])
+            if hit:
+                value = (hit.name, hit.ref_length, hit.query_from, hit.hit_from, hit.qseq, hit.hseq,
+                         hit.query_length)
+                store_entry(cache_dir, get_hit_key(seq, target_family, parsedFasta, settings), value, log)
+        evict_results_throttled(cache_dir, log)
+    except Exception as E:  # caching must never break processing
+        log.warning(f"Could not cache BLAST results of {os.path.basename(fastaFilename)}: {repr(E)}")
+
+
+# ===========================================================
+# annotations:
+
+def get_reference_fasta_file(target_family, settings):
+    """returns the parsed reference fasta file of the given target family
+    """
+    parsed_fasta = settings["parsed_kir"] if target_family == settings["gene_kir"] else settings["parsed_hla"]
+    return os.path.join(settings["dat_path"], settings["general_dir"], settings["reference_dir"], parsed_fasta)
+
+
+def get_annotation_keys(blast_file, query_sequences, target_family, allelesFilename, incomplete_ok, settings, log):
+    """returns the cache keys of the annotations of all queries of a BLAST output file,
+    depending on sequence, top hit and the reference files
+
+    :param query_sequences: dict of format {query_id: SeqRecord}
+    :return: dict of format {query_id: key}, or None if any query can't be cached
+    """
+    if not get_cache_dir(settings):
+        return None
+    try:
+        top_hits = read_top_hits(blast_file, target_family, settings, log)
+    except Exception as E:  # errors are reported when processing the BLAST output
+        log.debug(f"\tCould not read top hits of {os.path.basename(blast_file)}: {repr(E)}")
+        return None
+    reference_fasta = get_reference_fasta_file(target_family, settings)
+    keys = {}
+    for (query_id, hit) in top_hits.items():
+        if not hit or query_id not in query_sequences:
+            return None
+        keys[query_id] = get_key("annotation", str(query_sequences[query_id].seq).upper(), target_family,
+                                 (hit.name, hit.query_from, hit.hit_from, hit.qseq, hit.hseq, hit.query_length),
+                                 get_version_token(allelesFilename), get_version_token(reference_fasta),
+                                 bool(incomplete_ok), settings.get("TL_version"))
+    return keys or None
+
+
+def load_annotations(keys, settings, log):
+    """returns the cached annotations for the given keys (dict of format {query_id: key}),
+    or None if any of them is not cached
+    """
+    cache_dir = get_cache_dir(settings)
+    if not keys or not cache_dir:
+        return None
+    annotations = {}
+    for (query_id, key) in keys.items():
+        annotation = load_entry(cache_dir, key, log)
+        if annotation is None:
+            return None
+        annotations[query_id] = annotation
+    log.info("\tFound the annotation in the result cache")
+    return annotations
+
+
+def store_annotations(keys, annotations, settings, log):
+    """stores annotations (dict of format {query_id: annotation}) under the given keys
+    """
+    cache_dir = get_cache_dir(settings)
+    if not keys or not cache_dir:
+        return
+    for (query_id, key) in keys.items():
+        if annotations.get(query_id):
+            store_entry(cache_dir, key, annotations[query_id], log)
+    evict_results_throttled(cache_dir, log)
+
+
+# ===========================================================
+# per-sample annotations:
+
+def get_sample_annotation_file(blast_file):
+    """returns the path of the stored annotation belonging to a BLAST output file
+    """
+    for ext in [BLAST_XML_EXT, BLAST_TABLE_EXT]:
+        if blast_file.endswith(ext):
+            return blast_file[:-len(ext)] + SAMPLE_ANNOTATION_EXT
+    return blast_file + SAMPLE_ANNOTATION_EXT
+
+
+def get_file_checksum(path):
+    """returns the SHA1 checksum of the content of a file
+    """
+    checksum = sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+
+def get_sample_inputs(blast_file, seqs_file, target_family, allelesFilename, incomplete_ok, settings):
+    """returns everything the annotation of a sample depends on:
+    checksums of BLAST output & query fasta, versions of the reference files and the annotation settings
+    """
+    return (RESULT_CACHE_FORMAT, get_file_checksum(blast_file), get_file_checksum(seqs_file), target_family,
+            get_version_token(allelesFilename), get_version_token(get_reference_fasta_file(target_family, settings)),
+            bool(incomplete_ok), settings.get("TL_version"))
+
+
+def load_sample_annotations(blast_file, seqs_file, target_family, allelesFilename, incomplete_ok, settings, log):
+    """returns the annotations stored next to a BLAST output file,
+    or None if there are none or any of their inputs changed since
+    """
+    annotation_file = get_sample_annotation_file(blast_file)
+    if not os.path.isfile(annotation_file):
+        return None
+    stored = read_pickle(annotation_file, log)
+    try:
+        inputs = get_sample_inputs(blast_file, seqs_file, target_family, allelesFilename, incomplete_ok, settings)
+    except OSError as E:
+        log.debug(f"\tCould not check the stored annotation of {os.path.basename(blast_file)}: {repr(E)}")
+        return None
+    if not isinstance(stored, dict) or stored.get("inputs") != inputs:
+        log.debug(f"\tStored annotation of {os.path.basename(blast_file)} is outdated")
+        return None
+    log.info(f"\tFound the stored annotation of {os.path.basename(blast_file)}")
+    return stored["annotations"]
+
+
+def store_sample_annotations(blast_file, seqs_file, target_family, allelesFilename, incomplete_ok, annotations,
+                             settings, log):
+    """stores annotations next to the BLAST output file they were calculated from
+    """
+    try:
+        inputs = get_sample_inputs(blast_file, seqs_file, target_family, allelesFilename, incomplete_ok, settings)
+    except OSError as E:  # storing must never break processing
+        log.warning(f"Could not store the annotation of {os.path.basename(blast_file)}: {repr(E)}")
+        return
+    write_pickle(get_sample_annotation_file(blast_file), {"inputs": inputs, "annotations": annotations}, log)
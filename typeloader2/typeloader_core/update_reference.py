@@ -8,17 +8,22 @@ handles updating of the reference data for TypeLoader
 import os
 from pathlib import Path
 import datetime
-import re, subprocess, shutil, socket
+import re, subprocess, shutil, socket, filecmp
 import urllib.request
+import http.client
 from urllib.error import URLError
 import hashlib
-from typing import Tuple
+import threading
+import time
+from typing import Tuple, Callable
 import logging
 
 if __name__ == "__main__":
-    import hla_embl_parser
+    import hla_embl_parser, reference_index, reference_shards
+    from reference_cache import reference_cache, get_version_token
 else:
-    from . import hla_embl_parser
+    from . import hla_embl_parser, reference_index, reference_shards
+    from .reference_cache import reference_cache, get_version_token
 
 remote_db_path = {
     "hla_path": "https://github.com/DKMS-LSL/IMGTHLA/raw/Latest/hla.dat",
@@ -37,11 +42,18 @@ remote_checksumfile_index = {
 
 COUNTRY_URL = "https://raw.githubusercontent.com/DKMS-LSL/typeloader_reference_parser/master/data/countries.csv"
 COUNTRY_FILE = "collection_country_options.csv"
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024  # bytes
+RESTRICTED_CACHE_DIR = "restricted_db_cache"  # created next to the target_dir of restricted databases
+RESTRICTED_CACHE_MAX_AGE = 30  # days since last use
+RESTRICTED_CACHE_MAX_BYTES = 500 * 1024 * 1024
 
+# held while reference files are replaced and while they are read by BLAST & annotation,
+# so a reference update running in the background never swaps files in the middle of their use:
+reference_lock = threading.RLock()
 
-def read_remote_file(myurl, proxy, timeout, log, return_binary=False):
-    """reads a remote file from a given URL, either using the given proxy or not if none is given,
-    returns the data as string
+
+def get_opener(proxy, log):
+    """returns a URL opener, using the given proxy or not if none is given
     """
     if proxy:
         log.debug("Using proxy...")
@@ -50,7 +62,14 @@ def read_remote_file(myurl, proxy, timeout, log, return_binary=False):
     else:
         log.debug("Not using proxy...")
         opener = urllib.request.build_opener()
+    return opener
+
 
+def read_remote_file(myurl, proxy, timeout, log, return_binary=False):
+    """reads a remote file from a given URL, either using the given proxy or not if none is given,
+    returns the data as string
+    """
+    opener = get_opener(proxy, log)
     with opener.open(myurl, timeout=timeout) as request:
         html = request.read()
         if return_binary:
@@ -59,6 +78,123 @@ def read_remote_file(myurl, proxy, timeout, log, return_binary=False):
     return data
 
 
+def get_total_size(response, start):
+    """returns the total size of a remote file from the headers of a (possibly partial) response
+    (None if unknown)
+    """
+    content_range = response.headers.get("Content-Range")  # format: 'bytes start-end/total'
+    if content_range and "/" in content_range:
+        total = content_range.split("/")[-1].strip()
+        if total.isdigit():
+            return int(total)
+    length = response.headers.get("Content-Length")
+    if length and length.isdigit():
+        return int(length) + start
+    return None
+
+
+def make_progress_logger(log, name, interval=5):
+    """returns a progress callback for download_file that logs the download progress
+    at most every interval seconds
+    """
+    last = [0]
+
+    def log_progress(done, total, bytes_per_sec):
+        now = time.time()
+        if now - last[0] < interval and done != total:
+            return
+        last[0] = now
+        total_txt = f"{total / 1024 / 1024:.1f}" if total else "?"
+        log.debug(f"\t\t{name}: {done / 1024 / 1024:.1f} of {total_txt} MB ({bytes_per_sec / 1024:.0f} kB/s)")
+    return log_progress
+
+
+def download_file(myurl, local_file, proxy, timeout, log, progress_callback: Callable = None,
+                  max_retries=3, chunk_size=DOWNLOAD_CHUNK_SIZE):
+    """downloads a remote file to local_file, streaming it to disk in chunks
+    while computing its MD5 checksum.
+    The data is first written to local_file + '.part'; if that exists already (or the connection breaks),
+    the download is resumed from there via an HTTP Range request.
+    Resuming uses the ETag/Last-Modified header of the first response (stored in local_file + '.part.info'),
+    so a partial download is never continued with a changed remote file.
+
+    :param progress_callback: function called after each chunk with (bytes done, total bytes or None, bytes/s)
+    :param max_retries: number of times an interrupted download is resumed before giving up
+    :return: MD5 checksum (hexdigest) of the downloaded file
+    """
+    part_file = local_file + ".part"
+    info_file = part_file + ".info"
+    opener = get_opener(proxy, log)
+    md5 = hashlib.md5()
+    done = 0
+    validator = None
+    if os.path.isfile(part_file) and os.path.isfile(info_file):  # resume earlier download
+        with open(info_file) as f:
+            validator = f.read().strip()
+        with open(part_file, "rb") as f:
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                md5.update(chunk)
+                done += len(chunk)
+        log.debug(f"\tResuming download of {myurl} after {done} bytes...")
+
+    retries = 0
+    while True:
+        request = urllib.request.Request(myurl)
+        if done and validator:
+            request.add_header("Range", f"bytes={done}-")
+            request.add_header("If-Range", validator)
+        else:
+            md5 = hashlib.md5()
+            done = 0
+        try:
+            with opener.open(request, timeout=timeout) as response:
+                if done and response.status != 206:  # remote file changed or no Range support => start from scratch
+                    log.debug("\tCannot resume download, restarting download...")
+                    md5 = hashlib.md5()
+                    done = 0
+                if not done:
+                    validator = response.headers.get("ETag") or response.headers.get("Last-Modified")
+                    if validator:
+                        with open(info_file, "w") as g:
+                            g.write(validator)
+                    elif os.path.exists(info_file):
+                        os.remove(info_file)
+                total = get_total_size(response, done)
+                start_time = time.time()
+                start_done = done
+                with open(part_file, "ab" if done else "wb") as g:
+                    for chunk in iter(lambda: response.read(chunk_size), b""):
+                        g.write(chunk)
+                        md5.update(chunk)
+                        done += len(chunk)
+                        if progress_callback:
+                            elapsed = max(time.time() - start_time, 1e-6)
+                            progress_callback(done, total, (done - start_done) / elapsed)
+            if total and done < total:
+                raise ConnectionError(f"Download ended after {done} of {total} bytes")
+            break
+        except urllib.error.HTTPError as E:
+            if E.code == 416 and done:  # requested range not satisfiable => partial file unusable
+                log.debug("\tCould not resume download, restarting download...")
+                os.remove(part_file)
+                md5 = hashlib.md5()
+                done = 0
+            else:
+                raise
+        except (socket.timeout, ConnectionError, URLError, http.client.HTTPException) as E:
+            retries += 1
+            if retries > max_retries:
+                raise
+            log.warning(f"Download of {myurl} interrupted after {done} bytes ({repr(E)}), resuming...")
+
+    if os.path.exists(local_file):
+        os.remove(local_file)
+    shutil.move(part_file, local_file)
+    if os.path.exists(info_file):
+        os.remove(info_file)
+    return md5.hexdigest()
+
+
 def read_local_md5_checkfile(ref_path: str, db_name: str, log) -> Tuple[str | None, bool]:
     """Get md5 checksum and last modified date of local reference file.
 
@@ -122,7 +258,11 @@ def get_local_md5checksum(local_reference_file, log):
     """
     log.debug("\tGetting checksum of local file {}...".format(local_reference_file))
 
-    md5 = hashlib.md5(open(local_reference_file, "rb").read()).hexdigest()
+    md5 = hashlib.md5()
+    with open(local_reference_file, "rb") as f:
+        for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b""):
+            md5.update(chunk)
+    md5 = md5.hexdigest()
     log.debug("\t=> {}".format(md5))
     return md5
 
@@ -147,18 +287,53 @@ def make_blast_db(target, ref_dir, blast_path, log):
         return False, msg
 
 
+def reuse_blast_db(target, old_ref_dir, ref_dir, log):
+    """copies the blast database of the previous reference version (including its per-locus shards) to ref_dir
+    if the new parsed fasta file is identical to the previous one;
+    returns True if this was possible
+    """
+    fa_file = os.path.join(ref_dir, f"parsed{target}.fa")
+    old_fa_file = os.path.join(old_ref_dir, f"parsed{target}.fa")
+    if not os.path.isfile(old_fa_file) or not filecmp.cmp(old_fa_file, fa_file, shallow=False):
+        return False
+    blast_files = [myfile for myfile in os.listdir(old_ref_dir) if myfile.startswith(f"parsed{target}.fa.")
+                   and not myfile.endswith((".fai", ".seqidx", ".kmeridx"))]  # indices were created with the new fasta file
+    if not blast_files:
+        return False
+    log.debug("\tReference sequences unchanged, reusing previous blast database...")
+    for myfile in blast_files:
+        shutil.copy2(os.path.join(old_ref_dir, myfile), os.path.join(ref_dir, myfile))
+    return True
+
+
 def move_files(ref_path_temp, ref_path, target, log):
     """moves all files from ref_path_temp to ref_path, replacing existing files
+    (all at once while holding reference_lock, so no reader ever sees a mix of old and new files);
+    per-locus blast databases not listed in the new shard manifest are removed,
+    all of them if no new shard manifest was created
     """
     log.debug("\tReplacing old files with new files...")
-    for myfile in os.listdir(ref_path_temp):
-        if target.lower() in myfile.lower():
-            src_path = os.path.join(ref_path_temp, myfile)
-            target_path = os.path.join(ref_path, myfile)
-            log.debug("\t\t- {}".format(myfile))
-            if os.path.exists(target_path):
-                os.remove(target_path)
-            shutil.move(src_path, target_path)
+    fa_name = f"parsed{target}.fa"
+    manifest_name = reference_shards.get_manifest_file(fa_name)
+    loci = reference_shards.get_known_loci(os.path.join(ref_path, fa_name), log)  # old & new shards
+    loci |= reference_shards.get_known_loci(os.path.join(ref_path_temp, fa_name), log)
+    with reference_lock:
+        new_shards = os.path.isfile(os.path.join(ref_path_temp, manifest_name))
+        for myfile in os.listdir(ref_path_temp):
+            if target.lower() in myfile.lower():
+                src_path = os.path.join(ref_path_temp, myfile)
+                target_path = os.path.join(ref_path, myfile)
+                log.debug("\t\t- {}".format(myfile))
+                os.replace(src_path, target_path)
+
+        keep = set()
+        if new_shards:
+            keep = {os.path.basename(shard_db)
+                    for shard_db in reference_shards.load_shards(os.path.join(ref_path, fa_name), log).values()}
+        elif os.path.isfile(os.path.join(ref_path, manifest_name)):
+            os.remove(os.path.join(ref_path, manifest_name))  # shards of the previous version
+        reference_shards.remove_shard_files(ref_path, fa_name, loci, log, keep=keep)
+        reference_cache.invalidate(ref_path)
 
 
 def check_database(db_name, reference_local_path, proxy, log, skip_if_updated_today=True):
@@ -196,8 +371,11 @@ def check_database(db_name, reference_local_path, proxy, log, skip_if_updated_to
     return True, msg
 
 
-def update_database(db_name, reference_local_path, blast_path, proxy, log, version=None):
+def update_database(db_name, reference_local_path, blast_path, proxy, log, version=None, workers=1,
+                    progress_callback=None):
     """updates a reference database
+    (workers = number of processes used to parse the .dat file, 0 = all available cores;
+    progress_callback: see download_file, by default the download progress is logged)
     """
     log.info("Retrieving new database version for {}...".format(db_name))
     if db_name == "kir":
@@ -216,12 +394,12 @@ def update_database(db_name, reference_local_path, blast_path, proxy, log, versi
     log.debug(f"\tdownloading new file from {remote_db_file}...")
     local_db_file = os.path.join(ref_path_temp, "%s.dat" % use_dbname)
 
+    if not progress_callback:
+        progress_callback = make_progress_logger(log, f"{use_dbname}.dat")
     try:
-        db_response = read_remote_file(remote_db_file, proxy, 60, log, return_binary=True)
-        with open(local_db_file, "wb") as db_local:
-            db_local.write(db_response)
+        local_md5 = download_file(remote_db_file, local_db_file, proxy, 60, log,
+                                  progress_callback=progress_callback)
         log.debug("\t => successfully downloaded new {} file".format(db_name))
-        local_md5 = get_local_md5checksum(local_db_file, log)
         log.debug(f"\t => MD5 of downloaded file: {local_md5}")
     except urllib.error.HTTPError:
         msg = f"Sorry, could not find file {remote_db_file}!\n\n" \
@@ -232,9 +410,21 @@ def update_database(db_name, reference_local_path, blast_path, proxy, log, versi
         return False, msg
 
     log.debug("\tCreating parsed files...")
-    version = hla_embl_parser.make_parsed_files(use_dbname, ref_path_temp, log)
+    version, _ = hla_embl_parser.make_parsed_files_incremental(use_dbname, ref_path_temp, reference_local_path, log,
+                                                               workers=workers)
 
-    success, msg = make_blast_db(use_dbname, ref_path_temp, blast_path, log)
+    if reuse_blast_db(use_dbname, reference_local_path, ref_path_temp, log):
+        success, msg = True, None
+    else:
+        success, msg = make_blast_db(use_dbname, ref_path_temp, blast_path, log)
+
+    fa_file = os.path.join(ref_path_temp, f"parsed{use_dbname}.fa")
+    if success and not os.path.isfile(reference_shards.get_manifest_file(fa_file)):
+        shards_ok, shards_msg = reference_shards.make_shard_dbs(fa_file, blast_path, log)
+        if not shards_ok:  # not fatal: uploads are BLASTed against the complete reference instead
+            log.warning(shards_msg)
+            reference_shards.remove_shard_files(ref_path_temp, os.path.basename(fa_file),
+                                                reference_shards.get_known_loci(fa_file, log), log)
 
     if success:
         curr_md5_file = os.path.join(ref_path_temp, f"curr_md5_{use_dbname}.txt")
@@ -243,7 +433,7 @@ def update_database(db_name, reference_local_path, blast_path, proxy, log, versi
             g.write(f"{local_md5} {datetime.datetime.now().strftime('%d.%m.%y')}")
 
         update_msg = f"Updated the reference data for {db_name.upper()} to version {version}."
-        move_files(ref_path_temp, reference_local_path, db_name, log)
+        move_files(ref_path_temp, reference_local_path, use_dbname, log)
     else:
         log.error(msg)
         update_msg = f"Tried to update the reference data for {db_name.upper()} to version {version}, "
@@ -253,8 +443,48 @@ def update_database(db_name, reference_local_path, blast_path, proxy, log, versi
     return success, update_msg
 
 
-def make_restricted_db(db_name, ref_path, restricted_to, target_dir, blast_path, log):
-    """creates a limited version of the given database, restricted to the given alleles
+def get_restricted_db_key(dat_file, restricted_to):
+    """returns the cache key of a restricted database:
+    a hash of the sorted allele names plus the version token of the reference they are taken from
+    """
+    (path, version_token) = get_version_token(dat_file)
+    mykey = repr((path, version_token, sorted(set(restricted_to))))
+    return hashlib.sha1(mykey.encode("utf-8")).hexdigest()
+
+
+def get_dir_size(mydir):
+    """returns the summed size of all files in a directory (in bytes)
+    """
+    return sum(entry.stat().st_size for entry in os.scandir(mydir) if entry.is_file())
+
+
+def evict_restricted_dbs(cache_dir, log, keep=None, max_age=RESTRICTED_CACHE_MAX_AGE,
+                         max_bytes=RESTRICTED_CACHE_MAX_BYTES):
+    """removes cached restricted databases not used for more than max_age days,
+    then the least recently used ones until the cache fits into max_bytes
+    (the entry named keep is never removed)
+    """
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.is_dir() and entry.name != keep and "." not in entry.name:  # skip unfinished entries
+            entries.append((entry.stat().st_mtime, get_dir_size(entry.path), entry.path))
+    total_size = sum(size for (_, size, _) in entries)
+    if keep and os.path.isdir(os.path.join(cache_dir, keep)):
+        total_size += get_dir_size(os.path.join(cache_dir, keep))
+
+    oldest_allowed = time.time() - max_age * 24 * 60 * 60
+    for (last_used, size, mydir) in sorted(entries):
+        if last_used >= oldest_allowed and total_size <= max_bytes:
+            break
+        log.debug(f"\tRemoving cached restricted database {os.path.basename(mydir)}...")
+        shutil.rmtree(mydir, ignore_errors=True)
+        total_size -= size
+
+
+def make_restricted_db(db_name, ref_path, restricted_to, target_dir, blast_path, log, cache_dir=None):
+    """creates a limited version of the given database, restricted to the given alleles;
+    the alleles are read via the reference index, and each restricted database is cached in cache_dir
+    (keyed by allele set & reference version), so repeated requests only copy the cached files to target_dir
     """
     log.info(f"Create local reference version of {db_name} restricted to {', '.join(restricted_to)}...")
     if db_name == "kir":
@@ -262,20 +492,40 @@ def make_restricted_db(db_name, ref_path, restricted_to, target_dir, blast_path,
     else:
         use_dbname = db_name
 
+    if not cache_dir:
+        cache_dir = os.path.join(os.path.dirname(os.path.abspath(target_dir)), RESTRICTED_CACHE_DIR)
+    os.makedirs(cache_dir, exist_ok=True)
     os.makedirs(target_dir, exist_ok=True)
 
-    log.debug("\tCreating parsed files...")
-    hla_embl_parser.make_parsed_files(use_dbname, ref_path, log,
-                                      restricted_to=restricted_to,
-                                      target_dir=target_dir)
-
-    success, msg = make_blast_db(use_dbname, target_dir, blast_path, log)
-
-    if success:
-        log.info("Success!")
+    key = get_restricted_db_key(os.path.join(ref_path, f"{use_dbname}.dat"), restricted_to)
+    cached_dir = os.path.join(cache_dir, key)
+    if os.path.isdir(cached_dir):
+        log.debug("\tUsing cached restricted database...")
+        os.utime(cached_dir)  # remember last use
     else:
-        log.error(msg)
-    return success, msg
+        temp_dir = f"{cached_dir}.{os.getpid()}_{threading.get_ident()}"
+        try:
+            log.debug("\tCreating parsed files...")
+            reference_index.make_restricted_parsed_files(use_dbname, ref_path, restricted_to, temp_dir, log)
+
+            success, msg = make_blast_db(use_dbname, temp_dir, blast_path, log)
+            if not success:
+                log.error(msg)
+                return success, msg
+            try:
+                os.replace(temp_dir, cached_dir)
+            except OSError:  # created by a concurrent call in the meantime
+                pass
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+        evict_restricted_dbs(cache_dir, log, keep=key)
+
+    for myfile in os.listdir(cached_dir):
+        shutil.copy2(os.path.join(cached_dir, myfile), os.path.join(target_dir, myfile))
+    reference_cache.invalidate(target_dir)
+
+    log.info("Success!")
+    return True, None
 
 
 def update_country_data(target_dir: str, proxy: str, log: logging.Logger) -> Tuple[bool, str | None]:
@@ -16,7 +16,9 @@ import os, shutil
 import re
 from pathlib import Path
 import string, random, time
+import threading
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from Bio import SeqIO
 from PyQt5.QtSql import QSqlQuery
 
@@ -24,7 +26,8 @@ from typing import List, Optional, Tuple, Dict
 
 from typeloader2.typeloader_core import (EMBLfunctions as EF, coordinates as COO, backend_make_ena as BME,
                                          backend_enaformat as BE, getAlleleSeqsAndBlast as GASB,
-                                         closestallele as CA, errors, update_reference)
+                                         closestallele as CA, errors, update_reference, result_cache)
+from typeloader2.typeloader_core.hla_embl_parser import get_num_workers
 from typeloader2 import general, db_internal, db_external
 
 # ===========================================================
@@ -52,10 +55,56 @@ MISSING_SPATIOTEMPORAL_OPTIONS = [  # source: https://www.insdc.org/submitting-s
 
 DATE_PATTERN = "^\d{4}(-\d{2})?(-\d{2})?$"
 
+REFERENCE_UPDATE_LOCKS = {"hla": threading.Lock(), "kir": threading.Lock()}  # one update per reference at a time
+
 
 # ===========================================================
 # classes:
 
+class ReferenceUpdateProgress:
+    """combines the download progress of concurrent reference updates into one progress report
+    """
+    def __init__(self, log, report_func=None, interval=5):
+        self.log = log
+        self.report_func = report_func  # called with the combined report text; if None, the report is logged
+        self.interval = interval  # min. seconds between reports
+        self.status = {}  # db_name => (bytes done, total bytes or None, bytes/s)
+        self.last_report = 0
+        self.lock = threading.Lock()
+
+    def callback_for(self, db_name):
+        """returns a progress callback for the download of db_name (see update_reference.download_file)
+        """
+        def callback(done, total, bytes_per_sec):
+            self.update(db_name, done, total, bytes_per_sec)
+        return callback
+
+    def update(self, db_name, done, total, bytes_per_sec):
+        with self.lock:
+            self.status[db_name] = (done, total, bytes_per_sec)
+            now = time.time()
+            if now - self.last_report < self.interval and done != total:
+                return
+            self.last_report = now
+            text = self.make_report()
+        if self.report_func:
+            self.report_func(text)
+        else:
+            self.log.info(text)
+
+    def make_report(self):
+        """returns the combined progress of all downloads as text
+        """
+        parts = []
+        speed = 0
+        for db_name, (done, total, bytes_per_sec) in self.status.items():
+            total_txt = f"{total / 1024 / 1024:.1f}" if total else "?"
+            parts.append(f"{db_name} {done / 1024 / 1024:.1f} of {total_txt} MB")
+            if done != total:
+                speed += bytes_per_sec
+        return f"Downloading reference data: {', '.join(parts)} ({speed / 1024 / 1024:.1f} MB/s)"
+
+
 class Allele:
     def __init__(self, gendx_result, gene, name, product, targetFamily, sample_id_int, settings, log,
                  newAlleleName="", partner_allele="", parent=None, existing_values=None):
@@ -131,13 +180,16 @@ class Allele:
 
 
 def perform_reference_update(db_name: str, reference_local_path: str, blast_path: str, proxy: str | None, log,
-                             version: str = None) -> Tuple[bool, str | None, str]:
+                             version: str = None, workers: int | str = 1,
+                             progress_callback=None) -> Tuple[bool, str | None, str]:
     """call trigger reference update of a database
 
     :param db_name: HLA or KIR
     :param reference_local_path: path to 'reference_data' dir
     :param blast_path: path to BLASTN
     :param log: logger instance
+    :param workers: number of processes used to parse the reference file (0 = all available cores)
+    :param progress_callback: called during the download with (bytes done, total bytes, bytes/s)
     :return: success (bool), error_type (str or None), message (str)
     """
     db_name = db_name.lower()
@@ -145,16 +197,26 @@ def perform_reference_update(db_name: str, reference_local_path: str, blast_path
         return False, "Unknown reference type", \
             f"'{db_name}' is an unknown reference. Please select 'hla' or 'kir'!"
 
+    update_lock = REFERENCE_UPDATE_LOCKS[db_name]
+    if not update_lock.acquire(blocking=False):  # e.g., a manual reset during a background update
+        msg = f"The {db_name.upper()} reference is currently being updated. " \
+              f"Please try again once this update has finished!"
+        log.warning(msg)
+        return False, "Reference update running", msg
+
     blast_dir = os.path.dirname(blast_path)
     try:
         success, update_msg = update_reference.update_database(db_name, reference_local_path,
                                                                blast_dir, proxy, log,
-                                                               version=version)
+                                                               version=version, workers=workers,
+                                                               progress_callback=progress_callback)
     except Exception as E:
         log.exception("Reference update failed!")
         general.play_sound(log)
         msg = f"Could not update the reference database(s). Please try again!\n\nError: {repr(E)}"
         return False, "Reference update failed", msg
+    finally:
+        update_lock.release()
 
     if success:
         err = None
@@ -164,6 +226,29 @@ def perform_reference_update(db_name: str, reference_local_path: str, blast_path
     return success, err, update_msg
 
 
+def perform_reference_updates(db_names: List[str], reference_local_path: str, blast_path: str, proxy: str | None,
+                              log, workers: int | str = 1,
+                              report_func=None) -> Dict[str, Tuple[bool, str | None, str]]:
+    """updates several reference databases concurrently
+    (download, parsing and makeblastdb of each database run in their own thread);
+    a failed update does not affect the others
+
+    :param db_names: list of databases to update (HLA and/or KIR)
+    :param workers: number of processes used to parse the reference files, shared by all updates
+                    (0 = all available cores)
+    :param report_func: called with the combined download progress of all databases (as text)
+    :return: dict of format {db_name: (success, error_type, message)}, in the order of db_names
+    """
+    progress = ReferenceUpdateProgress(log, report_func)
+    workers = max(get_num_workers(workers) // max(len(db_names), 1), 1)  # split the cores between the updates
+    with ThreadPoolExecutor(max_workers=max(len(db_names), 1)) as executor:
+        futures = {db_name: executor.submit(perform_reference_update, db_name, reference_local_path, blast_path,
+                                            proxy, log, workers=workers,
+                                            progress_callback=progress.callback_for(db_name.upper()))
+                   for db_name in db_names}
+    return {db_name: futures[db_name].result() for db_name in db_names}
+
+
 def update_curr_versions(settings: dict, log) -> None:
     """gets the current version of the reference databases
     """
@@ -360,8 +445,20 @@ def toggle_project_status(proj_name: str, curr_status: str, log, values=["Open",
         return success, curr_status, 0
 
 
-def upload_parse_sequence_file(raw_path: str, settings: dict, log, use_given_reference: str | bool = False):
+def get_temp_raw_file(raw_path: str, filetype: str, settings: dict) -> str:
+    """returns the path in temp_dir to which a raw file is uploaded
+    """
+    temp_raw_file = os.path.join(settings["temp_dir"], os.path.basename(raw_path).replace(" ", "_"))
+    if filetype == "FASTA":
+        if os.path.splitext(raw_path)[1].lower() != ".fa":
+            temp_raw_file = os.path.splitext(temp_raw_file)[0] + ".fa"
+    return temp_raw_file
+
+
+def upload_parse_sequence_file(raw_path: str, settings: dict, log, use_given_reference: str | bool = False,
+                               blast_xml_file: str | bool = False):
     """uploads file from raw_path to temp_dir and parses it
+    (blast_xml_file: BLAST result of a previous batch BLAST run of this file, if available)
     """
     log.debug("Uploading file {} to temp location...".format(raw_path))
     extension = os.path.splitext(raw_path)[1].lower()
@@ -381,10 +478,7 @@ def upload_parse_sequence_file(raw_path: str, settings: dict, log, use_given_ref
 
     # save uploaded file to temp dir:
     try:
-        temp_raw_file = os.path.join(settings["temp_dir"], os.path.basename(raw_path).replace(" ", "_"))
-        if filetype == "FASTA":
-            if extension != ".fa":
-                temp_raw_file = os.path.splitext(temp_raw_file)[0] + ".fa"
+        temp_raw_file = get_temp_raw_file(raw_path, filetype, settings)
         log.info("Saving file to {}".format(temp_raw_file))
         shutil.copyfile(raw_path, temp_raw_file)
         log.info("\t=> Done!")
@@ -396,7 +490,8 @@ def upload_parse_sequence_file(raw_path: str, settings: dict, log, use_given_ref
     # read file:
     try:
         results = GASB.blast_raw_seqs(temp_raw_file, filetype, settings, log,
-                                      use_given_reference=use_given_reference)
+                                      use_given_reference=use_given_reference,
+                                      blast_xml_file=blast_xml_file)
     except ValueError as E:
         msg = E.args[0]
         if msg.startswith("Fasta"):
@@ -476,8 +571,22 @@ def remove_other_allele(blast_xml_file: str, fasta_file: str, other_allele_name:
         os.remove(fasta_file)
         shutil.move(temp, fasta_file)
 
-    log.debug("\tCleaning XML file...")
     temp = blast_xml_file + "1"
+    if blast_xml_file.endswith(CA.BLAST_TABLE_EXT):
+        log.debug("\tCleaning BLAST output file...")
+        with open(blast_xml_file, "r") as f, open(temp, "w") as g:
+            blocks = [block for block in CA.read_blast_table_blocks(f)
+                      if not any(line.startswith("# Query:") and other_allele_name in line for line in block)]
+            for block in blocks:
+                g.writelines(block)
+            g.write(f"# BLAST processed {len(blocks)} queries\n")
+        if replace:
+            os.remove(blast_xml_file)
+            shutil.move(temp, blast_xml_file)
+        log.debug("\t=> Done!")
+        return
+
+    log.debug("\tCleaning XML file...")
     with open(blast_xml_file, "r") as f, open(temp, "w") as g:
         header = True
         for line in f:
@@ -741,7 +850,10 @@ def move_files_to_sample_dir(project: str, sample_name: str, local_name: str, fi
         os.makedirs(sample_dir)
     log.debug("\tMoving files to sample_dir: {}".format(sample_dir))
     raw_file = general.move_rename_file(temp_raw_file, sample_dir, local_name)
+    annotation_file = result_cache.get_sample_annotation_file(blastXmlFile)
     blastXmlFile = general.move_rename_file(blastXmlFile, sample_dir, local_name)
+    if os.path.isfile(annotation_file):  # keep the annotation next to its blast file
+        shutil.move(annotation_file, result_cache.get_sample_annotation_file(blastXmlFile))
     if filetype == "XML":
         fasta_filename = general.move_rename_file(fasta_filename, sample_dir, local_name)
     else:
@@ -1041,13 +1153,14 @@ def parse_bulk_csv(csv_file: str, settings: dict, log):
 
 
 def handle_new_allele_parsing(project_name: str, sample_id_int: str, sample_id_ext: str, raw_path: str, customer: str,
-                              settings: dict, log, use_restricted_db=False):
+                              settings: dict, log, use_restricted_db=False, blast_xml_file=False):
     """handles step one of the uploading of one new allele to TL;
     called by NewAlleleForm and upload_new_allele_complete()
     """
     log.info("Uploading {} to project {}...".format(sample_id_int, project_name))
     results = upload_parse_sequence_file(raw_path, settings, log,
-                                         use_given_reference=use_restricted_db)
+                                         use_given_reference=use_restricted_db,
+                                         blast_xml_file=blast_xml_file)
     if not results[0]:  # something went wrong
         return False, "{}: {}".format(results[1], results[2])
     log.debug("\t=> success")
@@ -1070,12 +1183,12 @@ def handle_new_allele_parsing(project_name: str, sample_id_int: str, sample_id_e
 def upload_new_allele_complete(project_name: str, sample_id_int: str, sample_id_ext: str, raw_path: str, customer: str,
                                provenance: str, sample_date: str,
                                settings: dict, mydb, log, incomplete_ok=False, use_restricted_db=False,
-                               startover=False):
+                               startover=False, blast_xml_file=False):
     """adds one new target sequence to TypeLoader
     """
     success, results = handle_new_allele_parsing(project_name, sample_id_int, sample_id_ext,
                                                  raw_path, customer, settings, log,
-                                                 use_restricted_db)
+                                                 use_restricted_db, blast_xml_file)
     if not success:
         log.warning("Could not upload target file")
         log.warning(results)
@@ -1137,12 +1250,35 @@ def upload_new_allele_complete(project_name: str, sample_id_int: str, sample_id_
         return False, "{}: {}".format(err_type, msg)
 
 
+def batch_blast_bulk_alleles(alleles: list, settings: dict, log) -> dict:
+    """BLASTs the fasta files of all alleles of a bulk upload with one BLAST run per target family,
+    so BLAST is not started once per allele;
+    returns dict of format {nr: BLAST XML file}
+    (alleles missing from it are BLASTed one by one during their upload)
+    """
+    temp_files = {}  # temp_raw_file => nr
+    for [nr, _, _, raw_path, _, _, _, _] in alleles:
+        temp_raw_file = get_temp_raw_file(raw_path, "FASTA", settings)
+        if temp_raw_file in temp_files or nr in temp_files.values():  # would get mixed up
+            continue
+        try:
+            shutil.copyfile(raw_path, temp_raw_file)
+        except Exception as E:
+            log.exception(E)
+            continue
+        temp_files[temp_raw_file] = nr
+
+    results = GASB.blast_raw_seqs_batch(list(temp_files), settings, log)
+    return {temp_files[temp_raw_file]: xml_file for (temp_raw_file, xml_file) in results.items()}
+
+
 def bulk_upload_new_alleles(csv_file: str, project: str, settings: dict, mydb, log):
     """performs bulk uploading, parsing and saving of new target alleles
     specified in a .csv file
     """
     log.info("Starting bulk upload from file {}...".format(csv_file))
     alleles, error_dic, num_rows = parse_bulk_csv(csv_file, settings, log)
+    blast_results = batch_blast_bulk_alleles(alleles, settings, log)
     successful = []
     alleles_uploaded = []
     for allele in alleles:
@@ -1150,7 +1286,8 @@ def bulk_upload_new_alleles(csv_file: str, project: str, settings: dict, mydb, l
         log.info("Uploading #{}: {}...".format(nr, sample_id_int))
         success, msg = upload_new_allele_complete(project, sample_id_int, sample_id_ext, raw_path, customer, provenance,
                                                   sample_date,
-                                                  settings, mydb, log, incomplete_ok=incomplete_ok)
+                                                  settings, mydb, log, incomplete_ok=incomplete_ok,
+                                                  blast_xml_file=blast_results.get(nr, False))
         if success:
             local_name = msg
             successful.append("  - #{}: {}".format(nr, local_name))